@@ -5,14 +5,34 @@ import json
 import sys
 import shutil
 import threading
+import functools
+import contextvars
+import queue
+import atexit
+import bisect
+import traceback
+import gc
+import base64
+import tempfile
+import gzip
+import io
+import socket
+import signal
+import select
+import subprocess
+import zlib
+import struct
+import hashlib
+import mimetypes
+from collections import deque, namedtuple
 from datetime import datetime
 from pathlib import Path
 import sqlite3
 import logging
 from flask import (
     Flask, render_template, request, redirect, url_for, 
-    flash, session, send_from_directory, jsonify, abort,
-    make_response
+    flash, session, send_from_directory, send_file, jsonify, abort,
+    make_response, stream_template, g
 )
 from flask_login import (
     LoginManager, UserMixin, login_user, 
@@ -22,13 +42,20 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField
 from wtforms.validators import DataRequired, Length, EqualTo, Regexp
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship
+from socketio import PubSubManager
+from sqlalchemy import create_engine, event, bindparam, or_, and_, func, insert, select, literal, union_all, Index, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship, make_transient_to_detached, joinedload
 from markupsafe import escape, Markup
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.local import LocalProxy
+from werkzeug.http import is_resource_modified
 import re
 import html
+import click
 from flask_cors import CORS
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, WatchedFileHandler
 # 配置
 from config import Config
 
@@ -36,38 +63,70 @@ from config import Config
 app = Flask(__name__)
 app.config.from_object(Config)
 
-# 创建logs目录
+# 日志目录，由 setup_logging() 创建
 log_dir = Path(app.root_path) / 'logs'
-log_dir.mkdir(exist_ok=True)
+logger = logging.getLogger('social_platform')
+
+def rotated_log_path(path):
+    """轮转后的文件名：原文件名加时间戳，同一秒多次轮转时追加序号"""
+    path = Path(path)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    candidate = path.with_name(f"{path.name}.{stamp}")
+    counter = 1
+    while candidate.exists() or candidate.with_name(candidate.name + '.gz').exists():
+        candidate = path.with_name(f"{path.name}.{stamp}-{counter}")
+        counter += 1
+    return candidate
+
+class ArchivingRotatingFileHandler(RotatingFileHandler):
+    """按大小轮转，轮转出的文件交给 archiver 在后台压缩，不再按 backupCount 删除"""
+
+    archiver = None
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            rotated = rotated_log_path(self.baseFilename)
+            os.rename(self.baseFilename, rotated)
+            if self.archiver is not None:
+                self.archiver.submit(rotated)
+        if not self.delay:
+            self.stream = self._open()
 
 # 配置日志
-try:
-    log_file = log_dir / 'system.log'
-    
-    # 确保新日志使用UTF-8
-    handler = RotatingFileHandler(
-        log_file, 
-        maxBytes=10*1024*1024,  # 10 MB
-        backupCount=5,
-        encoding='utf-8'  # 关键：强制使用UTF-8编码
-    )
-    
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    
-    logger = logging.getLogger('social_platform')
-    logger.setLevel(logging.INFO)
-    logger.addHandler(handler)
-    
-    # 记录一条UTF-8编码的初始化日志
-    logger.info("应用启动成功 - 使用UTF-8编码日志")
-except Exception as e:
-    print(f"配置日志失败: {str(e)}")
-    # 备用方案
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger('social_platform')
+def setup_logging():
+    """创建日志目录并挂载轮转文件处理器（由 create_app 调用）"""
+    try:
+        log_dir.mkdir(exist_ok=True)
+        log_file = log_dir / 'system.log'
+        
+        # 确保新日志使用UTF-8
+        if launcher.multi_process():
+            # 多进程运行时由启动器统一轮转，各进程在文件被移走后重新打开
+            handler = WatchedFileHandler(log_file, encoding='utf-8')
+        else:
+            handler = ArchivingRotatingFileHandler(
+                log_file, 
+                maxBytes=app.config.get('LOG_MAX_BYTES', 10*1024*1024),  # 10 MB
+                encoding='utf-8'  # 关键：强制使用UTF-8编码
+            )
+        
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        
+        # 记录一条UTF-8编码的初始化日志
+        logger.info("应用启动成功 - 使用UTF-8编码日志")
+    except Exception as e:
+        print(f"配置日志失败: {str(e)}")
+        # 备用方案
+        logging.basicConfig(level=logging.INFO)
 
-# 初始化数据库
+# 初始化数据库（create_engine 不会立即连接，建表和迁移见 setup_database）
 engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
 Base = declarative_base()
 db_session = scoped_session(sessionmaker(autocommit=False,
@@ -75,14 +134,157 @@ db_session = scoped_session(sessionmaker(autocommit=False,
                                          bind=engine))
 app.teardown_appcontext(lambda exc: db_session.remove())
 
-# 初始化Socket.IO
-socketio = SocketIO(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'], cors_allowed_origins='*')
+# 多进程运行时由启动器传给工作进程的信息（JSON）
+WORKER_ENV = 'SOCIAL_PLATFORM_WORKER'
+
+def worker_info():
+    """工作进程信息 {index, control, bus, run_dir, address, launcher_pid}，单进程运行时为 None"""
+    raw = os.environ.get(WORKER_ENV)
+    return json.loads(raw) if raw else None
+
+class WorkerBusManager(PubSubManager):
+    """经启动器的 Unix socket 在工作进程间转发 Socket.IO 广播，每行一个JSON消息"""
+
+    name = 'worker-bus'
+
+    def __init__(self, path):
+        super().__init__(channel='social-platform')
+        self.path = path
+        self._sock = None
+        self._lock = None
+
+    def _connect(self):
+        if self._sock is None:
+            from eventlet import greenio
+            from eventlet.semaphore import Semaphore
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self._sock = greenio.GreenSocket(sock)
+            self._lock = Semaphore()
+        return self._sock
+
+    def _publish(self, data):
+        line = (json.dumps(data, separators=(',', ':')) + '\n').encode('utf-8')
+        sock = self._connect()
+        with self._lock:
+            sock.sendall(line)
+
+    def publish_versions(self, keys):
+        """把资源版本号变更通知其他工作进程"""
+        self._publish({'method': 'resource_versions', 'keys': list(keys), 'host_id': self.host_id})
+
+    def publish_user_invalidation(self, user_id):
+        """通知其他工作进程清除用户缓存（资料、角色修改或删除用户）"""
+        self._publish({'method': 'user_cache', 'user_id': user_id, 'host_id': self.host_id})
+
+    def _listen(self):
+        with self._connect().makefile('rb') as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                # 不是 Socket.IO 消息，在这里处理掉
+                if data.get('method') == 'resource_versions':
+                    if data.get('host_id') != self.host_id:
+                        resource_versions.bump(*data['keys'], broadcast=False)
+                    continue
+                if data.get('method') == 'user_cache':
+                    if data.get('host_id') != self.host_id:
+                        user_cache.invalidate(data['user_id'], broadcast=False)
+                    continue
+                yield data
+
+# 初始化Socket.IO（多进程运行时广播经启动器转发到其他工作进程）
+_worker = worker_info()
+socketio = SocketIO(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'], cors_allowed_origins='*',
+                    **({'client_manager': WorkerBusManager(_worker['bus'])} if _worker else {}))
 
 # 初始化登录管理
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# 阻塞IO执行层
+class BlockingIOExecutor:
+    """把 sqlite3 / 文件 IO 交给有界原生线程池执行，避免阻塞 eventlet hub
+
+    eventlet 模式下使用 eventlet.tpool，调用方协程在等待结果时让出控制权；
+    其他异步模式下请求本身已运行在线程中，直接调用即可。
+    """
+
+    def __init__(self, async_mode, size):
+        self.size = size
+        self._tpool = None
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+        if async_mode == 'eventlet':
+            try:
+                from eventlet import tpool
+                tpool.set_num_threads(size)
+                tpool.QUIET = True  # 异常由调用方处理，不重复打印
+                self._tpool = tpool
+            except ImportError:
+                self._tpool = None
+
+    def _invoke(self, submitted, fn, args, kwargs):
+        started = time.monotonic()
+        wait = started - submitted
+        with self._lock:
+            self.waiting -= 1
+            self.active += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.total_run += time.monotonic() - started
+
+    def run(self, fn, *args, **kwargs):
+        """在线程池中执行 fn 并返回结果，异常原样抛出"""
+        with self._lock:
+            self.waiting += 1
+        submitted = time.monotonic()
+        if self._tpool is None:
+            return self._invoke(submitted, fn, args, kwargs)
+        # 带上调用方的 contextvars（如当前请求的SQL统计）
+        ctx = contextvars.copy_context()
+        return self._tpool.execute(ctx.run, self._invoke, submitted, fn, args, kwargs)
+
+    def stats(self):
+        """队列深度与等待时间统计"""
+        with self._lock:
+            completed = self.completed or 1
+            return {
+                'mode': 'tpool' if self._tpool else 'inline',
+                'pool_size': self.size,
+                'queue_depth': self.waiting,
+                'active': self.active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait_ms': round(self.total_wait / completed * 1000, 3),
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'avg_run_ms': round(self.total_run / completed * 1000, 3)
+            }
+
+io_executor = BlockingIOExecutor(app.config['SOCKETIO_ASYNC_MODE'],
+                                 app.config.get('IO_THREADPOOL_SIZE', 10))
+
 # 模型定义
 class User(UserMixin, Base):
     __tablename__ = 'users'
@@ -90,11 +292,17 @@ class User(UserMixin, Base):
     id = Column(Integer, primary_key=True)
     username = Column(String(64), unique=True, index=True)
     password_hash = Column(String(128))
-    nickname = Column(String(64), default='')
+    nickname = Column(String(64), default='', index=True)
     color = Column(String(7), default='#000000')
     badge = Column(String(32), default='')
     last_seen = Column(DateTime, default=datetime.utcnow)
     role = Column(String(20), default='user')  # 新增权限字段：user, admin
+
+    # 管理后台用户列表的排序 + 游标分页索引
+    __table_args__ = (
+        Index('ix_users_last_seen_id', 'last_seen', 'id'),
+        Index('ix_users_role_id', 'role', 'id'),
+    )
     
     def is_admin(self):
         """检查用户是否为管理员"""
@@ -127,6 +335,42 @@ class ChatMessage(Base):
     user = relationship('User', backref='chat_messages')
     room = relationship('ChatRoom', backref='messages')
 
+    # 按房间增量同步
+    __table_args__ = (
+        Index('ix_chat_messages_room_id_id', 'room_id', 'id'),
+    )
+
+class ChatMessageTombstone(Base):
+    """被删除的聊天消息，客户端增量同步时据此移除本地缓存"""
+    __tablename__ = 'chat_message_tombstones'
+    # 自增ID用作同步游标，不能复用
+    __table_args__ = (
+        Index('ix_chat_message_tombstones_room_id_id', 'room_id', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer)
+    room_id = Column(Integer)
+    deleted_at = Column(DateTime, default=datetime.utcnow)
+
+class ChatReadMarker(Base):
+    """用户在聊天室中的已读位置，只在用户阅读或发送时写入
+
+    未读数不单独存储，读取时按 (room_id, id) 索引统计 last_read_id 之后的消息数，
+    发送消息不需要更新其他用户的记录。
+    """
+    __tablename__ = 'chat_read_markers'
+    # 主键服务于房间列表的按用户查询，room_id 索引服务于删除聊天室
+    __table_args__ = (
+        Index('ix_chat_read_markers_room_id', 'room_id'),
+    )
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    room_id = Column(Integer, ForeignKey('chat_rooms.id'), primary_key=True)
+    last_read_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 class ForumSection(Base):
     __tablename__ = 'forum_sections'
     
@@ -159,9 +403,6 @@ class ForumReply(Base):
     
     user = relationship('User', backref='forum_replies')
 
-# 创建表
-Base.metadata.create_all(bind=engine)
-
 # 检查并更新数据库结构
 def update_database_schema():
     """检查并更新数据库结构，添加缺失的列"""
@@ -178,15 +419,27 @@ def update_database_schema():
             cursor.execute("ALTER TABLE users ADD COLUMN role VARCHAR(20) DEFAULT 'user';")
             conn.commit()
             logger.info("已添加role列到users表")
-        
+
+        # 已有数据库补建用户列表的搜索和排序索引
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_users_nickname ON users (nickname);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_users_last_seen_id ON users (last_seen, id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_users_role_id ON users (role, id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_chat_messages_room_id_id ON chat_messages (room_id, id);")
+        conn.commit()
+
+        # 小数据库交给后台维护任务切换到 incremental vacuum 模式，大库需管理员显式请求整库 VACUUM
+        cursor.execute("PRAGMA auto_vacuum;")
+        auto_vacuum = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_count;")
+        page_count = cursor.fetchone()[0]
         conn.close()
+        if auto_vacuum != 2 and page_count < 1000:
+            db_maintenance.request_run(full_vacuum=True)
+
         logger.info("数据库结构更新完成")
     except Exception as e:
         logger.error(f"数据库结构更新失败: {str(e)}")
 
-# 应用启动时更新数据库结构
-update_database_schema()
-
 # 确保admin用户是管理员
 def ensure_admin_user():
     """确保admin用户是管理员角色"""
@@ -213,23 +466,156 @@ def ensure_admin_user():
     except Exception as e:
         logger.error(f"设置管理员用户失败: {str(e)}")
 
-# 应用启动时确保admin用户是管理员
-ensure_admin_user()
+# 用户缓存
+class UserCache:
+    """已认证用户缓存
+
+    缓存的是与会话分离的 User 快照，HTTP 请求中通过 merge(load=False)
+    挂回当前会话，不产生查询；Socket 连接在建立时绑定快照，后续事件直接使用。
+    资料、角色、密码修改或删除用户时须调用 invalidate()，多进程运行时经工作进程总线
+    同步清除其他进程的缓存和Socket快照。
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # user_id -> (过期时间, 快照)
+        self._sockets = {}  # sid -> 快照
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def snapshot(user):
+        """复制一个与会话无关的 User 对象"""
+        copy = User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
+        make_transient_to_detached(copy)
+        return copy
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(user_id, None)
+            self.misses += 1
+            return None
+
+    def put(self, user):
+        return self._store(self.snapshot(user))
+
+    def _store(self, snapshot):
+        with self._lock:
+            self._entries[snapshot.id] = (time.monotonic() + self.ttl, snapshot)
+        return snapshot
+
+    def _fetch(self, user_id):
+        """查询用户并返回快照（在IO线程池中执行）"""
+        user = db_session.get(User, user_id)
+        return self.snapshot(user) if user is not None else None
+
+    def load(self, user_id):
+        """返回用户快照，未命中时查询数据库"""
+        snapshot = self.get(user_id)
+        if snapshot is None:
+            user = db_session.get(User, user_id)
+            if user is None:
+                return None
+            snapshot = self.put(user)
+        return snapshot
+
+    def invalidate(self, user_id, broadcast=True):
+        """清除用户缓存及其Socket连接快照（须在事件循环中调用）"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            for sid in [sid for sid, user in self._sockets.items() if user.id == user_id]:
+                del self._sockets[sid]
+        if broadcast and isinstance(socketio.server.manager, WorkerBusManager):
+            try:
+                socketio.server.manager.publish_user_invalidation(user_id)
+            except OSError as e:
+                logger.warning(f"广播用户缓存失效失败: {str(e)}")
+
+    def bind_socket(self, sid, user_id):
+        """绑定Socket连接的用户快照，未命中时在IO线程池中查询，不阻塞事件循环"""
+        snapshot = self.get(user_id)
+        if snapshot is None:
+            snapshot = run_db_task(self._fetch, user_id)
+            if snapshot is None:
+                return None
+            self._store(snapshot)
+        with self._lock:
+            self._sockets[sid] = snapshot
+        return snapshot
+
+    def unbind_socket(self, sid):
+        with self._lock:
+            self._sockets.pop(sid, None)
+
+    def socket_user(self, sid):
+        with self._lock:
+            return self._sockets.get(sid)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sockets.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached_users': len(self._entries),
+                'socket_snapshots': len(self._sockets),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+user_cache = UserCache(app.config.get('USER_CACHE_TTL', 60))
 
 # 用户加载函数
 @login_manager.user_loader
 def load_user(user_id):
-    return db_session.query(User).get(int(user_id))
+    snapshot = user_cache.load(int(user_id))
+    if snapshot is None:
+        return None
+    # 挂回当前会话，后续修改仍可正常提交
+    return db_session.merge(snapshot, load=False)
+
+def session_user_id():
+    """会话中已登录的用户ID，不经过 current_user，因此不会在事件循环中查询用户"""
+    user_id = session.get('_user_id')
+    return int(user_id) if user_id is not None else None
+
+def get_socket_user():
+    """当前Socket连接的用户快照，未认证时返回 None"""
+    user = user_cache.socket_user(request.sid)
+    if user is None:
+        user_id = session_user_id()
+        if user_id is not None:
+            user = user_cache.bind_socket(request.sid, user_id)
+    return user
+
+def lazy_context_value(fn):
+    """模板上下文的惰性值：模板读取时才调用 fn，同一次渲染中只计算一次"""
+    cached = []
+
+    def get():
+        if not cached:
+            cached.append(fn())
+        return cached[0]
+    return LocalProxy(get)
+
 @app.context_processor
 def inject_app_info():
-    """将应用信息注入到所有模板中"""
+    """将应用信息注入到所有模板中（配置项请直接使用 Flask 提供的 config）"""
     return {
-        'app_info': {
+        'app_info': lazy_context_value(lambda: {
             'debug': app.debug,
-            'name': app.name,
-            'config': app.config
-        }
+            'name': app.name
+        })
     }
+
 # 表单定义
 class LoginForm(FlaskForm):
     username = StringField('用户名', validators=[
@@ -286,6 +672,301 @@ def sanitize_content(content):
     
     return content
 
+# 用户活动时间
+class ActivityTracker:
+    """合并写入的用户活动时间
+
+    last_seen 先记录在内存中，后台任务每隔 ACTIVITY_FLUSH_INTERVAL 秒
+    用一次批量 UPDATE 写回数据库；读取在线状态时需合并尚未写回的值。
+    多进程运行时只能合并本进程的待写回值，其他进程的活动最多延迟一个写回间隔可见。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}  # user_id -> 最后活动时间
+        self._flushing = {}  # 正在写回的批次，写回完成前仍对读取可见
+        self._lock = threading.Lock()
+        self.started = False
+        self.flush_count = 0
+        self.flushed_rows = 0
+
+    def touch(self, user_id):
+        """记录一次用户活动"""
+        with self._lock:
+            self._pending[user_id] = datetime.utcnow()
+        self.start()
+
+    def pending(self, since=None):
+        """尚未写回数据库的活动时间，可按时间过滤"""
+        with self._lock:
+            merged = dict(self._flushing)
+            merged.update(self._pending)
+        if since is not None:
+            merged = {user_id: ts for user_id, ts in merged.items() if ts >= since}
+        return merged
+
+    @staticmethod
+    def _write(batch):
+        table = User.__table__
+        db_session.execute(
+            table.update().where(table.c.id == bindparam('user_id')).values(last_seen=bindparam('ts')),
+            [{'user_id': user_id, 'ts': ts} for user_id, ts in batch.items()]
+        )
+        db_session.commit()
+
+    def flush(self):
+        """把内存中的活动时间批量写回数据库"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+        if not batch:
+            return 0
+
+        try:
+            run_db_task(self._write, batch)
+            self.flush_count += 1
+            self.flushed_rows += len(batch)
+            return len(batch)
+        except Exception as e:
+            # 写回失败时放回队列，保留较新的值
+            with self._lock:
+                for user_id, ts in batch.items():
+                    if self._pending.get(user_id, ts) <= ts:
+                        self._pending[user_id] = ts
+            logger.error(f"写回用户活动时间失败: {str(e)}")
+            return 0
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    def _worker(self):
+        while True:
+            socketio.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        """启动后台写回任务"""
+        if self.started:
+            return
+        self.started = True
+        socketio.start_background_task(self._worker)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'flush_count': self.flush_count,
+            'flushed_rows': self.flushed_rows
+        }
+
+activity_tracker = ActivityTracker(app.config.get('ACTIVITY_FLUSH_INTERVAL', 5))
+
+def id_chunks(ids, size=None):
+    """把ID列表切成小块，避免 IN (...) 超过 SQLite 绑定变量数上限"""
+    ids = list(ids)
+    size = size or app.config.get('SQL_IN_CHUNK_SIZE', 500)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+# 统计计数
+class StatsCounters:
+    """管理面板统计计数器
+
+    写入路径增量更新总数、各聊天室消息数和各分区帖子数，并按分钟记录消息速率；
+    批量删除等难以精确增量的操作调用 request_reconcile()，
+    后台任务定期用真实表数据校准。多进程运行时计数器不经总线同步：总数在各进程
+    校准后一致，消息速率只统计本进程处理的写入，snapshot() 中的 worker 标明来源。
+    """
+
+    TOTALS = ('users', 'chat_messages', 'forum_threads', 'forum_replies')
+
+    def __init__(self, reconcile_interval, series_minutes):
+        self.reconcile_interval = reconcile_interval
+        self.series_minutes = series_minutes
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.started = False
+        self.reconcile_requested = False
+        self.last_reconcile = None
+        self.totals = dict.fromkeys(self.TOTALS, 0)
+        self.room_messages = {}  # room_id -> 消息数
+        self.section_threads = {}  # section_id -> 主题数
+        self.section_replies = {}  # section_id -> 回复数
+        self.series = {'chat_messages': deque(), 'forum_posts': deque()}  # [分钟, 数量]
+
+    def _bump_series(self, name, amount):
+        minute = int(time.time() // 60)
+        buckets = self.series[name]
+        if buckets and buckets[-1][0] == minute:
+            buckets[-1][1] += amount
+        else:
+            buckets.append([minute, amount])
+        while buckets and buckets[0][0] <= minute - self.series_minutes:
+            buckets.popleft()
+
+    def incr(self, name, amount=1, room_id=None, section_id=None):
+        """增量更新计数，新增记录时同时计入速率序列"""
+        with self._lock:
+            self.totals[name] += amount
+            if room_id is not None:
+                room_id = int(room_id) if str(room_id).isdigit() else room_id
+                self.room_messages[room_id] = self.room_messages.get(room_id, 0) + amount
+            if section_id is not None:
+                target = self.section_threads if name == 'forum_threads' else self.section_replies
+                target[section_id] = target.get(section_id, 0) + amount
+            if amount > 0:
+                if name == 'chat_messages':
+                    self._bump_series('chat_messages', amount)
+                elif name in ('forum_threads', 'forum_replies'):
+                    self._bump_series('forum_posts', amount)
+
+    def discard_room(self, room_id):
+        with self._lock:
+            self.room_messages.pop(room_id, None)
+
+    def request_reconcile(self):
+        """请求后台尽快用真实表数据校准"""
+        self.reconcile_requested = True
+        self.start()
+
+    @staticmethod
+    def _count_all():
+        return {
+            'totals': {
+                'users': db_session.query(func.count(User.id)).scalar(),
+                'chat_messages': db_session.query(func.count(ChatMessage.id)).scalar(),
+                'forum_threads': db_session.query(func.count(ForumThread.id)).scalar(),
+                'forum_replies': db_session.query(func.count(ForumReply.id)).scalar()
+            },
+            'room_messages': dict(db_session.query(ChatMessage.room_id, func.count(ChatMessage.id))
+                                  .group_by(ChatMessage.room_id).all()),
+            'section_threads': dict(db_session.query(ForumThread.section_id, func.count(ForumThread.id))
+                                    .group_by(ForumThread.section_id).all()),
+            'section_replies': dict(db_session.query(ForumThread.section_id, func.count(ForumReply.id))
+                                    .join(ForumReply, ForumReply.thread_id == ForumThread.id)
+                                    .group_by(ForumThread.section_id).all())
+        }
+
+    def reconcile(self):
+        """重新统计真实表数据，修正累计误差"""
+        self.reconcile_requested = False
+        counts = run_db_task(self._count_all)
+        with self._lock:
+            drift = {name: self.totals[name] - counts['totals'][name] for name in self.TOTALS}
+            self.totals = counts['totals']
+            self.room_messages = counts['room_messages']
+            self.section_threads = counts['section_threads']
+            self.section_replies = counts['section_replies']
+            self.loaded = True
+            self.last_reconcile = datetime.now()
+        if self.started and any(drift.values()):
+            logger.info(f"统计计数已校准，偏差: {drift}")
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.reconcile()
+        self.start()
+
+    def _worker(self):
+        waited = 0
+        while True:
+            socketio.sleep(1)
+            waited += 1
+            if self.reconcile_requested or waited >= self.reconcile_interval:
+                waited = 0
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    logger.error(f"统计计数校准失败: {str(e)}")
+
+    def start(self):
+        """启动后台校准任务"""
+        if self.started:
+            return
+        self.started = True
+        socketio.start_background_task(self._worker)
+
+    def snapshot(self):
+        """当前计数与速率序列（缺失的分钟补零）"""
+        now_minute = int(time.time() // 60)
+        with self._lock:
+            series = {}
+            for name, buckets in self.series.items():
+                values = dict((minute, count) for minute, count in buckets)
+                series[name] = [values.get(minute, 0)
+                                for minute in range(now_minute - self.series_minutes + 1, now_minute + 1)]
+            return {
+                'totals': dict(self.totals),
+                'room_messages': dict(self.room_messages),
+                'section_threads': dict(self.section_threads),
+                'section_replies': dict(self.section_replies),
+                'series': series,
+                'series_start': datetime.fromtimestamp((now_minute - self.series_minutes + 1) * 60).isoformat(),
+                'last_reconcile': self.last_reconcile.isoformat() if self.last_reconcile else None,
+                'worker': (worker_info() or {}).get('index')
+            }
+
+stats_counters = StatsCounters(app.config.get('STATS_RECONCILE_INTERVAL', 600),
+                               app.config.get('STATS_SERIES_MINUTES', 60))
+
+# 条件请求
+class ResourceVersions:
+    """轮询接口的资源版本号
+
+    写入路径调用 bump()，接口由版本号生成 ETag、由最后变更时间生成 Last-Modified，
+    判断 304 时既不查询数据库也不序列化。ETag 带进程纪元，进程重启后旧 ETag 自然失效；
+    多进程运行时 bump 经工作进程总线同步到其他进程。总线 socket 属于事件循环，
+    需要广播的 bump 不能在 IO 线程池中调用，run_db_task 的调用方在任务返回后再 bump。
+    """
+
+    def __init__(self):
+        self.epoch = os.urandom(4).hex()
+        self.started_at = datetime.utcnow()
+        self._versions = {}  # key -> (版本号, 最后修改时间)
+        self._lock = threading.Lock()
+
+    def bump(self, *keys, broadcast=True):
+        now = datetime.utcnow()
+        with self._lock:
+            for key in keys:
+                version = self._versions.get(key, (0, None))[0]
+                self._versions[key] = (version + 1, now)
+        if broadcast and isinstance(socketio.server.manager, WorkerBusManager):
+            try:
+                socketio.server.manager.publish_versions(keys)
+            except OSError as e:
+                logger.warning(f"广播资源版本失败: {str(e)}")
+
+    def versions(self, prefix):
+        """以 prefix 开头的键的当前版本号 {键的其余部分: 版本号}"""
+        with self._lock:
+            return {key[len(prefix):]: version for key, (version, _) in self._versions.items()
+                    if key.startswith(prefix)}
+
+    def validators(self, *keys):
+        """返回 (ETag, Last-Modified)"""
+        with self._lock:
+            entries = [self._versions.get(key, (0, self.started_at)) for key in keys]
+        etag = '-'.join([self.epoch] + [str(version) for version, _ in entries])
+        return etag, max(modified for _, modified in entries)
+
+resource_versions = ResourceVersions()
+
+def not_modified_response(etag, last_modified):
+    """请求携带的验证器仍然有效时返回 304 响应，否则返回 None"""
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return with_validators(app.response_class(status=304), etag, last_modified)
+
+def with_validators(response, etag, last_modified):
+    """设置 ETag / Last-Modified，要求客户端每次使用缓存前重新验证"""
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 def get_online_users(room_id):
     """获取指定房间的在线用户"""
     # 获取最近5分钟有活动的用户
@@ -293,8 +974,13 @@ def get_online_users(room_id):
     cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
     
     # 实际上Flask-SocketIO没有内置的房间在线用户列表，我们需要自己维护
-    # 这里简化处理，返回最近活动的用户
+    # 这里简化处理，返回最近活动的用户（包括尚未写回数据库的活动）
+    pending = activity_tracker.pending(since=cutoff_time)
     recent_users = db_session.query(User).filter(User.last_seen >= cutoff_time).all()
+    # 活动尚未写回的用户分块补查（重连高峰时可能有很多）
+    missing = set(pending) - {user.id for user in recent_users}
+    for chunk in id_chunks(missing):
+        recent_users.extend(db_session.query(User).filter(User.id.in_(chunk)).all())
     
     online_users = []
     for user in recent_users:
@@ -308,63 +994,2512 @@ def get_online_users(room_id):
     
     return online_users
 
-def get_recent_logs(limit=10):
-    """获取最近的系统日志"""
-    logs = []
-    log_file = Path(app.root_path) / 'logs' / 'system.log'
-    
-    if log_file.exists():
-        with open(log_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()[-limit:]
-            for line in lines:
+def count_online_users():
+    """统计最近有活动的用户数"""
+    from datetime import datetime, timedelta
+    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
+
+    # 合并尚未写回数据库的活动时间
+    pending = activity_tracker.pending(since=cutoff_time)
+    count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
+    # 数据库中已算作在线的待写回用户不重复计数，分块查询
+    for chunk in id_chunks(pending):
+        count -= db_session.query(User).filter(User.last_seen >= cutoff_time, User.id.in_(chunk)).count()
+    return count + len(pending)
+
+class OnlineCountCache:
+    """全局在线人数缓存，每个进程最多每 ttl 秒查询一次，数值变化时递增 'online' 版本"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.count = None
+        self.expires = 0
+        self._lock = threading.Lock()
+
+    def peek(self):
+        """缓存未过期时返回人数，否则返回 None（不查询）"""
+        with self._lock:
+            if self.count is not None and time.monotonic() < self.expires:
+                return self.count
+        return None
+
+    def get(self):
+        count = self.peek()
+        if count is not None:
+            return count
+        count = count_online_users()
+        with self._lock:
+            changed = count != self.count
+            self.count = count
+            self.expires = time.monotonic() + self.ttl
+        if changed:
+            # 各进程的待写回活动不同，计数只在本进程内有效，不广播
+            resource_versions.bump('online', broadcast=False)
+        return count
+
+online_count_cache = OnlineCountCache(app.config.get('ONLINE_COUNT_CACHE_TTL', 5))
+
+# 管理后台用户列表：可排序的列及默认方向
+USER_SORT_COLUMNS = {
+    'id': (User.id, False),
+    'last_seen': (User.last_seen, True),
+    'role': (User.role, False),
+}
+
+def encode_user_cursor(value, user_id):
+    """把最后一行的 (排序值, ID) 编码为不透明游标"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, user_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_user_cursor(cursor, sort):
+    """解析游标，格式不对时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, user_id = json.loads(raw)
+        user_id = int(user_id)
+    except Exception:
+        raise ValueError("无效的游标")
+    if sort == 'last_seen' and value is not None:
+        value = datetime.fromisoformat(value)
+    return value, user_id
+
+def keyset_after(column, value, user_id, descending):
+    """(column, id) 严格位于游标之后的条件
+
+    SQLite 升序时 NULL 排在最前，降序时排在最后。
+    """
+    if descending:
+        if value is None:
+            return and_(column.is_(None), User.id < user_id)
+        return or_(column < value,
+                   and_(column == value, User.id < user_id),
+                   column.is_(None))
+    if value is None:
+        return or_(and_(column.is_(None), User.id > user_id),
+                   column.isnot(None))
+    return or_(column > value, and_(column == value, User.id > user_id))
+
+def query_user_page(q=None, sort='id', descending=None, cursor=None, limit=50):
+    """按游标分页查询用户，返回 (用户列表, 下一页游标)
+
+    q 按用户名或昵称前缀匹配，用区间比较代替 LIKE 以便使用索引（区分大小写）。
+    """
+    column, default_descending = USER_SORT_COLUMNS[sort]
+    if descending is None:
+        descending = default_descending
+
+    query = db_session.query(User)
+    if q:
+        upper = q + '\U0010ffff'
+        query = query.filter(or_(
+            and_(User.username >= q, User.username < upper),
+            and_(User.nickname >= q, User.nickname < upper)
+        ))
+    if cursor:
+        value, user_id = decode_user_cursor(cursor, sort)
+        query = query.filter(keyset_after(column, value, user_id, descending))
+
+    if column is User.id:
+        order = [User.id.desc() if descending else User.id]
+    elif descending:
+        order = [column.desc(), User.id.desc()]
+    else:
+        order = [column, User.id]
+    users = query.order_by(*order).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        last = users[-1]
+        next_cursor = encode_user_cursor(getattr(last, column.key), last.id)
+    return users, next_cursor
+
+def parse_room_id(value):
+    """把客户端传入的聊天室ID转成整数，非法时返回 None"""
+    try:
+        room_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return room_id if room_id > 0 else None
+
+def chat_room_exists(room_id):
+    return db_session.query(ChatRoom.id).filter(ChatRoom.id == room_id).first() is not None
+
+def save_chat_message(user_id, room_id, content):
+    """保存聊天消息，返回 (消息ID, 时间戳)
+
+    可能在IO线程池中执行，由调用方回到事件循环后 bump 房间版本号。
+    """
+    message = ChatMessage(
+        content=content,  # 存储原始Markdown
+        user_id=user_id,
+        room_id=room_id
+    )
+    db_session.add(message)
+    db_session.flush()
+    # 提交前取值，避免提交后过期属性再次查询
+    result = (message.id, message.timestamp)
+    # 发送者读到自己的消息
+    upsert_read_marker(user_id, room_id, message.id)
+    db_session.commit()
+    stats_counters.incr('chat_messages', room_id=room_id)
+    return result
+
+def upsert_read_marker(user_id, room_id, last_read_id):
+    """写入已读位置，已有记录只向前推进"""
+    stmt = sqlite_insert(ChatReadMarker).values(user_id=user_id, room_id=room_id, last_read_id=last_read_id,
+                                                updated_at=datetime.utcnow())
+    db_session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'room_id'],
+        set_={'last_read_id': stmt.excluded.last_read_id,
+              'updated_at': stmt.excluded.updated_at},
+        where=ChatReadMarker.last_read_id < stmt.excluded.last_read_id
+    ))
+
+def unread_count_query(room_id, last_read_id):
+    """room_id 中 last_read_id 之后的消息数，最多数到 CHAT_UNREAD_CAP 条"""
+    newer = select(ChatMessage.id).where(ChatMessage.room_id == room_id, ChatMessage.id > last_read_id)\
+        .limit(app.config.get('CHAT_UNREAD_CAP', 100)).subquery()
+    return select(func.count()).select_from(newer)
+
+def mark_room_read(user_id, room_id, message_id):
+    """把用户在房间中的已读位置推进到 message_id（不回退），返回未读数；房间不存在时返回 None"""
+    if not chat_room_exists(room_id):
+        return None
+    # 不超过房间当前最新的消息，避免已读位置跑到之后的新消息前面
+    latest = db_session.query(func.max(ChatMessage.id)).filter(ChatMessage.room_id == room_id).scalar() or 0
+    message_id = min(message_id, latest)
+    marker = db_session.get(ChatReadMarker, (user_id, room_id))
+    if marker is None or marker.last_read_id < message_id:
+        upsert_read_marker(user_id, room_id, message_id)
+        db_session.commit()
+    else:
+        message_id = marker.last_read_id
+    return db_session.execute(unread_count_query(room_id, message_id)).scalar()
+
+def room_unread_counts(user_id):
+    """用户各聊天室的未读数 {room_id: 数量}，只包含读过或发过言的房间
+
+    一次主键范围查询取已读位置，再用一条 UNION ALL 语句按 (room_id, id) 索引分别计数，
+    每个房间最多数到 CHAT_UNREAD_CAP 条。没有已读记录的房间不计未读，也不在这里写入记录。
+    """
+    markers = db_session.query(ChatReadMarker.room_id, ChatReadMarker.last_read_id)\
+        .filter(ChatReadMarker.user_id == user_id).all()
+    if not markers:
+        return {}
+    counts = [unread_count_query(room_id, last_read_id).add_columns(literal(room_id))
+              for room_id, last_read_id in markers]
+    return {room_id: count for count, room_id in db_session.execute(union_all(*counts))}
+
+def record_chat_tombstones(query):
+    """为 query 即将批量删除的聊天消息写入墓碑，须在 delete() 之前、同一事务内调用"""
+    rows = query.with_entities(ChatMessage.id, ChatMessage.room_id)
+    db_session.execute(insert(ChatMessageTombstone).from_select(['message_id', 'room_id'], rows))
+
+def chat_message_data(msg):
+    """聊天消息的接口格式（只含原始Markdown）"""
+    return {
+        'id': msg.id,
+        'content': msg.content,  # 原始Markdown内容
+        'timestamp': msg.timestamp.isoformat(),
+        'user_id': msg.user_id,
+        'username': msg.user.username,
+        'nickname': msg.user.nickname or msg.user.username,
+        'color': msg.user.color,
+        'badge': msg.user.badge
+    }
+
+def run_db_task(fn, *args, **kwargs):
+    """在IO线程池中执行数据库操作，只返回普通数据
+
+    线程池中的线程各自持有 scoped_session，任务结束后释放，
+    因此 fn 不能返回绑定到会话的 ORM 对象。
+    """
+    caller = threading.get_ident()
+
+    def task():
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if threading.get_ident() != caller:
+                db_session.remove()
+
+    return io_executor.run(task)
+
+# 日志读取
+LogEntry = namedtuple('LogEntry', ['timestamp', 'level', 'logger', 'message'])
+
+class LogReader:
+    """从文件末尾按块向前读取日志
+
+    依次读取当前日志、尚未压缩的轮转文件和 .gz 归档（按修改时间从新到旧），
+    按级别、时间范围和文本过滤，不把整个文件读入内存。归档按分块压缩，
+    借助 .idx 索引只解压时间范围内的分块。
+    游标为 "inode:偏移量"，偏移量是未压缩数据中的位置；归档记录原文件的 inode，
+    日志轮转改名或压缩后仍能定位到原位置。
+    """
+
+    BLOCK_SIZE = 64 * 1024
+    LINE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (\S+) - (\w+) - (.*)$')
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._index_cache = {}  # 归档路径 -> (修改时间, 索引)
+
+    def files(self):
+        """当前日志及轮转出的文件，从新到旧"""
+        if not self.path.parent.exists():
+            return []
+        prefix = self.path.name + '.'
+        rotated = []
+        with os.scandir(self.path.parent) as it:
+            for entry in it:
+                name = entry.name
+                if not name.startswith(prefix) or name.endswith(('.idx', '.tmp')):
+                    continue
+                # 压缩完成、尚未删除的原文件
+                if not name.endswith('.gz') and os.path.exists(entry.path + '.gz'):
+                    continue
                 try:
-                    # 简化解析
-                    parts = line.split(' ', 3)
-                    if len(parts) >= 4:
-                        timestamp_str = f"{parts[0]} {parts[1]}"
-                        message = parts[3].strip()
-                        # 移除日志级别和模块名
-                        message = message.split(' - ', 2)[-1] if ' - ' in message else message
-                        timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S,%f')
-                        logs.append(type('Log', (), {'timestamp': timestamp, 'message': message})())
-                except Exception as e:
+                    rotated.append((entry.stat().st_mtime, Path(entry.path)))
+                except FileNotFoundError:
                     continue
+        rotated.sort(reverse=True)
+        current = [self.path] if self.path.exists() else []
+        return current + [path for _, path in rotated]
+
+    def archive_index(self, path):
+        """读取归档索引，时间字段转换为 datetime"""
+        index_path = path.with_name(path.name[:-3] + '.idx')
+        mtime = index_path.stat().st_mtime
+        cached = self._index_cache.get(str(path))
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        to_time = lambda value: datetime.fromisoformat(value) if value else None
+        index['members'] = [(to_time(first), to_time(last), offset, length, raw_offset, raw_length)
+                            for first, last, offset, length, raw_offset, raw_length in index['members']]
+        self._index_cache[str(path)] = (mtime, index)
+        return index
+
+    @classmethod
+    def reverse_lines(cls, f, end):
+        """从 end 位置向前逐行读取，产出 (行首偏移, 行内容bytes)"""
+        pos = end
+        buffer = b''
+        while pos > 0:
+            size = min(cls.BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            buffer = f.read(size) + buffer
+            line_end = pos + len(buffer)
+            lines = buffer.split(b'\n')
+            buffer = lines.pop(0)  # 块首可能是不完整的行，留到下一块
+            for line in reversed(lines):
+                line_start = line_end - len(line)
+                if line:
+                    yield line_start, line
+                line_end = line_start - 1
+        if buffer:
+            yield 0, buffer
+
+    def archive_lines(self, f, index, end, since=None, until=None):
+        """倒序读取归档，跳过时间范围外的分块，只解压需要的部分"""
+        for first, last, offset, length, raw_offset, raw_length in reversed(index['members']):
+            if end is not None and raw_offset >= end:
+                continue
+            if since and last and last < since:
+                return
+            if until and first and first > until:
+                continue
+            f.seek(offset)
+            data = gzip.decompress(f.read(length))
+            member_end = raw_length if end is None else min(raw_length, end - raw_offset)
+            for line_offset, line in self.reverse_lines(io.BytesIO(data), member_end):
+                yield raw_offset + line_offset, line
+
+    @classmethod
+    def parse(cls, text):
+        match = cls.LINE_RE.match(text)
+        if not match:
+            return None
+        try:
+            timestamp = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S,%f')
+        except ValueError:
+            return None
+        return LogEntry(timestamp, match.group(3), match.group(2), match.group(4))
+
+    def _inode(self, path):
+        if path.name.endswith('.gz'):
+            return self.archive_index(path)['source_inode']
+        return path.stat().st_ino
+
+    def _start_position(self, files, cursor):
+        """把游标解析为 (文件序号, 结束偏移)"""
+        if not cursor:
+            return 0, None
+        try:
+            inode, offset = (int(part) for part in cursor.split(':', 1))
+        except ValueError:
+            raise ValueError("无效的日志游标")
+        for index, path in enumerate(files):
+            try:
+                if self._inode(path) == inode:
+                    return index, offset
+            except FileNotFoundError:
+                continue
+        return len(files), None  # 游标所在文件已被清理
+
+    def read(self, limit=50, levels=None, since=None, until=None, text=None, cursor=None):
+        """按从新到旧的顺序读取日志，返回 (日志列表, 下一页游标)"""
+        levels = {level.upper() for level in levels} if levels else None
+        text = text.lower() if text else None
+        files = self.files()
+        index, end = self._start_position(files, cursor)
+        entries = []
+        # 多行日志（如异常堆栈）的后续行；一条日志可能被轮转拆到两个文件中，跨文件保留
+        continuation = []
+
+        for path in files[index:]:
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue  # 读取期间被压缩或清理
+
+            with f:
+                if path.name.endswith('.gz'):
+                    try:
+                        archive = self.archive_index(path)
+                    except FileNotFoundError:
+                        continue
+                    inode = archive['source_inode']
+                    members = archive['members']
+                    file_end = end if end is not None else (members[-1][4] + members[-1][5] if members else 0)
+                    lines = self.archive_lines(f, archive, end, since, until)
+                else:
+                    inode = os.fstat(f.fileno()).st_ino
+                    file_end = f.seek(0, os.SEEK_END) if end is None else end
+                    lines = self.reverse_lines(f, file_end)
+
+                for offset, raw in lines:
+                    # 文件末尾没有换行：这一行在轮转时被截断，剩余部分是较新文件的第一行
+                    if continuation and offset + len(raw) == file_end:
+                        raw += continuation.pop().encode('utf-8')
+                    line = raw.decode('utf-8', errors='replace').rstrip('\r')
+                    entry = self.parse(line)
+                    if entry is None:
+                        continuation.append(line)
+                        continue
+
+                    if continuation:
+                        entry = entry._replace(message='\n'.join([entry.message] + continuation[::-1]))
+                        continuation = []
+
+                    # 文件内按时间递增，早于 since 后可直接结束
+                    if since and entry.timestamp < since:
+                        return entries, None
+                    if until and entry.timestamp > until:
+                        continue
+                    if levels and entry.level not in levels:
+                        continue
+                    if text and text not in entry.message.lower():
+                        continue
+
+                    entries.append(entry)
+                    if len(entries) >= limit:
+                        return entries, f"{inode}:{offset}"
+            end = None
+
+        return entries, None
+
+class AuditLogReader(LogReader):
+    """读取 admin.log，支持文本与 JSON 两种格式"""
+
+    LINE_RE = re.compile(r'^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] \[管理员: (.*?)\] (.*)$')
+
+    @classmethod
+    def parse(cls, text):
+        if text.startswith('{'):
+            try:
+                record = json.loads(text)
+                return LogEntry(datetime.strptime(record['timestamp'], '%Y-%m-%d %H:%M:%S'),
+                                'INFO', record['user'], record['action'])
+            except (ValueError, KeyError, TypeError):
+                return None
+        match = cls.LINE_RE.match(text)
+        if not match:
+            return None
+        try:
+            timestamp = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return None
+        return LogEntry(timestamp, 'INFO', match.group(2), match.group(3))
+
+log_reader = LogReader(log_dir / 'system.log')
+audit_log_reader = AuditLogReader(log_dir / 'admin.log')
+
+# 日志归档
+class LogArchiver:
+    """在后台压缩轮转出的日志并维护保留预算
+
+    每个归档由多个独立的 gzip 分块拼接而成（仍可直接 zcat），分块只在日志条目
+    开头处切分；同名 .idx 记录每个分块的时间范围和偏移，读取时按时间定位分块。
+    归档总大小超过 max_bytes 或早于 max_days 时从最旧的开始删除。
+    """
+
+    def __init__(self, readers, block_size, max_bytes, max_days):
+        self.readers = {reader.path.name: reader for reader in readers}
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.max_days = max_days
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.compressed = 0
+        self.removed = 0
+        self.errors = 0
+
+    def rotate(self, path):
+        """把日志改名为轮转文件并排队压缩"""
+        rotated = rotated_log_path(path)
+        os.rename(path, rotated)
+        self.submit(rotated)
+        return rotated
+
+    def submit(self, path):
+        self.start()
+        self._queue.put(Path(path))
+
+    def _reader_for(self, path):
+        base = path.name.split('.', 2)
+        return self.readers.get('.'.join(base[:2]))
+
+    def pending_files(self):
+        """目录中尚未压缩的轮转文件（包括旧版本留下的 .1、.2 备份）"""
+        files = []
+        for reader in self.readers.values():
+            files.extend(path for path in reader.files()
+                         if path != reader.path and not path.name.endswith('.gz'))
+        return files
+
+    def _blocks(self, f, reader):
+        """按 block_size 切分，只在日志条目开头处切，产出 (数据, 首条时间, 末条时间)"""
+        lines = []
+        size = 0
+        first = last = None
+        for line in f:
+            entry = reader.parse(line.decode('utf-8', errors='replace').rstrip('\r\n'))
+            if entry is not None:
+                if size >= self.block_size:
+                    yield b''.join(lines), first, last
+                    lines, size, first = [], 0, None
+                first = first or entry.timestamp
+                last = entry.timestamp
+            lines.append(line)
+            size += len(line)
+        if lines:
+            yield b''.join(lines), first, last
+
+    def compress(self, path):
+        """压缩一个轮转文件，写入归档和索引后删除原文件"""
+        reader = self._reader_for(path)
+        if reader is None or not path.exists():
+            return
+        archive = path.with_name(path.name + '.gz')
+        index_path = path.with_name(path.name + '.idx')
+        tmp_archive = archive.with_name(archive.name + '.tmp')
+        members = []
+        raw_offset = 0
+
+        stat = path.stat()
+        with open(path, 'rb') as src, open(tmp_archive, 'wb') as out:
+            for data, first, last in self._blocks(src, reader):
+                compressed = gzip.compress(data, mtime=0)
+                members.append([first.isoformat() if first else None,
+                                last.isoformat() if last else None,
+                                out.tell(), len(compressed), raw_offset, len(data)])
+                out.write(compressed)
+                raw_offset += len(data)
+
+        index = {
+            'source': path.name,
+            'source_inode': stat.st_ino,
+            'raw_size': raw_offset,
+            'start': next((m[0] for m in members if m[0]), None),
+            'end': next((m[1] for m in reversed(members) if m[1]), None),
+            'members': members
+        }
+        with open(index_path.with_name(index_path.name + '.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(index_path.with_name(index_path.name + '.tmp'), index_path)
+        # 归档的修改时间沿用原文件，读取时按修改时间排序
+        os.utime(tmp_archive, (stat.st_atime, stat.st_mtime))
+        os.replace(tmp_archive, archive)
+        path.unlink()
+        self.compressed += 1
+
+    def archives(self):
+        """全部归档，从旧到新，返回 [(修改时间, 大小, 路径)]"""
+        result = []
+        for reader in self.readers.values():
+            for path in reader.files():
+                if path.name.endswith('.gz'):
+                    try:
+                        stat = path.stat()
+                    except FileNotFoundError:
+                        continue
+                    result.append((stat.st_mtime, stat.st_size, path))
+        result.sort()
+        return result
+
+    def enforce_budget(self):
+        """删除超出大小或时间预算的最旧归档"""
+        archives = self.archives()
+        total = sum(size for _, size, _ in archives)
+        cutoff = time.time() - self.max_days * 86400 if self.max_days else None
+        for mtime, size, path in archives:
+            if total <= self.max_bytes and (cutoff is None or mtime >= cutoff):
+                break
+            path.unlink(missing_ok=True)
+            path.with_name(path.name[:-3] + '.idx').unlink(missing_ok=True)
+            total -= size
+            self.removed += 1
+            logger.info(f"已删除超出保留预算的日志归档: {path.name}")
+
+    def _run(self):
+        for path in self.pending_files():
+            self._queue.put(path)
+        while True:
+            path = self._queue.get()
+            try:
+                self.compress(path)
+                self.enforce_budget()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"压缩日志 {path.name} 失败: {str(e)}")
+
+    def start(self):
+        """启动后台压缩线程，并处理启动前遗留的轮转文件"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-archiver', daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        archives = self.archives()
+        return {
+            'archives': len(archives),
+            'bytes': sum(size for _, size, _ in archives),
+            'queued': self._queue.qsize(),
+            'compressed': self.compressed,
+            'removed': self.removed,
+            'errors': self.errors
+        }
+
+log_archiver = LogArchiver([log_reader, audit_log_reader],
+                           block_size=app.config.get('LOG_ARCHIVE_BLOCK_SIZE', 256 * 1024),
+                           max_bytes=app.config.get('LOG_ARCHIVE_MAX_BYTES', 200 * 1024 * 1024),
+                           max_days=app.config.get('LOG_ARCHIVE_MAX_DAYS', 30))
+ArchivingRotatingFileHandler.archiver = log_archiver
+
+def get_recent_logs(limit=10):
+    """获取最近的系统日志（按时间升序）"""
+    logs, _ = io_executor.run(log_reader.read, limit=limit)
+    logs.reverse()
     
     # 如果没有日志文件，创建一些模拟数据
     if not logs:
         for i in range(limit):
-            logs.append(type('Log', (), {
-                'timestamp': datetime.now(),
-                'message': f"系统启动正常 - 模拟日志条目 {i+1}"
-            })())
+            logs.append(LogEntry(datetime.now(), 'INFO', 'social_platform',
+                                 f"系统启动正常 - 模拟日志条目 {i+1}"))
     
-    return logs[:limit]
+    return logs
 
-def log_admin_action(action):
-    """记录管理员操作 - 安全版本"""
-    try:
-        log_dir = Path(app.root_path) / 'logs'
-        log_dir.mkdir(exist_ok=True)
-        log_file = log_dir / 'admin.log'
-        
-        with open(log_file, 'a', encoding='utf-8') as f:
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            # 安全检查：确保用户已认证
-            if current_user and hasattr(current_user, 'is_authenticated') and current_user.is_authenticated:
-                username = current_user.username
+# 管理员操作日志
+class AuditLogger:
+    """队列化的管理员操作日志
+
+    调用方只把记录放入队列；后台线程保持 admin.log 打开，
+    攒批写入后统一 flush，超过 max_bytes 时轮转并交给 archiver 压缩。
+    max_bytes 为 0 时不自行轮转（多进程运行时由启动器轮转），文件被移走后重新打开。
+    进程退出时 close() 会写完队列中的全部记录。队列满（写入线程停止或跟不上）时
+    调用方直接同步追加写入，不丢记录，也不无限期阻塞。
+    """
+
+    BATCH_SIZE = 200
+
+    def __init__(self, path, fmt='text', flush_interval=1.0, max_queue=10000, mirror_to_system=False,
+                 max_bytes=0, archiver=None):
+        self.path = Path(path)
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.archiver = archiver
+        self.flush_interval = flush_interval
+        self.mirror_to_system = mirror_to_system
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.overflowed = 0
+
+    def format(self, record):
+        if self.fmt == 'json':
+            return json.dumps(record, ensure_ascii=False) + '\n'
+        return f"[{record['timestamp']}] [管理员: {record['user']}] {record['action']}\n"
+
+    def log(self, user, action):
+        """放入队列，队列满时同步写入"""
+        record = {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'user': user,
+            'action': action
+        }
+        if self._closed:
+            self._write_batch([record])
+            return
+        self.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.overflowed += 1
+            if self.overflowed == 1 or self.overflowed % 1000 == 0:
+                logger.warning(f"管理员操作日志队列已满，已有 {self.overflowed} 条记录改为同步写入")
+            self._write_batch([record])
+
+    def _write_batch(self, batch, f=None):
+        try:
+            if f is None:
+                self.path.parent.mkdir(exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as out:
+                    out.writelines(self.format(record) for record in batch)
             else:
-                username = 'system'  # 系统操作
-            f.write(f"[{timestamp}] [管理员: {username}] {action}\n")
-        
-        # 同时记录到系统日志
-        logger.info(f"管理员操作: {action}")
-    except Exception as e:
-        # 避免在错误处理中再次出错
+                f.writelines(self.format(record) for record in batch)
+                f.flush()
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"写入管理员操作日志失败: {str(e)}")
+
+        if self.mirror_to_system:
+            for record in batch:
+                logger.info(f"管理员操作: {record['action']}")
+
+    def _reopen_if_moved(self, f):
+        """admin.log 被其他进程轮转走后重新打开"""
+        try:
+            if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+        return open(self.path, 'a', encoding='utf-8')
+
+    def _rotate(self, f):
+        """admin.log 超过 max_bytes 时轮转，交给 archiver 压缩"""
+        if not self.max_bytes or os.fstat(f.fileno()).st_size < self.max_bytes:
+            return f
+        f.close()
+        try:
+            if self.archiver is not None:
+                self.archiver.rotate(self.path)
+            else:
+                os.rename(self.path, rotated_log_path(self.path))
+        except Exception as e:
+            logger.error(f"轮转管理员操作日志失败: {str(e)}")
+        return open(self.path, 'a', encoding='utf-8')
+
+    def _run(self):
+        self.path.parent.mkdir(exist_ok=True)
+        f = open(self.path, 'a', encoding='utf-8')
+        try:
+            stop = False
+            while not stop:
+                try:
+                    record = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+                if record is None:
+                    break
+
+                # 攒批：取出队列中已有的记录，一次写入
+                batch = [record]
+                while len(batch) < self.BATCH_SIZE:
+                    try:
+                        record = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        stop = True
+                        break
+                    batch.append(record)
+                if not self.max_bytes:
+                    f = self._reopen_if_moved(f)
+                self._write_batch(batch, f)
+                f = self._rotate(f)
+        finally:
+            f.close()
+
+    def start(self):
+        """启动后台写入线程（原生线程，不占用 eventlet hub）"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='audit-logger', daemon=True)
+                self._thread.start()
+
+    def close(self, timeout=10):
+        """停止写入线程并写完队列中的剩余记录"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            try:
+                self._queue.put(None, timeout=timeout)
+                self._thread.join(timeout)
+            except queue.Full:
+                logger.error("管理员操作日志写入线程未响应，直接写入剩余记录")
+
+        # 写入线程未处理的记录，以及检查 _closed 之后才入队的记录，直接写入
+        remaining = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not None:
+                remaining.append(record)
+        if remaining:
+            self._write_batch(remaining)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'errors': self.errors,
+            'overflowed': self.overflowed
+        }
+
+audit_logger = AuditLogger(
+    log_dir / 'admin.log',
+    fmt=app.config.get('AUDIT_LOG_FORMAT', 'text'),
+    flush_interval=app.config.get('AUDIT_LOG_FLUSH_INTERVAL', 1.0),
+    mirror_to_system=app.config.get('AUDIT_LOG_MIRROR_SYSTEM', False),
+    max_bytes=app.config.get('AUDIT_LOG_MAX_BYTES', 10 * 1024 * 1024),
+    archiver=log_archiver
+)
+atexit.register(audit_logger.close)
+
+def log_admin_action(action):
+    """记录管理员操作 - 安全版本"""
+    try:
+        # 安全检查：确保用户已认证
+        if current_user and hasattr(current_user, 'is_authenticated') and current_user.is_authenticated:
+            username = current_user.username
+        else:
+            username = 'system'  # 系统操作
+
+        # 只入队，由后台线程批量写入
+        audit_logger.log(username, action)
+    except Exception as e:
+        # 避免在错误处理中再次出错
         try:
             logger.error(f"记录管理员操作失败: {str(e)}")
         except Exception as e2:
             print(f"记录管理员操作失败(二次错误): {str(e2)}")
 
+# 数据库后台维护
+class DatabaseMaintenance:
+    """数据库后台维护：分步 incremental_vacuum、定期 ANALYZE / PRAGMA optimize
+
+    在后台任务中运行，写入繁忙时自动暂停；每一步 sqlite 调用都放到 IO 线程池执行，
+    避免 VACUUM / ANALYZE 占住事件循环、阻塞聊天。
+    """
+
+    AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._write_times = deque(maxlen=10000)
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self.started = False
+        self.running = False
+        self.paused = False
+        self.run_requested = False
+        self.full_vacuum_requested = False
+        self.last_vacuum = None
+        self.last_optimize = None
+        self.last_analyze = None
+        self.last_error = None
+        self.pages_reclaimed = 0
+
+    def record_write(self):
+        """记录一次写语句，用于判断当前写入压力"""
+        self._write_times.append(time.monotonic())
+
+    def write_rate(self, window=5):
+        """最近 window 秒内每秒的写语句数"""
+        cutoff = time.monotonic() - window
+        with self._lock:
+            while self._write_times and self._write_times[0] < cutoff:
+                self._write_times.popleft()
+            return len(self._write_times) / window
+
+    def is_busy(self):
+        return self.write_rate() > self.app.config.get('DB_WRITE_BUSY_THRESHOLD', 20)
+
+    @property
+    def db_path(self):
+        return self.app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _pragmas(self, *names):
+        conn = self._connect()
+        try:
+            return [conn.execute(f"PRAGMA {name}").fetchone()[0] for name in names]
+        finally:
+            conn.close()
+
+    def report(self):
+        """空闲页与碎片统计"""
+        page_size, page_count, freelist_count, auto_vacuum = io_executor.run(
+            self._pragmas, 'page_size', 'page_count', 'freelist_count', 'auto_vacuum')
+
+        def fmt(value):
+            return datetime.fromtimestamp(value).isoformat() if value else None
+
+        return {
+            'page_size': page_size,
+            'page_count': page_count,
+            'freelist_count': freelist_count,
+            'file_bytes': page_size * page_count,
+            'free_bytes': page_size * freelist_count,
+            'fragmentation': round(freelist_count / page_count, 4) if page_count else 0,
+            'auto_vacuum': self.AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum)),
+            'write_rate': round(self.write_rate(), 2),
+            'running': self.running,
+            'paused': self.paused,
+            'pending': self.run_requested,
+            'full_vacuum_pending': self.full_vacuum_requested,
+            'pages_reclaimed': self.pages_reclaimed,
+            'last_vacuum': fmt(self.last_vacuum),
+            'last_optimize': fmt(self.last_optimize),
+            'last_analyze': fmt(self.last_analyze),
+            'last_error': self.last_error
+        }
+
+    def incremental_vacuum(self):
+        """分步回收空闲页，每步之间让出控制权，写入繁忙时中止本轮"""
+        pages_per_step = int(self.app.config.get('DB_VACUUM_PAGES_PER_STEP', 200))
+        max_steps = int(self.app.config.get('DB_VACUUM_MAX_STEPS', 50))
+        reclaimed = 0
+
+        # 只有 auto_vacuum=INCREMENTAL 的数据库才能分步回收
+        if io_executor.run(self._pragmas, 'auto_vacuum')[0] != 2:
+            return 0
+
+        for _ in range(max_steps):
+            if self.is_busy():
+                self.paused = True
+                break
+
+            step = io_executor.run(self._vacuum_step, pages_per_step)
+            if not step:
+                break
+            reclaimed += step
+            socketio.sleep(0)
+
+        self.pages_reclaimed += reclaimed
+        self.last_vacuum = time.time()
+        return reclaimed
+
+    def _vacuum_step(self, pages):
+        """回收一步空闲页，返回回收的页数（没有空闲页时为 0）"""
+        conn = self._connect()
+        try:
+            free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_before:
+                return 0
+            # executescript 会把 pragma 步进到底，execute 只执行一步
+            conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+            conn.commit()
+            return free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _full_vacuum(self):
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+
+    def _optimize(self, optimize, analyze):
+        conn = self._connect()
+        try:
+            if optimize:
+                conn.execute("PRAGMA optimize")
+            if analyze:
+                conn.execute("ANALYZE")
+                conn.commit()
+        finally:
+            conn.close()
+
+    def full_vacuum(self):
+        """一次性整库 VACUUM，同时切换到 INCREMENTAL 模式（管理员显式请求或小库首次启动时执行）"""
+        io_executor.run(self._full_vacuum)
+        self.last_vacuum = time.time()
+
+    def run_once(self, force=False):
+        """执行一轮维护"""
+        now = time.time()
+        self.running = True
+        try:
+            if self.full_vacuum_requested:
+                self.full_vacuum_requested = False
+                self.full_vacuum()
+                logger.info("数据库整库 VACUUM 完成，已启用 incremental vacuum")
+
+            reclaimed = self.incremental_vacuum()
+            if reclaimed:
+                logger.info(f"数据库增量回收完成: {reclaimed} 页")
+
+            optimize = force or now - (self.last_optimize or self._started_at) >= self.app.config.get('DB_OPTIMIZE_INTERVAL', 3600)
+            analyze = force or now - (self.last_analyze or self._started_at) >= self.app.config.get('DB_ANALYZE_INTERVAL', 86400)
+            if optimize or analyze:
+                io_executor.run(self._optimize, optimize, analyze)
+            if optimize:
+                self.last_optimize = now
+            if analyze:
+                self.last_analyze = now
+
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"数据库维护失败: {str(e)}")
+        finally:
+            self.running = False
+
+    def request_run(self, full_vacuum=False):
+        """请求后台尽快执行一轮维护"""
+        if full_vacuum:
+            self.full_vacuum_requested = True
+        self.run_requested = True
+
+    def _worker(self):
+        interval = self.app.config.get('DB_MAINTENANCE_INTERVAL', 60)
+        while True:
+            waited = 0
+            while waited < interval and not self.run_requested:
+                socketio.sleep(1)
+                waited += 1
+
+            # 写入繁忙时推迟，保留未完成的请求；有待执行的请求时上面的等待会被跳过，这里先让出
+            if self.is_busy():
+                self.paused = True
+                socketio.sleep(1)
+                continue
+
+            self.paused = False
+            force = self.run_requested
+            self.run_requested = False
+            self.run_once(force=force)
+
+    def start(self):
+        """启动后台维护任务"""
+        if self.started:
+            return
+        self.started = True
+        socketio.start_background_task(self._worker)
+
+db_maintenance = DatabaseMaintenance(app)
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def track_write_statements(conn, cursor, statement, parameters, context, executemany):
+    """统计写语句，供维护任务判断写入压力"""
+    if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+        db_maintenance.record_write()
+
+# 运行指标
+class Metric:
+    """进程内指标基类，按标签值分组保存样本"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    @staticmethod
+    def _format_labels(names, values, extra=None):
+        pairs = list(zip(names, values)) + (extra or [])
+        if not pairs:
+            return ''
+        escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+                   for name, value in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, [], value) for key, value in self._values.items()]
+
+    def render(self, const_labels=()):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for name, key, extra, value in self.samples():
+            lines.append(f'{name}{self._format_labels(self.labels, key, extra + list(const_labels))} {value}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def replace(self, values):
+        """整体替换样本，values 为 {标签值元组: 数值}"""
+        with self._lock:
+            self._values = dict(values)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    result.append((f'{self.name}_bucket', key, [('le', le)], cumulative))
+                result.append((f'{self.name}_sum', key, [], round(total, 6)))
+                result.append((f'{self.name}_count', key, [], count))
+        return result
+
+class MetricsRegistry:
+    """指标注册表，render() 输出 Prometheus 文本格式
+
+    指标只在本进程内累计。多进程运行时每个样本带 worker 标签（工作进程序号），
+    一次抓取只得到处理该请求的工作进程的指标，按 worker 区分后再汇总。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def collector(self, fn):
+        """注册在抓取时调用的采集函数，用于更新 Gauge"""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.error(f"指标采集失败: {str(e)}")
+        info = worker_info()
+        const_labels = [('worker', info['index'])] if info else []
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(const_labels))
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+http_requests_total = metrics.counter('http_requests_total', 'HTTP请求数', ('endpoint', 'method', 'status'))
+http_request_duration = metrics.histogram('http_request_duration_seconds', 'HTTP请求耗时', ('endpoint', 'method'))
+socketio_events_total = metrics.counter('socketio_events_total', 'Socket.IO事件数', ('event',))
+socketio_event_duration = metrics.histogram('socketio_event_duration_seconds', 'Socket.IO事件处理耗时', ('event',))
+socketio_connected = metrics.gauge('socketio_connected_clients', '当前Socket.IO连接数')
+socketio_room_clients = metrics.gauge('socketio_room_clients', '各聊天室连接数', ('room',))
+socketio_fanout = metrics.histogram('socketio_message_fanout', '每条聊天消息的接收连接数', (),
+                                    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+db_query_duration = metrics.histogram('db_query_duration_seconds', 'SQL语句耗时', ('operation',),
+                                      buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+db_pool = metrics.gauge('db_pool_connections', '数据库连接池状态', ('state',))
+io_pool = metrics.gauge('io_executor_tasks', 'IO线程池任务', ('state',))
+io_wait = metrics.gauge('io_executor_wait_seconds', 'IO线程池平均/最大等待时间', ('stat',))
+process_cpu = metrics.gauge('process_cpu_seconds_total', '进程CPU时间')
+process_memory = metrics.gauge('process_resident_memory_bytes', '进程常驻内存')
+process_fds = metrics.gauge('process_open_fds', '进程打开的文件描述符数')
+process_threads = metrics.gauge('process_threads', '进程线程数')
+
+def room_size(room, namespace='/'):
+    """房间内的连接数（仅本进程）"""
+    return len(socketio.server.manager.rooms.get(namespace, {}).get(room, ()))
+
+@metrics.collector
+def collect_runtime_metrics():
+    rooms = socketio.server.manager.rooms.get('/', {})
+    socketio_connected.set(len(rooms.get(None, ())))
+    socketio_room_clients.replace({(room,): len(sids) for room, sids in rooms.items()
+                                   if isinstance(room, str) and room.startswith('room_')})
+
+    pool = engine.pool
+    for state in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, state):
+            db_pool.set(getattr(pool, state)(), state=state)
+
+    stats = io_executor.stats()
+    for state in ('queue_depth', 'active', 'completed', 'failed'):
+        io_pool.set(stats[state], state=state)
+    io_wait.set(stats['avg_wait_ms'] / 1000, stat='avg')
+    io_wait.set(stats['max_wait_ms'] / 1000, stat='max')
+
+    try:
+        import psutil
+        process = psutil.Process(os.getpid())
+        cpu = process.cpu_times()
+        process_cpu.set(round(cpu.user + cpu.system, 3))
+        process_memory.set(process.memory_info().rss)
+        process_threads.set(process.num_threads())
+        if hasattr(process, 'num_fds'):
+            process_fds.set(process.num_fds())
+    except ImportError:
+        pass
+
+@app.before_request
+def start_request_timer():
+    request.environ['metrics.start'] = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = request.environ.get('metrics.start')
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_duration.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        http_requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+# SQL 性能分析
+class QueryProfile:
+    """单个HTTP请求或Socket.IO事件内的SQL统计"""
+
+    IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+
+    def __init__(self, kind, name):
+        self.kind = kind  # http / socketio
+        self.name = name
+        self.started_at = datetime.now()
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest = []  # [(耗时, 语句)]
+        self.shapes = {}  # 语句形态 -> 执行次数
+
+    @classmethod
+    def shape_of(cls, statement):
+        """归一化语句形态，IN (?, ?, ?) 视为同一形态"""
+        return cls.IN_LIST_RE.sub('IN (?)', ' '.join(statement.split()))
+
+    def record(self, statement, duration):
+        shape = self.shape_of(statement)
+        self.count += 1
+        self.total_time += duration
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+        limit = app.config.get('SQL_SLOW_STATEMENTS', 5)
+        if len(self.slowest) < limit or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, shape))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[limit:]
+
+    def n_plus_one(self):
+        """重复执行次数超过阈值的语句形态，疑似 N+1"""
+        threshold = app.config.get('SQL_NPLUSONE_THRESHOLD', 5)
+        return [{'statement': shape, 'count': count}
+                for shape, count in self.shapes.items() if count >= threshold]
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'started_at': self.started_at.isoformat(),
+            'query_count': self.count,
+            'db_time_ms': round(self.total_time * 1000, 3),
+            'slowest': [{'statement': shape, 'duration_ms': round(duration * 1000, 3)}
+                        for duration, shape in self.slowest],
+            'n_plus_one': self.n_plus_one()
+        }
+
+# 当前请求/事件的统计对象，greenlet 与线程各自独立
+current_query_profile = contextvars.ContextVar('current_query_profile', default=None)
+query_profiles = deque(maxlen=app.config.get('SQL_PROFILE_HISTORY', 200))
+
+def begin_query_profile(kind, name):
+    if not app.config.get('SQL_PROFILING', True):
+        return None
+    profile = QueryProfile(kind, name)
+    current_query_profile.set(profile)
+    return profile
+
+def finish_query_profile(profile):
+    """结束统计并保存，发现疑似 N+1 时记录警告"""
+    current_query_profile.set(None)
+    if profile is None:
+        return
+    query_profiles.append(profile)
+    for item in profile.n_plus_one():
+        logger.warning(f"疑似N+1查询: {profile.kind} {profile.name} "
+                       f"重复执行 {item['count']} 次: {item['statement'][:200]}")
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context.query_start
+    db_query_duration.observe(duration, operation=statement.lstrip()[:6].upper())
+    profile = current_query_profile.get()
+    if profile is not None:
+        profile.record(statement, duration)
+
+@app.before_request
+def start_request_profile():
+    begin_query_profile('http', request.endpoint or request.path)
+
+@app.after_request
+def finish_request_profile(response):
+    # 流式页面在输出结束后由 stream_page 关闭统计，输出期间的查询也计入本请求
+    if g.get('streaming_query_profile'):
+        return response
+    profile = current_query_profile.get()
+    finish_query_profile(profile)
+    if profile is not None and app.config.get('SQL_SERVER_TIMING', False):
+        response.headers.add('Server-Timing',
+                             f'db;dur={profile.total_time * 1000:.2f};desc="{profile.count} queries"')
+    return response
+
+def track_event(event_name):
+    """Socket.IO 事件处理器装饰器，统计事件内的SQL"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile = begin_query_profile('socketio', event_name)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                socketio_event_duration.observe(time.perf_counter() - started, event=event_name)
+                socketio_events_total.inc(event=event_name)
+                finish_query_profile(profile)
+        return wrapper
+    return decorator
+
+# eventlet hub 延迟监控
+hub_lag = metrics.histogram('eventlet_hub_lag_seconds', 'eventlet hub 调度延迟',
+                            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+def native_module(name):
+    """取得未被 eventlet monkey_patch 替换的原生模块"""
+    try:
+        from eventlet import patcher
+        return patcher.original(name)
+    except ImportError:
+        return __import__(name)
+
+def describe_frame(frame, use_rule=False):
+    """从调用栈中找出正在处理的路由或Socket.IO事件"""
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == __file__ and code.co_name == 'wrapper' and 'event_name' in frame.f_locals:
+            return f"socketio:{frame.f_locals['event_name']}"
+        if code.co_name == 'dispatch_request' and 'req' in frame.f_locals:
+            req = frame.f_locals['req']
+            if use_rule and req.url_rule is not None:
+                return f"http:{req.method} {req.url_rule.rule}"
+            return f"http:{req.method} {req.path}"
+        frame = frame.f_back
+    return 'unknown'
+
+class HubLagMonitor:
+    """持续测量 eventlet hub 调度延迟
+
+    后台协程按固定间隔 sleep 并记录实际唤醒延迟；另有一个原生看门狗线程，
+    发现心跳停滞超过阈值时抓取 hub 线程当前的调用栈，即正在阻塞的协程，
+    并记录为一次事故（时间、持续时长、路由或事件、调用栈）。
+    """
+
+    def __init__(self, interval, threshold, history):
+        self.interval = interval
+        self.threshold = threshold
+        self.incidents = deque(maxlen=history)
+        self.started = False
+        self.hub_ident = None
+        self.heartbeat = time.monotonic()
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._current = None
+        self._lock = threading.Lock()
+
+    def _probe(self):
+        self.hub_ident = self._native_threading.get_ident()
+        while True:
+            started = time.monotonic()
+            socketio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self.heartbeat = now
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            hub_lag.observe(lag)
+
+    def _watchdog(self):
+        while True:
+            self._native_time.sleep(self.interval)
+            if self.hub_ident is None:
+                continue
+            stalled = time.monotonic() - self.heartbeat - self.interval
+            with self._lock:
+                if stalled >= self.threshold:
+                    if self._current is None:
+                        frame = sys._current_frames().get(self.hub_ident)
+                        self._current = {
+                            'started_at': datetime.now().isoformat(),
+                            'duration_ms': round(stalled * 1000, 1),
+                            'source': describe_frame(frame),
+                            'stack': traceback.format_stack(frame, limit=30) if frame else []
+                        }
+                        self.incidents.append(self._current)
+                    else:
+                        self._current['duration_ms'] = round(stalled * 1000, 1)
+                elif self._current is not None:
+                    logger.warning(f"eventlet hub 阻塞 {self._current['duration_ms']}ms: {self._current['source']}")
+                    self._current = None
+
+    def start(self):
+        """启动监控（仅 eventlet 模式）"""
+        if self.started or app.config['SOCKETIO_ASYNC_MODE'] != 'eventlet':
+            return
+        try:
+            from eventlet import patcher
+        except ImportError:
+            return
+        self.started = True
+        # 即使已 monkey_patch，看门狗也必须是原生线程，才能在 hub 阻塞时运行
+        self._native_threading = native_module('threading')
+        self._native_time = native_module('time')
+        socketio.start_background_task(self._probe)
+        self._native_threading.Thread(target=self._watchdog, name='hub-lag-watchdog', daemon=True).start()
+
+    def report(self):
+        with self._lock:
+            return {
+                'enabled': self.started,
+                'interval_ms': self.interval * 1000,
+                'threshold_ms': self.threshold * 1000,
+                'lag_ms': round(self.lag * 1000, 3),
+                'max_lag_ms': round(self.max_lag * 1000, 3),
+                'incidents': list(self.incidents)[::-1]
+            }
+
+hub_monitor = HubLagMonitor(app.config.get('HUB_LAG_INTERVAL', 0.1),
+                            app.config.get('HUB_LAG_THRESHOLD', 0.25),
+                            app.config.get('HUB_LAG_INCIDENTS', 50))
+
+# 采样分析
+class SamplingProfiler:
+    """统计采样分析器
+
+    在原生线程中按固定间隔采集所有线程的调用栈（可选包括挂起的 greenlet），
+    按路由或Socket.IO事件打标签，输出 flamegraph.pl 可直接使用的折叠栈格式。
+    同一时间只允许一次采样。
+    """
+
+    def __init__(self, max_seconds, interval):
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.running = False
+
+    @staticmethod
+    def collapse(frame, tag):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join([tag] + names[::-1])
+
+    def _greenlet_frames(self):
+        """挂起的 greenlet 的栈顶帧（需遍历 gc，开销较大）"""
+        try:
+            from greenlet import greenlet
+        except ImportError:
+            return []
+        return [obj.gr_frame for obj in gc.get_objects()
+                if isinstance(obj, greenlet) and obj.gr_frame is not None]
+
+    def capture(self, seconds, include_greenlets=False):
+        """采样 seconds 秒，返回 (折叠栈计数, 采样次数)；已有采样在运行时返回 None"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        self.running = True
+        try:
+            seconds = min(max(seconds, 0.1), self.max_seconds)
+            sleep = native_module('time').sleep
+            own_ident = threading.get_ident()
+            stacks = {}
+            samples = 0
+            deadline = time.monotonic() + seconds
+
+            while time.monotonic() < deadline:
+                frames = [frame for ident, frame in sys._current_frames().items() if ident != own_ident]
+                # greenlet 遍历较慢，每10次采样做一次
+                if include_greenlets and samples % 10 == 0:
+                    frames.extend(self._greenlet_frames())
+                for frame in frames:
+                    key = self.collapse(frame, describe_frame(frame, use_rule=True))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                sleep(self.interval)
+
+            return stacks, samples
+        finally:
+            self.running = False
+            self._lock.release()
+
+profiler = SamplingProfiler(app.config.get('PROFILER_MAX_SECONDS', 30),
+                            app.config.get('PROFILER_INTERVAL', 0.01))
+
+# 服务生命周期
+LISTEN_FD_ENV = 'SERVER_LISTEN_FD'
+READY_FD_ENV = 'SERVER_READY_FD'
+
+class HandoffListener:
+    """工作进程的监听 socket：从启动器的控制连接接收已接受的客户端连接
+
+    提供 eventlet.wsgi.server 用到的 accept / getsockname / family / close。
+    """
+
+    def __init__(self, path, address):
+        self.address = tuple(address)
+        self.family = socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._sock.connect(path)
+        self._sock.setblocking(False)
+
+    def getsockname(self):
+        return self.address
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def notify_ready(self):
+        self._sock.send(f"ready {os.getpid()}".encode())
+
+    def accept(self):
+        import eventlet
+        from eventlet import greenio
+        from eventlet.hubs import trampoline
+
+        while True:
+            try:
+                msg, fds, _, _ = socket.recv_fds(self._sock, 16, 1)
+            except BlockingIOError:
+                trampoline(self._sock, read=True)
+                continue
+            if fds:
+                conn = socket.socket(fileno=fds[0])
+                try:
+                    return greenio.GreenSocket(conn), conn.getpeername()
+                except OSError:
+                    conn.close()  # 交接途中客户端已断开
+                    continue
+            if not msg:
+                # 启动器已退出，排空后结束本进程；排空时本协程会被 kill
+                lifecycle.begin(restart=False, reason='启动器已退出')
+                eventlet.event.Event().wait()
+
+    def close(self):
+        self._sock.close()
+
+class ServerLifecycle:
+    """优雅重启与关停
+
+    替代 socketio.run 自行持有监听 socket。关停时停止接受新连接，通知客户端带随机
+    退避重连后断开 Socket.IO 连接，等待处理中的请求结束，再写回活动时间和审计日志。
+    重启时先把监听 socket 交给新进程，新进程就绪后旧进程才停止接受连接；
+    调试模式下由 werkzeug 重载器重启（退出码3）。
+    作为多进程启动器的工作进程运行时，连接由启动器交接，重启只需排空后退出，
+    由启动器负责拉起新进程。
+    """
+
+    def __init__(self, drain_timeout, ready_timeout, reconnect_delay, reconnect_jitter):
+        self.drain_timeout = drain_timeout
+        self.ready_timeout = ready_timeout
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_jitter = reconnect_jitter
+        self.state = 'running'  # running / draining / stopped
+        self.exit_code = 0
+        self.listener = None
+        self._server = None
+
+    @property
+    def draining(self):
+        return self.state != 'running'
+
+    @staticmethod
+    def under_reloader():
+        return os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+    def listen(self, host, port):
+        """创建监听 socket，由上一个进程交接时直接沿用"""
+        import eventlet
+        from eventlet import greenio
+
+        info = worker_info()
+        fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if info is not None:
+            self.listener = HandoffListener(info['control'], info['address'])
+        elif fd is not None:
+            self.listener = greenio.GreenSocket(socket.socket(fileno=int(fd)))
+            logger.info(f"沿用上一进程的监听 socket: {self.listener.getsockname()}")
+        else:
+            self.listener = eventlet.listen((host, port))
+        return self.listener
+
+    def _notify_ready(self):
+        if isinstance(self.listener, HandoffListener):
+            self.listener.notify_ready()
+            return
+        fd = os.environ.pop(READY_FD_ENV, None)
+        if fd is not None:
+            os.write(int(fd), b'1')
+            os.close(int(fd))
+
+    def serve(self, host, port, log_output=False):
+        """运行 WSGI 服务直到排空结束，返回退出码"""
+        import eventlet
+        import eventlet.wsgi
+
+        sock = self.listen(host, port)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.begin(restart=False, reason='SIGTERM'))
+            signal.signal(signal.SIGHUP, lambda *args: self.begin(restart=True, reason='SIGHUP'))
+
+        self._server = eventlet.spawn(eventlet.wsgi.server, sock, app, log_output=log_output)
+        self._notify_ready()
+        self._server.wait()
+        self.flush()
+        self.state = 'stopped'
+        return self.exit_code
+
+    def run(self, host='127.0.0.1', port=5000, debug=False):
+        """启动服务，调试模式下带自动重载"""
+        app.debug = debug
+        if not debug or LISTEN_FD_ENV in os.environ:
+            return self.serve(host, port, log_output=debug)
+
+        from werkzeug._reloader import run_with_reloader
+
+        # 重载器在子线程中运行服务，sys.exit 只能结束该线程
+        run_with_reloader(lambda: os._exit(self.serve(host, port, log_output=debug)))
+
+    def request(self, restart, reason=''):
+        """管理接口发起的重启或关停；多进程运行时交给启动器处理全部工作进程"""
+        info = worker_info()
+        if info is None:
+            return self.begin(restart, reason)
+        if self.draining:
+            return False
+        logger.info(f"请求启动器{'滚动重启' if restart else '关停'}全部工作进程（{reason}）")
+        os.kill(info['launcher_pid'], signal.SIGHUP if restart else signal.SIGTERM)
+        return True
+
+    def begin(self, restart, reason=''):
+        """开始重启或关停，已在进行中时返回 False"""
+        if self.draining:
+            return False
+        self.state = 'draining'
+        logger.info(f"开始{'重启' if restart else '关停'}服务器{f'（{reason}）' if reason else ''}")
+        socketio.start_background_task(self._drain, restart)
+        return True
+
+    def _spawn_successor(self):
+        """启动继承监听 socket 的新进程，就绪后返回 True"""
+        fd = self.listener.fileno()
+        ready_read, ready_write = os.pipe()
+        env = dict(os.environ, **{LISTEN_FD_ENV: str(fd), READY_FD_ENV: str(ready_write)})
+        try:
+            child = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                     pass_fds=(fd, ready_write))
+        finally:
+            os.close(ready_write)
+
+        try:
+            deadline = time.monotonic() + self.ready_timeout
+            while time.monotonic() < deadline and child.poll() is None:
+                if select.select([ready_read], [], [], 0)[0]:
+                    if os.read(ready_read, 1):
+                        logger.info(f"新进程 {child.pid} 已接管监听 socket")
+                        return True
+                    break  # 管道关闭但未写入，新进程启动失败
+                socketio.sleep(0.1)
+        finally:
+            os.close(ready_read)
+
+        logger.error(f"新进程未能就绪（退出码 {child.poll()}），取消重启")
+        if child.poll() is None:
+            child.terminate()
+        return False
+
+    def _drain(self, restart):
+        socketio.sleep(0.5)  # 等待管理接口的响应发出
+
+        if restart and isinstance(self.listener, HandoffListener):
+            pass  # 新的工作进程已由启动器拉起
+        elif restart and self.listener is not None and not self.under_reloader():
+            if not self._spawn_successor():
+                self.state = 'running'
+                return
+        elif restart and self.under_reloader():
+            self.exit_code = 3
+
+        # 停止接受新连接；已有连接处理完当前请求后关闭
+        if self._server is not None:
+            self._server.kill(SystemExit)
+
+        # 通知本进程的客户端稍后随机重连，避免同时涌入
+        socketio.emit('server_shutdown', {
+            'restart': restart,
+            'reconnect_delay': self.reconnect_delay,
+            'reconnect_jitter': self.reconnect_jitter
+        }, ignore_queue=True)
+        socketio.sleep(0.5)
+        for sid, _ in list(socketio.server.manager.get_participants('/', None)):
+            socketio.server.disconnect(sid, namespace='/', ignore_queue=True)
+
+        if self._server is None:
+            # 不是由 run() 启动时无法等待处理中的请求，只写回数据后退出
+            self.flush()
+            os._exit(self.exit_code)
+
+        import eventlet
+
+        try:
+            with eventlet.Timeout(self.drain_timeout):
+                self._server.wait()
+        except eventlet.Timeout:
+            logger.warning(f"{self.drain_timeout} 秒内未能排空连接，强制退出")
+            self.flush()
+            os._exit(self.exit_code)
+
+    def flush(self):
+        """写回内存中的活动时间和排队的审计日志"""
+        try:
+            activity_tracker.flush()
+        except Exception as e:
+            logger.error(f"退出前写回活动时间失败: {str(e)}")
+        audit_logger.close()
+
+lifecycle = ServerLifecycle(app.config.get('SHUTDOWN_DRAIN_TIMEOUT', 30),
+                            app.config.get('RESTART_READY_TIMEOUT', 30),
+                            app.config.get('RECONNECT_DELAY', 1),
+                            app.config.get('RECONNECT_JITTER', 10))
+
+# 多进程启动器
+class WorkerLoadReporter:
+    """工作进程负载：每隔 interval 秒写入 run_dir/worker-<序号>.json，管理接口汇总读取"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = False
+        self._process = None
+
+    def snapshot(self):
+        info = worker_info() or {}
+        rooms = socketio.server.manager.rooms.get('/', {})
+        load = {
+            'index': info.get('index', 0),
+            'pid': os.getpid(),
+            'updated_at': datetime.now().isoformat(),
+            'socket_clients': len(rooms.get(None, ())),
+            'requests': sum(value for _, _, _, value in http_requests_total.samples()),
+            'hub_lag_ms': round(hub_monitor.lag * 1000, 3),
+            'io_queue_depth': io_executor.stats()['queue_depth'],
+            'heartbeat_interval': round(heartbeat.current_interval, 2),
+            'draining': lifecycle.draining
+        }
+        try:
+            import psutil
+            if self._process is None:
+                self._process = psutil.Process(os.getpid())
+            load['cpu_percent'] = self._process.cpu_percent(interval=None)
+            load['memory_bytes'] = self._process.memory_info().rss
+        except ImportError:
+            pass
+        return load
+
+    def _run(self, path):
+        tmp = path.with_name(path.name + '.tmp')
+        while True:
+            try:
+                tmp.write_text(json.dumps(self.snapshot()), encoding='utf-8')
+                os.replace(tmp, path)
+            except Exception as e:
+                logger.error(f"写入工作进程负载失败: {str(e)}")
+            socketio.sleep(self.interval)
+
+    def start(self):
+        """工作进程中启动上报任务"""
+        info = worker_info()
+        if self.started or info is None:
+            return
+        self.started = True
+        socketio.start_background_task(self._run, Path(info['run_dir']) / f"worker-{info['index']}.json")
+
+    def report(self):
+        """全部工作进程的负载；单进程运行时只有本进程"""
+        info = worker_info()
+        if info is None:
+            return {'mode': 'single', 'workers': [self.snapshot()]}
+
+        run_dir = Path(info['run_dir'])
+        try:
+            slots = json.loads((run_dir / 'launcher.json').read_text(encoding='utf-8'))['slots']
+        except (FileNotFoundError, ValueError):
+            slots = []
+        workers = []
+        for slot in slots:
+            try:
+                load = json.loads((run_dir / f"worker-{slot['index']}.json").read_text(encoding='utf-8'))
+            except (FileNotFoundError, ValueError):
+                load = {}
+            if load.get('pid') != slot['pid']:
+                load = {}  # 上报来自已被替换的进程
+            workers.append(dict(load, **slot))
+        return {'mode': 'multi', 'workers': workers}
+
+load_reporter = WorkerLoadReporter(app.config.get('WORKER_STATS_INTERVAL', 5))
+
+class WorkerSlot:
+    """一个工作进程位置：控制 socket、当前进程及其控制连接"""
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.server = None
+        self.process = None
+        self.conn = None
+        self.conn_pid = None
+        self.previous = None  # 被替换的旧进程的控制连接，旧进程收到信号后关闭
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = None
+        self.dispatched = 0
+        self.ready = threading.Condition()
+
+class WorkerLauncher:
+    """多进程启动器
+
+    主进程持有公共监听 socket，按客户端地址哈希把每个新连接（SCM_RIGHTS）交给
+    固定的工作进程，同一客户端的长轮询请求和 WebSocket 总落在同一进程，
+    该进程不可用时顺延到下一个。工作进程之间的 Socket.IO 广播经主进程转发。
+    工作进程异常退出时按退避间隔重启；SIGHUP 逐个滚动重启，新进程就绪后旧进程
+    才排空退出；SIGTERM / SIGINT 优雅关停全部进程。日志轮转也由主进程统一处理。
+
+    本机反向代理转发的连接来源地址都是回环地址，分发时改用请求头中
+    X-Forwarded-For / X-Real-IP / Forwarded 给出的客户端地址。分发按连接进行，
+    代理与上游之间开启 keepalive 时同一连接会承载不同客户端的请求，
+    这种部署需由代理自行按客户端固定上游（如 nginx ip_hash）。
+    除资源版本和用户缓存经总线同步外，统计计数、消息速率、待写回的活动时间和
+    /metrics 指标都只反映处理该请求的工作进程。
+    """
+
+    SEND_TIMEOUT = 1.0
+    PEEK_TIMEOUT = 0.5  # 读取本机代理请求头的等待时间
+    LOOPBACK = ('127.0.0.1', '::1')
+    FORWARDED_RE = re.compile(rb'^(?:x-forwarded-for|x-real-ip):[ \t]*([^,\s]+)|^forwarded:[^\r\n]*?for="?([^;,"\s]+)',
+                              re.IGNORECASE | re.MULTILINE)
+
+    def __init__(self, restart_backoff, ready_timeout, drain_timeout, stats_interval):
+        self.restart_backoff = restart_backoff
+        self.ready_timeout = ready_timeout
+        self.drain_timeout = drain_timeout
+        self.stats_interval = stats_interval
+        self.active = False
+        self.run_dir = None
+        self.address = None
+        self.slots = []
+        self.retiring = []
+        self.rejected = 0
+        self._bus_clients = []
+        self._bus_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._rolling = threading.Lock()
+
+    def multi_process(self):
+        """当前进程是否在多进程模式下运行（启动器或工作进程）"""
+        return self.active or worker_info() is not None
+
+    # 工作进程管理
+    def _spawn(self, slot):
+        info = {
+            'index': slot.index,
+            'control': str(slot.path),
+            'bus': str(self.run_dir / 'bus.sock'),
+            'run_dir': str(self.run_dir),
+            'address': list(self.address),
+            'launcher_pid': os.getpid()
+        }
+        env = dict(os.environ, **{WORKER_ENV: json.dumps(info)})
+        # 独立会话：终端的 Ctrl+C 只发给启动器，由启动器依次关停工作进程
+        process = subprocess.Popen([sys.executable, '-c', 'import app; app.run_worker()'],
+                                   cwd=app.root_path, env=env, start_new_session=True)
+        logger.info(f"启动工作进程 {slot.index} (pid {process.pid})")
+        return process
+
+    def _wait_ready(self, slot, process):
+        """等待进程连上控制 socket 并报告就绪"""
+        deadline = time.monotonic() + self.ready_timeout
+        with slot.ready:
+            while slot.conn_pid != process.pid and process.poll() is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop.is_set():
+                    break
+                slot.ready.wait(min(remaining, 0.5))
+            return slot.conn_pid == process.pid
+
+    def _serve_slot(self, slot):
+        """接受工作进程的控制连接，报告就绪后成为该位置的当前连接"""
+        while True:
+            try:
+                conn, _ = slot.server.accept()
+            except OSError:
+                return
+            try:
+                conn.settimeout(self.ready_timeout)
+                message = conn.recv(64).decode()
+                if not message.startswith('ready '):
+                    conn.close()
+                    continue
+                conn.settimeout(self.SEND_TIMEOUT)
+            except OSError:
+                conn.close()
+                continue
+            with slot.ready:
+                if slot.previous is not None:
+                    slot.previous.close()
+                slot.previous = slot.conn
+                slot.conn, slot.conn_pid = conn, int(message.split()[1])
+                slot.ready.notify_all()
+
+    def _drop_conn(self, slot, conn):
+        with slot.ready:
+            if slot.conn is conn:
+                slot.conn = slot.conn_pid = None
+        conn.close()
+
+    def _check_workers(self):
+        """重启异常退出的工作进程，回收已排空的旧进程"""
+        self.retiring = [p for p in self.retiring if p.poll() is None]
+        now = time.monotonic()
+        for slot in self.slots:
+            process = slot.process
+            if process is not None and process.poll() is not None:
+                uptime = now - slot.started_at
+                slot.failures = 0 if uptime > 60 else slot.failures + 1
+                delay = min(self.restart_backoff * 2 ** max(slot.failures - 1, 0), 60)
+                logger.error(f"工作进程 {slot.index} (pid {process.pid}) 退出，退出码 "
+                             f"{process.returncode}，{delay:.1f} 秒后重启")
+                with slot.ready:
+                    if slot.conn is not None and slot.conn_pid == process.pid:
+                        slot.conn.close()
+                        slot.conn = slot.conn_pid = None
+                slot.process = None
+                slot.restart_at = now + delay
+            if slot.process is None and slot.restart_at is not None and now >= slot.restart_at \
+                    and not self._rolling.locked():
+                slot.restart_at = None
+                slot.restarts += 1
+                slot.process = self._spawn(slot)
+                slot.started_at = time.monotonic()
+
+    def rolling_restart(self):
+        """逐个替换工作进程：新进程就绪后旧进程收到 SIGHUP 排空退出"""
+        if not self._rolling.acquire(blocking=False):
+            return
+        try:
+            logger.info("开始滚动重启工作进程")
+            for slot in self.slots:
+                if self._stop.is_set():
+                    return
+                old = slot.process
+                process = self._spawn(slot)
+                if not self._wait_ready(slot, process):
+                    logger.error(f"工作进程 {slot.index} 的新进程未能就绪，停止滚动重启")
+                    process.terminate()
+                    self.retiring.append(process)
+                    return
+                slot.process = process
+                slot.started_at = time.monotonic()
+                slot.restart_at = None
+                slot.restarts += 1
+                if old is not None and old.poll() is None:
+                    old.send_signal(signal.SIGHUP)
+                    self.retiring.append(old)
+                with slot.ready:
+                    if slot.previous is not None:
+                        slot.previous.close()
+                        slot.previous = None
+            logger.info("滚动重启完成")
+        finally:
+            self._rolling.release()
+
+    # 连接分发与广播转发
+    def _client_key(self, conn, host):
+        """分发用的客户端地址：本机代理转发的连接预读（不消费）请求头，取其中的客户端地址"""
+        if host not in self.LOOPBACK:
+            return host
+        try:
+            conn.settimeout(self.PEEK_TIMEOUT)
+            head = conn.recv(4096, socket.MSG_PEEK)
+        except OSError:
+            return host
+        finally:
+            conn.settimeout(None)  # 文件描述符交给工作进程后须为阻塞模式
+        match = self.FORWARDED_RE.search(head.split(b'\r\n\r\n', 1)[0])
+        if match is None:
+            return host
+        return (match.group(1) or match.group(2)).decode('latin-1')
+
+    def _route(self, conn, host):
+        """按客户端地址选择工作进程并交出连接，全部不可用时返回 False"""
+        start = zlib.crc32(self._client_key(conn, host).encode()) % len(self.slots)
+        for offset in range(len(self.slots)):
+            slot = self.slots[(start + offset) % len(self.slots)]
+            target = slot.conn
+            if target is None:
+                continue
+            try:
+                socket.send_fds(target, [b'c'], [conn.fileno()])
+                slot.dispatched += 1
+                return True
+            except OSError:
+                self._drop_conn(slot, target)
+        return False
+
+    def _dispatch(self, listener):
+        while not self._stop.is_set():
+            try:
+                conn, address = listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stop.is_set():
+                    return
+                continue
+            with conn:
+                if not self._route(conn, address[0]):
+                    self.rejected += 1
+
+    def _serve_bus(self, server):
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                return
+            # 只限制发送：卡住的工作进程不能拖住转发线程，读取保持阻塞
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                              struct.pack('ll', int(self.SEND_TIMEOUT), int(self.SEND_TIMEOUT % 1 * 1e6)))
+            with self._bus_lock:
+                self._bus_clients.append(client)
+            threading.Thread(target=self._relay, args=(client,), name='worker-bus', daemon=True).start()
+
+    def _relay(self, source):
+        """把一个工作进程发布的消息转发给其他工作进程"""
+        try:
+            with source.makefile('rb') as f:
+                for line in f:
+                    with self._bus_lock:
+                        targets = [c for c in self._bus_clients if c is not source]
+                    for target in targets:
+                        try:
+                            target.sendall(line)
+                        except OSError:
+                            self._close_bus_client(target)
+        except OSError:
+            pass
+        finally:
+            self._close_bus_client(source)
+
+    def _close_bus_client(self, client):
+        with self._bus_lock:
+            if client in self._bus_clients:
+                self._bus_clients.remove(client)
+        client.close()
+
+    # 日志与状态
+    def _rotate_logs(self, pending):
+        """工作进程只追加写入，由启动器按大小轮转；稍后再压缩，等工作进程重新打开文件"""
+        limits = {log_reader.path: app.config.get('LOG_MAX_BYTES', 10 * 1024 * 1024),
+                  audit_log_reader.path: app.config.get('AUDIT_LOG_MAX_BYTES', 10 * 1024 * 1024)}
+        for path, limit in limits.items():
+            try:
+                if limit and path.stat().st_size >= limit:
+                    rotated = rotated_log_path(path)
+                    os.rename(path, rotated)
+                    pending.append((time.monotonic() + 5, rotated))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"轮转日志 {path.name} 失败: {str(e)}")
+        while pending and pending[0][0] <= time.monotonic():
+            log_archiver.submit(pending.pop(0)[1])
+
+    def _write_state(self):
+        state = {
+            'pid': os.getpid(),
+            'address': list(self.address),
+            'rejected': self.rejected,
+            'slots': [{
+                'index': slot.index,
+                'pid': slot.process.pid if slot.process else None,
+                'alive': slot.process is not None and slot.process.poll() is None,
+                'accepting': slot.conn is not None,
+                'restarts': slot.restarts,
+                'dispatched': slot.dispatched
+            } for slot in self.slots]
+        }
+        tmp = self.run_dir / 'launcher.json.tmp'
+        tmp.write_text(json.dumps(state), encoding='utf-8')
+        os.replace(tmp, self.run_dir / 'launcher.json')
+
+    def _shutdown(self):
+        """通知全部工作进程排空退出，超时后强制结束"""
+        processes = [slot.process for slot in self.slots if slot.process is not None] + self.retiring
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for process in processes:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"工作进程 {process.pid} 未能按时退出，强制结束")
+                process.kill()
+
+    def run(self, host, port, workers):
+        """启动 workers 个工作进程并持续监管，关停后返回退出码"""
+        self.active = True
+        create_app()
+        setup_database()
+        self.run_dir = Path(tempfile.mkdtemp(prefix='social-platform-'))
+        listener = socket.create_server((host, port), backlog=1024)
+        listener.settimeout(1.0)
+        self.address = listener.getsockname()[:2]
+
+        bus = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bus.bind(str(self.run_dir / 'bus.sock'))
+        bus.listen(workers)
+        threading.Thread(target=self._serve_bus, args=(bus,), name='worker-bus', daemon=True).start()
+
+        for index in range(workers):
+            slot = WorkerSlot(index, self.run_dir / f'worker-{index}.sock')
+            slot.server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            slot.server.bind(str(slot.path))
+            slot.server.listen(2)
+            threading.Thread(target=self._serve_slot, args=(slot,), name=f'worker-slot-{index}',
+                             daemon=True).start()
+            slot.process = self._spawn(slot)
+            slot.started_at = time.monotonic()
+            self.slots.append(slot)
+
+        stop = lambda *args: self._stop.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, lambda *args: threading.Thread(
+            target=self.rolling_restart, name='rolling-restart', daemon=True).start())
+
+        threading.Thread(target=self._dispatch, args=(listener,), name='dispatcher', daemon=True).start()
+        logger.info(f"启动器监听 {self.address[0]}:{self.address[1]}，{workers} 个工作进程")
+
+        pending_logs = []
+        next_state = 0
+        try:
+            while not self._stop.wait(0.5):
+                self._check_workers()
+                self._rotate_logs(pending_logs)
+                if time.monotonic() >= next_state:
+                    self._write_state()
+                    next_state = time.monotonic() + self.stats_interval
+        finally:
+            logger.info("启动器开始关停")
+            listener.close()
+            self._shutdown()
+            for path in pending_logs:
+                log_archiver.submit(path[1])
+            audit_logger.close()
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+        return 0
+
+launcher = WorkerLauncher(app.config.get('WORKER_RESTART_BACKOFF', 1),
+                          app.config.get('RESTART_READY_TIMEOUT', 30),
+                          app.config.get('SHUTDOWN_DRAIN_TIMEOUT', 30),
+                          app.config.get('WORKER_STATS_INTERVAL', 5))
+
+def run_worker():
+    """工作进程入口，由 WorkerLauncher 启动"""
+    global _database_ready
+    info = worker_info()
+    create_app()
+    _database_ready = True  # 启动器已完成建表和迁移
+    CORS(app, resources={r"/socket.io/*": {"origins": "*"}})
+    if info['index'] == 0:
+        db_maintenance.start()
+    activity_tracker.start()
+    stats_counters.start()
+    hub_monitor.start()
+    load_reporter.start()
+    # 立即开始监听总线，收到第一个 Socket.IO 连接前也能同步资源版本
+    socketio.server.manager_initialized = True
+    socketio.server.manager.initialize()
+    logger.info(f"工作进程 {info['index']} 启动 (pid {os.getpid()})")
+    sys.exit(lifecycle.serve(*info['address']))
+
+# 静态资源
+class StaticAssets:
+    """静态资源指纹与预压缩
+
+    build() 把 static/css、static/js（含 vendor）按内容哈希命名原样复制到构建目录，
+    同时生成 .gz / .br 预压缩文件和 manifest.json。url_for('static', filename=...)
+    经 manifest 解析为带哈希的文件名；带哈希的文件按 Accept-Encoding 直接发送预压缩
+    版本并长期缓存（immutable）。manifest 记录每个原文件的哈希，原文件构建后又被修改时
+    改用原文件，避免发出过期的构建结果。未构建或关闭 STATIC_USE_BUILD 时使用原始文件。
+    """
+
+    SOURCES = ('css', 'js')
+    SUFFIXES = ('.css', '.js')
+    ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+    def __init__(self, static_folder, build_dir, max_age):
+        self.root = Path(static_folder)
+        self.build_dir = build_dir
+        self.max_age = max_age
+        self.manifest = {}
+
+    @property
+    def output(self):
+        return self.root / self.build_dir
+
+    def _read_manifest(self):
+        """manifest 原始内容 {原文件名: {'file': 带哈希文件名, 'source': 原文件哈希}}"""
+        try:
+            return json.loads((self.output / 'manifest.json').read_text(encoding='utf-8'))
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _source_digest(self, name):
+        try:
+            return hashlib.sha256((self.root / name).read_bytes()).hexdigest()[:12]
+        except OSError:
+            return None
+
+    def load(self):
+        """读取 manifest，只保留原文件自构建以来未修改的条目；构建目录不存在时为空"""
+        self.manifest = {}
+        stale = []
+        for name, entry in self._read_manifest().items():
+            # 旧格式的条目没有原文件哈希，无法确认是否过期
+            if isinstance(entry, dict) and entry.get('source') == self._source_digest(name):
+                self.manifest[name] = entry['file']
+            else:
+                stale.append(name)
+        if stale:
+            logger.warning(f"以下静态资源在构建后已修改，改用原文件（请重新运行 build-assets）: {', '.join(stale)}")
+        return self.manifest
+
+    def resolve(self, filename):
+        return self.manifest.get(filename, filename)
+
+    def _precompress(self, target, data):
+        """写入比原文件小的 .gz 和 .br（brotli 未安装时跳过）"""
+        variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+        try:
+            import brotli
+            variants['.br'] = brotli.compress(data, quality=11)
+        except ImportError:
+            pass
+        for suffix, compressed in variants.items():
+            if len(compressed) < len(data):
+                target.with_name(target.name + suffix).write_bytes(compressed)
+
+    def build(self):
+        """构建全部资源并写入 manifest，返回 {原文件名: 带哈希文件名}"""
+        previous = self._read_manifest()
+        manifest = {}
+        for source_dir in self.SOURCES:
+            for path in sorted((self.root / source_dir).rglob('*')):
+                if not path.is_file() or path.suffix not in self.SUFFIXES:
+                    continue
+                data = path.read_bytes()
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                name = path.relative_to(self.root).as_posix()
+                target = self.output / Path(name).with_name(f"{path.stem}.{digest}{path.suffix}")
+                if not target.exists():
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    target.write_bytes(data)
+                    self._precompress(target, data)
+                manifest[name] = {'file': target.relative_to(self.root).as_posix(), 'source': digest}
+
+        self.output.mkdir(parents=True, exist_ok=True)
+        tmp = self.output / 'manifest.json.tmp'
+        tmp.write_text(json.dumps(manifest, indent=2), encoding='utf-8')
+        os.replace(tmp, self.output / 'manifest.json')
+
+        # 保留上一版文件：滚动重启期间旧页面仍会引用它们
+        keep = {entry['file'] for entry in manifest.values()}
+        keep |= {entry['file'] if isinstance(entry, dict) else entry for entry in previous.values()}
+        for path in self.output.rglob('*'):
+            name = path.relative_to(self.root).as_posix()
+            for _, suffix in self.ENCODINGS:
+                name = name.removesuffix(suffix)
+            if path.is_file() and path.name != 'manifest.json' and name not in keep:
+                path.unlink()
+        self.manifest = {name: entry['file'] for name, entry in manifest.items()}
+        return self.manifest
+
+    def send(self, filename):
+        """静态文件视图：带哈希的文件优先发送客户端接受的预压缩版本"""
+        if not filename.startswith(self.build_dir + '/') or filename.endswith('manifest.json'):
+            return app.send_static_file(filename)
+
+        accepted = request.accept_encodings
+        for encoding, suffix in self.ENCODINGS:
+            if accepted[encoding] and (self.root / (filename + suffix)).is_file():
+                response = send_from_directory(self.root, filename + suffix, max_age=self.max_age,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.root, filename, max_age=self.max_age)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+static_assets = StaticAssets(app.static_folder, app.config.get('STATIC_BUILD_DIR', 'dist'),
+                             app.config.get('STATIC_ASSET_MAX_AGE', 365 * 24 * 3600))
+app.view_functions['static'] = static_assets.send
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.resolve(values['filename'])
+
+# 响应压缩
+class ResponseCompressor:
+    """按 Accept-Encoding 压缩动态响应
+
+    超过 min_size 的文本 / JSON 响应使用 brotli（已安装时）或 gzip；流式响应逐块压缩并
+    flush，保持边生成边发送。send_file 发出的文件（含预压缩的静态资源）和已带
+    Content-Encoding 的响应不处理。压缩级别偏向速度：动态内容每次都要重新压缩。
+    """
+
+    MIMETYPES = {'text/html', 'text/plain', 'text/css', 'text/javascript', 'application/javascript',
+                 'application/json', 'application/xml', 'image/svg+xml'}
+
+    def __init__(self, min_size, gzip_level, brotli_quality):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        try:
+            import brotli
+            self._brotli = brotli
+        except ImportError:
+            self._brotli = None
+
+    def choose(self, accept_encodings):
+        """客户端接受的编码中权重最高的一个，相同时优先 brotli"""
+        candidates = [('gzip', accept_encodings['gzip'])]
+        if self._brotli is not None:
+            candidates.insert(0, ('br', accept_encodings['br']))
+        encoding, quality = max(candidates, key=lambda item: item[1])
+        return encoding if quality > 0 else None
+
+    def _compressor(self, encoding):
+        """返回 (压缩一块并 flush, 结束) 两个函数"""
+        if encoding == 'br':
+            compressor = self._brotli.Compressor(quality=self.brotli_quality)
+            return lambda data: compressor.process(data) + compressor.flush(), compressor.finish
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)  # 31: gzip 格式
+        return lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    def _stream(self, chunks, encoding):
+        compress, finish = self._compressor(encoding)
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                data = compress(chunk)
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def compress(self, response):
+        if (response.status_code != 200 or response.direct_passthrough or request.method == 'HEAD'
+                or 'Content-Encoding' in response.headers or response.mimetype not in self.MIMETYPES
+                or response.cache_control.no_transform):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compress, finish = self._compressor(encoding)
+            compressed = compress(data) + finish()
+            if len(compressed) >= len(data):
+                return response
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        # 压缩后字节不同，强 ETag 改为弱 ETag，条件请求仍可命中
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+response_compressor = ResponseCompressor(app.config.get('COMPRESS_MIN_SIZE', 1024),
+                                         app.config.get('COMPRESS_GZIP_LEVEL', 5),
+                                         app.config.get('COMPRESS_BROTLI_QUALITY', 4))
+
+@app.after_request
+def compress_response(response):
+    return response_compressor.compress(response)
+
+# 流式渲染
+def stream_page(template_name, **context):
+    """流式渲染模板，片段攒到 STREAM_CHUNK_SIZE 后发送，首字节不必等整页渲染完"""
+    pieces = stream_template(template_name, **context)
+    chunk_size = app.config.get('STREAM_CHUNK_SIZE', 16 * 1024)
+    profile = current_query_profile.get()
+    g.streaming_query_profile = True
+
+    def chunks():
+        current_query_profile.set(profile)
+        try:
+            buffer, size = [], 0
+            for piece in pieces:
+                buffer.append(piece)
+                size += len(piece)
+                if size >= chunk_size:
+                    yield ''.join(buffer)
+                    buffer, size = [], 0
+            if buffer:
+                yield ''.join(buffer)
+        finally:
+            current_query_profile.set(None)
+
+    response = app.response_class(chunks(), mimetype='text/html')
+    # 响应关闭时（输出完毕或客户端断开）保存统计，生成器未被迭代时同样执行
+    response.call_on_close(lambda: finish_query_profile(profile))
+    return response
+
+def iter_query_batches(query, column, id_column, key, descending=False, batch_size=None):
+    """按 (column, id) keyset 分批执行查询，逐批产出结果列表
+
+    每批在两次 yield 之间完整取出，不跨 yield 持有游标。流式响应让出 hub 时，同一线程上的
+    其他请求可能 remove 共享的会话，所以调用方应把每批结果转换成普通数据再交给模板。
+    key(row) 返回该行的 (column 值, id)；column 不能为 NULL。
+    """
+    batch_size = batch_size or app.config.get('STREAM_BATCH_SIZE', 200)
+    order = (column.desc(), id_column.desc()) if descending else (column.asc(), id_column.asc())
+    last = None
+    while True:
+        batch = query
+        if last is not None:
+            value, row_id = last
+            if descending:
+                batch = batch.filter(or_(column < value, and_(column == value, id_column < row_id)))
+            else:
+                batch = batch.filter(or_(column > value, and_(column == value, id_column > row_id)))
+        rows = batch.order_by(*order).limit(batch_size).all()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last = key(rows[-1])
+
+def user_summary(user):
+    """模板用的用户信息，不引用会话中的对象"""
+    if user is None:
+        return {}
+    return {'id': user.id, 'username': user.username, 'nickname': user.nickname,
+            'color': user.color, 'badge': user.badge}
+
 # 路由定义
 @app.route('/')
 def index():
@@ -385,8 +3520,7 @@ def login():
             return redirect(url_for('login'))
         
         login_user(user)
-        user.last_seen = datetime.utcnow()
-        db_session.commit()
+        activity_tracker.touch(user.id)
         log_admin_action(f"用户登录: {user.username}")
         return redirect(url_for('chat_index'))
     
@@ -411,6 +3545,7 @@ def change_password():
         
         current_user.set_password(form.new_password.data)
         db_session.commit()
+        user_cache.invalidate(current_user.id)
         log_admin_action(f"用户修改密码: {current_user.username}")
         flash('密码已成功修改', 'success')
         return redirect(url_for('chat_index'))
@@ -426,6 +3561,8 @@ def profile():
         current_user.color = form.color.data or '#000000'
         current_user.badge = form.badge.data
         db_session.commit()
+        user_cache.invalidate(current_user.id)
+        resource_versions.bump('users')  # 聊天历史中带有昵称、颜色和徽章
         log_admin_action(f"用户更新个人资料: {current_user.username}")
         flash('个人资料已更新', 'success')
         return redirect(url_for('profile'))
@@ -441,7 +3578,8 @@ def profile():
 @login_required
 def chat_index():
     rooms = db_session.query(ChatRoom).all()
-    return render_template('chat/index.html', rooms=rooms)
+    unread = room_unread_counts(current_user.id)
+    return render_template('chat/index.html', rooms=rooms, unread=unread)
 
 @app.route('/chat/<int:room_id>')
 @login_required
@@ -449,50 +3587,112 @@ def chat_room(room_id):
     room = db_session.query(ChatRoom).get(room_id)
     if room is None:
         abort(404)
-    return render_template('chat/room.html', room=room)
+    marker = db_session.get(ChatReadMarker, (current_user.id, room_id))
+    return render_template('chat/room.html', room=room, last_read_id=marker.last_read_id if marker else 0)
 
 @app.route('/api/chat/<int:room_id>/history')
 @login_required
 def chat_history(room_id):
-    """获取聊天历史消息 - 只返回原始Markdown内容"""
+    """获取聊天历史消息 - 只返回原始Markdown内容
+
+    after 为上一页最后一条消息的ID，按 (room_id, id) 索引直接定位；
+    offset 仅为兼容旧客户端保留，未提供 after 时才使用。
+    """
     limit = min(request.args.get('limit', 50, type=int), 100)
-    offset = request.args.get('offset', 0, type=int)
+    after = request.args.get('after', type=int)
+    offset = request.args.get('offset', 0, type=int) if after is None else 0
+
+    # 房间消息和用户资料都没有变化时直接返回 304
+    etag, last_modified = resource_versions.validators('rooms', f'room:{room_id}', 'users')
+    etag = f'{etag}-{limit}-{after}-{offset}'
+    response = not_modified_response(etag, last_modified)
+    if response is not None:
+        return response
     
-    # 按时间戳升序排列（最旧的在前），确保消息按时间顺序排列
-    messages = db_session.query(ChatMessage).filter_by(room_id=room_id)\
-        .order_by(ChatMessage.timestamp.asc()).limit(limit).offset(offset).all()
+    # 按ID升序排列（最旧的在前），作者资料随消息一次查出
+    query = db_session.query(ChatMessage).options(joinedload(ChatMessage.user))\
+        .filter(ChatMessage.room_id == room_id)
+    if after is not None:
+        query = query.filter(ChatMessage.id > after)
+    messages = query.order_by(ChatMessage.id.asc()).offset(offset).limit(limit).all()
     
     # 转换为字典列表（只返回原始内容）
-    messages_data = [{
-        'id': msg.id,
-        'content': msg.content,  # 原始Markdown内容
-        'timestamp': msg.timestamp.isoformat(),
-        'user_id': msg.user_id,
-        'username': msg.user.username,
-        'nickname': msg.user.nickname or msg.user.username,
-        'color': msg.user.color,
-        'badge': msg.user.badge
-    } for msg in messages]  # 保持顺序，按时间升序
+    messages_data = [chat_message_data(msg) for msg in messages]  # 保持顺序，按时间升序
     
-    return jsonify(messages=messages_data)
+    return with_validators(jsonify(messages=messages_data), etag, last_modified)
+
+@app.route('/api/chat/<int:room_id>/sync')
+@login_required
+def chat_sync(room_id):
+    """增量同步聊天记录
+
+    客户端在 IndexedDB 中缓存最近的消息，重新打开房间时带上最后一条消息ID (after)
+    和墓碑游标 (tombstones)，只取新消息和缓存中已被删除的消息ID。
+    没有缓存、新消息超过 limit 条或游标失效时返回最近 limit 条并置 reset，客户端替换整个缓存。
+    users 为最近 limit 条消息作者的当前资料，用于刷新缓存消息中的昵称、颜色和徽章。
+    """
+    max_limit = app.config.get('CHAT_SYNC_LIMIT', 200)
+    limit = max(1, min(request.args.get('limit', max_limit, type=int), max_limit))
+    after = request.args.get('after', 0, type=int)
+    cursor = request.args.get('tombstones', 0, type=int)
+
+    etag, last_modified = resource_versions.validators('rooms', f'room:{room_id}', 'users')
+    etag = f'{etag}-{limit}-{after}-{cursor}'
+    response = not_modified_response(etag, last_modified)
+    if response is not None:
+        return response
+
+    if db_session.get(ChatRoom, room_id) is None:
+        return jsonify(success=False, message="聊天室不存在"), 404
+
+    latest_tombstone, latest_deleted = db_session.query(func.max(ChatMessageTombstone.id),
+                                                        func.max(ChatMessageTombstone.message_id)).one()
+    latest_tombstone = latest_tombstone or 0
+    latest_message = max(db_session.query(func.max(ChatMessage.id)).scalar() or 0, latest_deleted or 0)
+    # 游标超出服务器记录说明数据库已重建，本地缓存作废
+    reset = after <= 0 or after > latest_message or cursor > latest_tombstone
+
+    query = db_session.query(ChatMessage).options(joinedload(ChatMessage.user))\
+        .filter(ChatMessage.room_id == room_id)
+    if not reset:
+        messages = query.filter(ChatMessage.id > after).order_by(ChatMessage.id.asc()).limit(limit + 1).all()
+        reset = len(messages) > limit
+    if reset:
+        messages = query.order_by(ChatMessage.id.desc()).limit(limit).all()[::-1]
+
+    tombstones = []
+    if not reset and cursor < latest_tombstone:
+        tombstones = [message_id for (message_id,) in db_session.query(ChatMessageTombstone.message_id)
+                      .filter(ChatMessageTombstone.room_id == room_id,
+                              ChatMessageTombstone.id > cursor,
+                              ChatMessageTombstone.message_id <= after)]
+
+    recent_authors = db_session.query(ChatMessage.user_id).filter(ChatMessage.room_id == room_id)\
+        .order_by(ChatMessage.id.desc()).limit(limit).subquery()
+    authors = db_session.query(User).filter(User.id.in_(select(recent_authors.c.user_id)))
+
+    return with_validators(jsonify(
+        messages=[chat_message_data(msg) for msg in messages],
+        tombstones=tombstones,
+        cursor=latest_tombstone,
+        reset=reset,
+        users={user.id: user_summary(user) for user in authors}
+    ), etag, last_modified)
 
 @app.route('/api/chat/send', methods=['POST'])
 @login_required
 def send_chat_message():
-    room_id = request.form.get('room_id')
+    room_id = parse_room_id(request.form.get('room_id'))
     message = request.form.get('message', '').strip()
     
-    if not room_id or not message:
+    if room_id is None or not message or not chat_room_exists(room_id):
         return jsonify(success=False, message="参数错误"), 400
     
     # 保存到数据库
-    message_obj = ChatMessage(
-        content=message,
-        user_id=current_user.id,
-        room_id=room_id
-    )
-    db_session.add(message_obj)
-    db_session.commit()
+    message_id, _ = save_chat_message(current_user.id, room_id, message)
+    resource_versions.bump(f'room:{room_id}')
+    socketio.emit('room_message', {'room_id': room_id, 'message_id': message_id,
+                                   'user_id': current_user.id}, to='room_list')
     
     # 返回成功响应
     return jsonify(success=True)
@@ -502,13 +3702,21 @@ def send_chat_message():
 @login_required
 def get_online_count():
     """获取全局在线用户数"""
-    from datetime import datetime, timedelta
-    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
+    # 缓存未过期时先判断 304，既不查询也不序列化
+    if online_count_cache.peek() is not None:
+        etag, last_modified = resource_versions.validators('online')
+        response = not_modified_response(etag, last_modified)
+        if response is not None:
+            return response
     
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
+    # 查询最近活动的用户数（带短时缓存，刷新后数值不变同样返回 304）
+    online_count = online_count_cache.get()
+    etag, last_modified = resource_versions.validators('online')
+    response = not_modified_response(etag, last_modified)
+    if response is not None:
+        return response
     
-    return jsonify(count=online_count)
+    return with_validators(jsonify(count=online_count), etag, last_modified)
 
 # 贴吧相关路由
 @app.route('/forum')
@@ -523,18 +3731,45 @@ def forum_section(section_id):
     section = db_session.query(ForumSection).get(section_id)
     if section is None:
         abort(404)
-    threads = db_session.query(ForumThread).filter_by(section_id=section_id)\
-        .order_by(ForumThread.timestamp.desc()).all()
-    return render_template('forum/section.html', section=section, threads=threads)
+    db_session.expunge(section)
+
+    def threads():
+        reply_counts = db_session.query(ForumReply.thread_id, func.count(ForumReply.id).label('count'))\
+            .group_by(ForumReply.thread_id).subquery()
+        query = db_session.query(ForumThread, func.coalesce(reply_counts.c.count, 0))\
+            .options(joinedload(ForumThread.user))\
+            .outerjoin(reply_counts, reply_counts.c.thread_id == ForumThread.id)\
+            .filter(ForumThread.section_id == section_id)
+        for rows in iter_query_batches(query, ForumThread.timestamp, ForumThread.id,
+                                       key=lambda row: (row[0].timestamp, row[0].id), descending=True):
+            for thread, reply_count in rows:
+                yield {'id': thread.id, 'title': thread.title, 'content': thread.content,
+                       'timestamp': thread.timestamp, 'user': user_summary(thread.user),
+                       'reply_count': reply_count}
+
+    return stream_page('forum/section.html', section=section, threads=threads())
 
 @app.route('/forum/thread/<int:thread_id>')
 @login_required
 def forum_thread(thread_id):
-    thread = db_session.query(ForumThread).get(thread_id)
+    thread = db_session.query(ForumThread).options(joinedload(ForumThread.user)).get(thread_id)
     if thread is None:
         abort(404)
-    replies = thread.replies.order_by(ForumReply.timestamp.asc()).all()
-    return render_template('forum/thread.html', thread=thread, replies=replies)
+    reply_count = thread.replies.count()
+    if thread.user is not None:
+        db_session.expunge(thread.user)
+    db_session.expunge(thread)
+
+    def replies():
+        query = db_session.query(ForumReply).options(joinedload(ForumReply.user))\
+            .filter(ForumReply.thread_id == thread_id)
+        for rows in iter_query_batches(query, ForumReply.timestamp, ForumReply.id,
+                                       key=lambda reply: (reply.timestamp, reply.id)):
+            for reply in rows:
+                yield {'id': reply.id, 'content': reply.content, 'timestamp': reply.timestamp,
+                       'user': user_summary(reply.user)}
+
+    return stream_page('forum/thread.html', thread=thread, replies=replies(), reply_count=reply_count)
 
 @app.route('/forum/new/<int:section_id>', methods=['GET', 'POST'])
 @login_required
@@ -566,6 +3801,7 @@ def new_post(section_id):
         )
         db_session.add(thread)
         db_session.commit()
+        stats_counters.incr('forum_threads', section_id=section_id)
         
         log_admin_action(f"用户创建新帖: {current_user.username} - {title}")
         return redirect(url_for('forum_thread', thread_id=thread.id))
@@ -599,6 +3835,7 @@ def reply_post():
     )
     db_session.add(reply)
     db_session.commit()
+    stats_counters.incr('forum_replies', section_id=thread.section_id)
     
     log_admin_action(f"用户回复帖子: {current_user.username} - 帖子ID: {thread_id}")
     # 只返回原始内容，前端负责渲染
@@ -621,11 +3858,13 @@ def admin_index():
     if not current_user.is_admin():  # 只有管理员才能访问
         abort(403)
     
-    # 获取统计信息
-    user_count = db_session.query(User).count()
-    online_count = 1  # 简化实现，实际应查询最近活动的用户
-    chat_messages_count = db_session.query(ChatMessage).count()
-    forum_posts_count = db_session.query(ForumThread).count() + db_session.query(ForumReply).count()
+    # 获取统计信息（增量维护的计数器，后台定期校准）
+    stats_counters.ensure_loaded()
+    totals = stats_counters.snapshot()['totals']
+    user_count = totals['users']
+    online_count = count_online_users()
+    chat_messages_count = totals['chat_messages']
+    forum_posts_count = totals['forum_threads'] + totals['forum_replies']
     
     # 获取系统信息
     python_version = sys.version.split()[0]
@@ -651,8 +3890,9 @@ def user_management():
     if not current_user.is_admin():
         abort(403)
     
-    users = db_session.query(User).all()
-    return render_template('admin/users.html', users=users)
+    # 用户列表由页面通过 /api/admin/users 分页加载
+    return render_template('admin/users.html',
+                           page_size=app.config.get('ADMIN_USER_PAGE_SIZE', 50))
 
 @app.route('/admin/chat')
 @login_required
@@ -679,11 +3919,18 @@ def file_manager_view():
         abort(403)
     
     path = request.args.get('path', '')
+    page_size = app.config.get('FILE_MANAGER_PAGE_SIZE', 200)
+    page = max(1, request.args.get('page', 1, type=int))
     try:
-        items = list_directory(path)
+        items, total = list_directory(path, offset=(page - 1) * page_size, limit=page_size)
         return render_template('admin/file_manager.html', 
                               items=items, 
-                              current_path=path)
+                              current_path=path,
+                              page=page,
+                              pages=max(1, (total + page_size - 1) // page_size),
+                              total=total,
+                              edit_max_bytes=app.config.get('FILE_EDIT_MAX_BYTES', 1024 * 1024),
+                              upload_chunk_size=app.config.get('FILE_UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
     except Exception as e:
         flash(f'错误: {str(e)}', 'danger')
         return redirect(url_for('admin_index'))
@@ -696,50 +3943,59 @@ def read_file_view():
     
     path = request.args.get('path', '')
     try:
-        root = Path(__file__).parent
-        full_path = (root / path).resolve()
-        
-        # 安全检查
-        if not str(full_path).startswith(str(root)):
-            raise ValueError("非法路径访问")
+        root, full_path = resolve_managed_path(path)
         
         if not full_path.exists() or full_path.is_dir():
             raise ValueError("文件不存在或为目录")
         
-        # 限制文件大小
-        if full_path.stat().st_size > 1024 * 1024:  # 1MB
-            return jsonify(success=False, message="文件过大，无法在浏览器中编辑"), 400
+        # 大文件不整体读入，由页面通过 download 接口按 Range 分段查看
+        size = full_path.stat().st_size
+        if size > app.config.get('FILE_EDIT_MAX_BYTES', 1024 * 1024):
+            log_admin_action(f"查看大文件: {path}")
+            return jsonify(success=True, editable=False, size=size, content=None)
         
         with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
             content = f.read()
         
         log_admin_action(f"读取文件: {path}")
-        return jsonify(success=True, content=content)
+        return jsonify(success=True, editable=True, size=size, content=content)
     except Exception as e:
         log_admin_action(f"读取文件失败: {path} - {str(e)}")
         return jsonify(success=False, message=str(e)), 400
 
+@app.route('/admin/file_manager/download')
+@login_required
+def download_file_view():
+    if not current_user.is_admin():
+        abort(403)
+    
+    path = request.args.get('path', '')
+    try:
+        root, full_path = resolve_managed_path(path)
+        if not full_path.is_file():
+            raise ValueError("文件不存在或为目录")
+    except Exception as e:
+        return jsonify(success=False, message=str(e)), 400
+    
+    # 分段请求只记录第一次
+    if 'Range' not in request.headers:
+        log_admin_action(f"下载文件: {path}")
+    # conditional=True 时由 werkzeug 处理 Range/If-Range 并按块流式发送
+    return send_file(full_path, conditional=True,
+                     as_attachment=request.args.get('attachment') == '1')
+
 @app.route('/admin/file_manager/write', methods=['POST'])
 @login_required
 def write_file_view():
     if not current_user.is_admin():
         abort(403)
     
-    path = request.form.get('path', '')
-    content = request.form.get('content', '')
+    # 内容为原始请求体，直接流式写入临时文件后替换
+    path = request.args.get('path', '')
     
     try:
-        root = Path(__file__).parent
-        full_path = (root / path).resolve()
-        
-        # 安全检查
-        if not str(full_path).startswith(str(root)):
-            raise ValueError("非法路径访问")
-        
-        # 限制文件类型
-        disallowed_extensions = ['.pyc', '.db', '.sqlite', '.exe', '.bat', '.sh']
-        if any(full_path.name.lower().endswith(ext) for ext in disallowed_extensions):
-            raise ValueError(f"禁止修改此类文件: {full_path.name}")
+        root, full_path = resolve_managed_path(path)
+        check_writable_path(root, full_path)
         
         # 备份原文件
         backup_path = None
@@ -750,8 +4006,16 @@ def write_file_view():
         # 确保目录存在
         full_path.parent.mkdir(parents=True, exist_ok=True)
         
-        with open(full_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        fd, tmp_path = tempfile.mkstemp(dir=full_path.parent, prefix=f'.{full_path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(request.stream, f, COPY_BUFFER_SIZE)
+            if backup_path:
+                shutil.copymode(backup_path, tmp_path)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
         
         log_admin_action(f"修改文件: {path}" + (f", 备份已创建: {backup_path}" if backup_path else ""))
         return jsonify(success=True, message="文件已保存")
@@ -759,6 +4023,48 @@ def write_file_view():
         log_admin_action(f"修改文件失败: {path} - {str(e)}")
         return jsonify(success=False, message=str(e)), 400
 
+@app.route('/admin/file_manager/upload', methods=['GET', 'POST'])
+@login_required
+def upload_file_view():
+    if not current_user.is_admin():
+        abort(403)
+    
+    path = request.args.get('path', '')
+    try:
+        root, full_path = resolve_managed_path(path)
+        check_writable_path(root, full_path)
+        part_path = upload_part_path(full_path)
+        received = part_path.stat().st_size if part_path.exists() else 0
+        
+        # GET 查询已接收的字节数，用于断点续传
+        if request.method == 'GET':
+            return jsonify(success=True, offset=received)
+        
+        # offset=0 表示重新开始，其余分块必须紧接已接收的数据
+        offset = request.args.get('offset', 0, type=int)
+        if offset and offset != received:
+            return jsonify(success=False, message="分块偏移量与已接收数据不一致", offset=received), 409
+        
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            shutil.copyfileobj(request.stream, f, COPY_BUFFER_SIZE)
+            received = f.tell()
+        
+        if request.args.get('final') != '1':
+            return jsonify(success=True, offset=received, done=False)
+        
+        backup_path = None
+        if full_path.exists():
+            backup_path = full_path.with_suffix(full_path.suffix + '.bak')
+            os.replace(full_path, backup_path)
+        os.replace(part_path, full_path)
+        
+        log_admin_action(f"上传文件: {path} ({received} 字节)" + (f", 备份已创建: {backup_path}" if backup_path else ""))
+        return jsonify(success=True, offset=received, done=True, message="文件已上传")
+    except Exception as e:
+        log_admin_action(f"上传文件失败: {path} - {str(e)}")
+        return jsonify(success=False, message=str(e)), 400
+
 # API端点
 @app.route('/api/admin/system-info')
 @login_required
@@ -781,7 +4087,12 @@ def get_system_info():
             'memory_usage': memory_usage,
             'server_time': datetime.now().isoformat(),
             'python_version': sys.version,
-            'flask_version': '2.3.2'
+            'flask_version': '2.3.2',
+            'io_executor': io_executor.stats(),
+            'user_cache': user_cache.stats(),
+            'activity_tracker': activity_tracker.stats(),
+            'audit_logger': audit_logger.stats(),
+            'log_archiver': log_archiver.stats()
         })
     except Exception as e:
         log_admin_action(f"获取系统信息失败: {str(e)}")
@@ -800,6 +4111,7 @@ def clear_cache():
     try:
         # 清除数据库查询缓存
         db_session.expire_all()
+        user_cache.clear()
         
         log_admin_action("管理员清除了系统缓存")
         return jsonify(success=True, message="缓存清除成功")
@@ -814,15 +4126,10 @@ def restart_server():
         return jsonify(success=False, message="权限不足"), 403
     
     try:
-        log_admin_action("管理员请求重启服务器")
-        
-        # 在新线程中重启服务器，给客户端响应
-        def restart():
-            time.sleep(2)  # 等待响应发送
-            os._exit(0)  # 强制退出，由调试模式自动重启
-        
-        threading.Thread(target=restart).start()
+        if not lifecycle.request(restart=True, reason=f"管理员 {current_user.username}"):
+            return jsonify(success=False, message="服务器正在重启或关停"), 409
         
+        log_admin_action("管理员请求重启服务器")
         return jsonify(success=True, message="服务器正在重启")
     except Exception as e:
         log_admin_action(f"重启服务器失败: {str(e)}")
@@ -851,27 +4158,59 @@ def backup_database():
         log_admin_action(f"数据库备份失败: {str(e)}")
         return jsonify(success=False, message=f"数据库备份失败: {str(e)}"), 500
 
-@app.route('/api/admin/system-log')
-@login_required
-def get_system_log():
-    if not current_user.is_admin():
-        return jsonify(success=False, message="权限不足"), 403
-    
+def read_log_page(reader, action):
+    """按请求参数分页读取日志，供系统日志与操作日志接口共用"""
     try:
-        logs = get_recent_logs(50)
+        limit = min(request.args.get('limit', 50, type=int), 500)
+        levels = [level for level in request.args.get('level', '').split(',') if level]
+        since = request.args.get('since')
+        until = request.args.get('until')
+
+        logs, next_cursor = io_executor.run(
+            reader.read,
+            limit=limit,
+            levels=levels,
+            since=datetime.fromisoformat(since) if since else None,
+            until=datetime.fromisoformat(until) if until else None,
+            text=request.args.get('q'),
+            cursor=request.args.get('cursor')
+        )
+        logs.reverse()  # 按时间升序返回
+
         return jsonify({
             'success': True,
             'logs': [{
                 'timestamp': log.timestamp.isoformat(),
+                'level': log.level,
+                'logger': log.logger,
                 'message': log.message
-            } for log in logs]
+            } for log in logs],
+            'next_cursor': next_cursor
         })
+    except ValueError as e:
+        return jsonify(success=False, message=f"参数错误: {str(e)}"), 400
     except Exception as e:
         return jsonify({
             'success': False,
-            'message': f"获取系统日志失败: {str(e)}"
+            'message': f"{action}失败: {str(e)}"
         }), 500
 
+@app.route('/api/admin/system-log')
+@login_required
+def get_system_log():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+    
+    return read_log_page(log_reader, "获取系统日志")
+
+@app.route('/api/admin/audit-log')
+@login_required
+def get_audit_log():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+    
+    return read_log_page(audit_log_reader, "获取操作日志")
+
 @app.route('/api/admin/optimize-database', methods=['POST'])
 @login_required
 def optimize_database():
@@ -879,19 +4218,153 @@ def optimize_database():
         return jsonify(success=False, message="权限不足"), 403
     
     try:
-        db_path = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("VACUUM")
-        conn.commit()
-        conn.close()
-        
-        log_admin_action("数据库优化成功")
-        return jsonify(success=True, message="数据库优化成功")
+        # 不在请求中执行整库 VACUUM，交给后台维护任务分步处理
+        data = request.get_json(silent=True) or {}
+        full_vacuum = bool(data.get('full'))
+        db_maintenance.start()
+        db_maintenance.request_run(full_vacuum=full_vacuum)
+
+        log_admin_action("已提交数据库优化任务" + ("（整库 VACUUM）" if full_vacuum else ""))
+        return jsonify(success=True, message="数据库优化任务已提交，将在后台执行",
+                       report=db_maintenance.report())
     except Exception as e:
         log_admin_action(f"数据库优化失败: {str(e)}")
         return jsonify(success=False, message=f"数据库优化失败: {str(e)}"), 500
 
+@app.route('/api/admin/db-maintenance')
+@login_required
+def get_db_maintenance():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    try:
+        return jsonify(success=True, report=db_maintenance.report())
+    except Exception as e:
+        return jsonify(success=False, message=f"获取数据库维护状态失败: {str(e)}"), 500
+
+# 反向代理转发时添加的请求头
+PROXY_HEADERS = ('X-Forwarded-For', 'X-Real-IP', 'Forwarded')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式指标：管理员或携带 METRICS_TOKEN 可访问
+
+    开启 METRICS_ALLOW_LOCAL 时本机直连也可访问；经反向代理转发的请求来源同样是本机，
+    带代理头时仍须提供令牌。
+    """
+    token = app.config.get('METRICS_TOKEN')
+    authorized = (
+        (current_user.is_authenticated and current_user.is_admin()) or
+        (token and request.headers.get('Authorization') == f'Bearer {token}') or
+        (app.config.get('METRICS_ALLOW_LOCAL', False) and request.remote_addr in ('127.0.0.1', '::1') and
+         not any(header in request.headers for header in PROXY_HEADERS))
+    )
+    if not authorized:
+        abort(403)
+
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.route('/api/admin/workers')
+@login_required
+def get_workers():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    try:
+        return jsonify(success=True, **load_reporter.report())
+    except Exception as e:
+        return jsonify(success=False, message=f"获取工作进程状态失败: {str(e)}"), 500
+
+@app.route('/api/admin/hub-lag')
+@login_required
+def get_hub_lag():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    return jsonify(success=True, report=hub_monitor.report())
+
+@app.route('/api/admin/profile', methods=['POST'])
+@login_required
+def run_profiler():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    seconds = request.args.get('seconds', 5, type=float)
+    include_greenlets = request.args.get('greenlets', '0') == '1'
+    if profiler.running:
+        return jsonify(success=False, message="已有采样正在进行"), 409
+
+    try:
+        log_admin_action(f"开始性能采样: {seconds} 秒")
+        # 采样循环在IO线程池的原生线程中运行，当前协程等待期间不占用 hub
+        result = io_executor.run(profiler.capture, seconds, include_greenlets)
+        if result is None:
+            return jsonify(success=False, message="已有采样正在进行"), 409
+
+        stacks, samples = result
+        body = ''.join(f"{stack} {count}\n"
+                       for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+        response = make_response(body)
+        response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        response.headers['Content-Disposition'] = 'attachment; filename=profile.collapsed'
+        response.headers['X-Profile-Samples'] = str(samples)
+        return response
+    except Exception as e:
+        log_admin_action(f"性能采样失败: {str(e)}")
+        return jsonify(success=False, message=f"性能采样失败: {str(e)}"), 500
+
+@app.route('/api/admin/stats')
+@login_required
+def get_admin_stats():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    try:
+        stats_counters.ensure_loaded()
+        data = stats_counters.snapshot()
+        data['online_count'] = count_online_users()
+        return jsonify(success=True, stats=data)
+    except Exception as e:
+        return jsonify(success=False, message=f"获取统计信息失败: {str(e)}"), 500
+
+@app.route('/api/admin/sql-profiles')
+@login_required
+def get_sql_profiles():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    try:
+        profiles = [profile.to_dict() for profile in list(query_profiles)]
+
+        # 按请求/事件名称汇总
+        summary = {}
+        for item in profiles:
+            key = f"{item['kind']}:{item['name']}"
+            entry = summary.setdefault(key, {
+                'kind': item['kind'], 'name': item['name'], 'calls': 0,
+                'queries': 0, 'db_time_ms': 0.0, 'n_plus_one_calls': 0
+            })
+            entry['calls'] += 1
+            entry['queries'] += item['query_count']
+            entry['db_time_ms'] += item['db_time_ms']
+            if item['n_plus_one']:
+                entry['n_plus_one_calls'] += 1
+
+        for entry in summary.values():
+            entry['avg_queries'] = round(entry['queries'] / entry['calls'], 2)
+            entry['avg_db_time_ms'] = round(entry['db_time_ms'] / entry['calls'], 3)
+            entry['db_time_ms'] = round(entry['db_time_ms'], 3)
+
+        return jsonify(
+            success=True,
+            summary=sorted(summary.values(), key=lambda e: e['db_time_ms'], reverse=True),
+            recent=profiles[-request.args.get('limit', 50, type=int):]
+        )
+    except Exception as e:
+        return jsonify(success=False, message=f"获取SQL统计失败: {str(e)}"), 500
+
 @app.route('/api/admin/shutdown', methods=['POST'])
 @login_required
 def shutdown_server():
@@ -902,14 +4375,10 @@ def shutdown_server():
         data = request.get_json()
         reason = data.get('reason', '未指定原因')
         
-        log_admin_action(f"服务器关停，原因: {reason}")
-        
-        # 在新线程中关闭服务器
-        def shutdown():
-            time.sleep(2)
-            os._exit(0)
+        if not lifecycle.request(restart=False, reason=reason):
+            return jsonify(success=False, message="服务器正在重启或关停"), 409
         
-        threading.Thread(target=shutdown).start()
+        log_admin_action(f"服务器关停，原因: {reason}")
         
         return jsonify(success=True, message="服务器正在关停", reason=reason)
     except Exception as e:
@@ -939,6 +4408,8 @@ def update_user(user_id):
             user.badge = data['badge']
         
         db_session.commit()
+        user_cache.invalidate(user_id)
+        resource_versions.bump('users')
         log_admin_action(f"更新了用户 {user.username} 的信息")
         return jsonify(success=True, message="用户信息更新成功")
     except Exception as e:
@@ -959,12 +4430,19 @@ def delete_user(user_id):
             return jsonify(success=False, message="不能删除超级管理员"), 400
         
         # 删除用户相关数据
+        record_chat_tombstones(db_session.query(ChatMessage).filter_by(user_id=user_id))
         db_session.query(ChatMessage).filter_by(user_id=user_id).delete()
+        db_session.query(ChatReadMarker).filter_by(user_id=user_id).delete()
         db_session.query(ForumThread).filter_by(user_id=user_id).delete()
         db_session.query(ForumReply).filter_by(user_id=user_id).delete()
         
         db_session.delete(user)
         db_session.commit()
+        user_cache.invalidate(user_id)
+        resource_versions.bump('users')
+        # 连带删除了消息和帖子，分房间/分区计数交给后台校准
+        stats_counters.incr('users', -1)
+        stats_counters.request_reconcile()
         
         log_admin_action(f"删除了用户 {user.username}")
         return jsonify(success=True, message="用户删除成功")
@@ -995,6 +4473,7 @@ def update_user_role(user_id):
         old_role = user.role
         user.role = new_role
         db_session.commit()
+        user_cache.invalidate(user_id)
         
         log_admin_action(f"修改用户 {user.username} 的角色: {old_role} -> {new_role}")
         return jsonify(success=True, message=f"用户 {user.username} 的角色已更新为 {new_role}")
@@ -1003,6 +4482,48 @@ def update_user_role(user_id):
         return jsonify(success=False, message=f"更新用户角色失败: {str(e)}"), 500
 
 
+@app.route('/api/admin/users', methods=['GET'])
+@login_required
+def list_users():
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    try:
+        limit = max(1, min(request.args.get('limit', app.config.get('ADMIN_USER_PAGE_SIZE', 50), type=int), 200))
+        sort = request.args.get('sort', 'id')
+        if sort not in USER_SORT_COLUMNS:
+            raise ValueError(f"不支持的排序字段 {sort}")
+        order = request.args.get('order')
+        if order not in (None, '', 'asc', 'desc'):
+            raise ValueError(f"不支持的排序方向 {order}")
+
+        users, next_cursor = query_user_page(
+            q=request.args.get('q', '').strip() or None,
+            sort=sort,
+            descending=(order == 'desc') if order else None,
+            cursor=request.args.get('cursor'),
+            limit=limit
+        )
+
+        # 合并尚未写回数据库的活动时间
+        pending = activity_tracker.pending()
+        result = []
+        for user in users:
+            last_seen = pending.get(user.id, user.last_seen)
+            result.append({
+                'id': user.id,
+                'username': user.username,
+                'nickname': user.nickname or user.username,
+                'role': user.role,
+                'last_seen': last_seen.strftime('%Y-%m-%d %H:%M:%S') if last_seen else None
+            })
+
+        return jsonify(success=True, users=result, next_cursor=next_cursor)
+    except ValueError as e:
+        return jsonify(success=False, message=f"参数错误: {str(e)}"), 400
+    except Exception as e:
+        return jsonify(success=False, message=f"获取用户列表失败: {str(e)}"), 500
+
 @app.route('/api/admin/users', methods=['POST'])
 @login_required
 def create_user():
@@ -1046,6 +4567,7 @@ def create_user():
         
         db_session.add(new_user)
         db_session.commit()
+        stats_counters.incr('users')
 
         log_admin_action(f"创建了新用户: {username}")
         return jsonify(success=True, message=f"用户 {username} 创建成功", user_id=new_user.id)
@@ -1122,8 +4644,11 @@ def delete_chat_room(room_id):
             return jsonify(success=False, message="不能删除默认聊天室"), 400
 
         room_name = room.name
+        db_session.query(ChatReadMarker).filter_by(room_id=room_id).delete()
         db_session.delete(room)
         db_session.commit()
+        stats_counters.discard_room(room_id)
+        resource_versions.bump(f'room:{room_id}')
 
         log_admin_action(f"删除了聊天室: {room_name}")
         return jsonify(success=True, message=f"聊天室 {room_name} 删除成功")
@@ -1154,8 +4679,14 @@ def delete_chat_messages():
             before_datetime = datetime.fromisoformat(before_date.replace('Z', '+00:00'))
             query = query.filter(ChatMessage.timestamp < before_datetime)
 
+        record_chat_tombstones(query)
         deleted_count = query.delete()
         db_session.commit()
+        if room_id and not before_date:
+            stats_counters.incr('chat_messages', -deleted_count, room_id=room_id)
+        else:
+            stats_counters.request_reconcile()
+        resource_versions.bump(f'room:{room_id}' if room_id else 'rooms')
 
         log_admin_action(f"清空聊天消息: {deleted_count} 条消息被删除")
         return jsonify(success=True, message=f"成功删除 {deleted_count} 条聊天消息")
@@ -1295,6 +4826,7 @@ def delete_forum_section(section_id):
         db_session.query(ForumThread).filter_by(section_id=section_id).delete()
         db_session.delete(section)
         db_session.commit()
+        stats_counters.request_reconcile()
         
         log_admin_action(f"删除了贴吧分区 {section.name}")
         return jsonify(success=True, message="贴吧分区删除成功")
@@ -1323,58 +4855,220 @@ def delete_forum_post(post_id):
             message = "删除了贴吧回复"
         
         db_session.commit()
+        stats_counters.request_reconcile()
         log_admin_action(message)
         return jsonify(success=True, message="删除成功")
     except Exception as e:
         return jsonify(success=False, message=f"删除失败: {str(e)}"), 500
 
 # 文件管理工具函数
-def list_directory(path):
-    """列出目录内容（安全版）"""
+FILE_MANAGER_SKIP = ['__pycache__']
+FILE_MANAGER_READONLY = ['logs', 'backups']  # 可浏览但不可修改
+FILE_WRITE_DISALLOWED = ['.pyc', '.db', '.sqlite', '.exe', '.bat', '.sh']
+COPY_BUFFER_SIZE = 64 * 1024
+
+def resolve_managed_path(path):
+    """解析文件管理路径，返回 (根目录, 绝对路径)"""
     root = Path(__file__).parent
     full_path = (root / path).resolve()
     
     # 安全检查
     if not str(full_path).startswith(str(root)):
         raise ValueError("非法路径访问")
+    return root, full_path
+
+def check_writable_path(root, full_path):
+    """检查文件是否允许修改"""
+    # 限制文件类型
+    if any(full_path.name.lower().endswith(ext) for ext in FILE_WRITE_DISALLOWED):
+        raise ValueError(f"禁止修改此类文件: {full_path.name}")
+    
+    if full_path.is_dir():
+        raise ValueError("目标是目录")
+    
+    parts = full_path.relative_to(root).parts
+    if not parts or parts[0] in FILE_MANAGER_READONLY:
+        raise ValueError(f"禁止修改此目录下的文件: {parts[0] if parts else '/'}")
+
+def upload_part_path(full_path):
+    """分块上传的临时文件，以点开头不出现在列表中"""
+    return full_path.with_name(f'.{full_path.name}.part')
+
+def list_directory(path, offset=0, limit=None):
+    """列出目录内容（安全版），返回 (当前页条目, 总条目数)
+
+    os.scandir 自带条目类型并缓存 stat 结果，只对当前页的文件取一次 stat。
+    """
+    root, full_path = resolve_managed_path(path)
     
-    if not full_path.exists() or not full_path.is_dir():
+    if not full_path.is_dir():
         raise ValueError("目录不存在")
     
-    items = []
-    for item in full_path.iterdir():
+    with os.scandir(full_path) as it:
         # 跳过隐藏文件和特定目录
-        if item.name.startswith('.') or item.name in ['__pycache__', 'logs', 'backups']:
-            continue
-        
-        rel_path = item.relative_to(root)
+        entries = [entry for entry in it
+                   if not entry.name.startswith('.') and entry.name not in FILE_MANAGER_SKIP]
+    
+    # 目录在前，按名称排序
+    entries.sort(key=lambda entry: (not entry.is_dir(), entry.name.lower()))
+    page = entries[offset:offset + limit] if limit else entries[offset:]
+    
+    items = []
+    for entry in page:
+        is_dir = entry.is_dir()
+        stat = None if is_dir else entry.stat()
         items.append({
-            'name': item.name,
-            'is_dir': item.is_dir(),
-            'path': str(rel_path),
-            'size': item.stat().st_size if item.is_file() else 0
+            'name': entry.name,
+            'is_dir': is_dir,
+            'path': Path(entry.path).relative_to(root).as_posix(),
+            'size': stat.st_size if stat else 0,
+            'mtime': datetime.fromtimestamp(stat.st_mtime) if stat else None
         })
     
-    return items
+    return items, len(entries)
+
+# 心跳
+class HeartbeatBroadcaster:
+    """服务器驱动的心跳，取代客户端的各个轮询定时器
+
+    每个进程一个后台任务，每个周期向本进程的全部Socket连接广播一次 heartbeat 事件，
+    携带全局在线人数、在线名单的变化和各房间的消息变动数；没有变化的部分不发送。
+    周期随负载（hub 调度延迟、阻塞IO排队、连接数）在 interval 与 max_interval 之间伸缩，
+    新连接在 connect 时单独收到一次完整状态。
+    """
+
+    def __init__(self, interval, max_interval, client_target, lag_target):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.client_target = client_target
+        self.lag_target = lag_target
+        self.current_interval = interval
+        self.online = {}  # user_id -> 用户信息（上个周期）
+        self.room_versions = {}
+        self.started = False
+        self.ticks = 0
+        self.last_tick = None
+
+    def next_interval(self):
+        """根据当前负载计算下一个周期"""
+        clients = user_cache.stats()['socket_snapshots']
+        load = max(hub_monitor.lag / self.lag_target,
+                   clients / self.client_target,
+                   io_executor.waiting / max(io_executor.size, 1))
+        return min(self.max_interval, self.interval * max(1.0, load))
+
+    @staticmethod
+    def _presence():
+        return {user['id']: user for user in get_online_users(None)}
+
+    def _room_activity(self):
+        """上个周期以来各房间的消息变动数（新消息和删除，经工作进程总线汇总）"""
+        versions = resource_versions.versions('room:')
+        activity = {room: version - self.room_versions.get(room, 0)
+                    for room, version in versions.items() if version != self.room_versions.get(room, 0)}
+        self.room_versions = versions
+        return activity
+
+    def state(self):
+        """完整状态，连接建立时发送"""
+        online = self.online if self.ticks else run_db_task(self._presence)
+        return {
+            'online_count': len(online),
+            'presence': {'users': list(online.values())},
+            'interval': self.current_interval
+        }
+
+    def tick(self):
+        """计算本周期的变化并广播；本进程没有连接时跳过"""
+        activity = self._room_activity()
+        if not user_cache.stats()['socket_snapshots']:
+            return
+        online = run_db_task(self._presence)
+        joined = [user for user_id, user in online.items() if self.online.get(user_id) != user]
+        left = [user_id for user_id in self.online if user_id not in online]
+        self.online = online
+        self.ticks += 1
+        self.last_tick = datetime.now()
+
+        payload = {'online_count': len(online), 'interval': self.current_interval}
+        if joined or left:
+            payload['presence'] = {'joined': joined, 'left': left}
+        if activity:
+            payload['activity'] = activity
+        # 各进程只发给自己的连接，不经总线转发
+        socketio.emit('heartbeat', payload, ignore_queue=True)
+
+    def _worker(self):
+        while True:
+            socketio.sleep(self.current_interval)
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"心跳广播失败: {str(e)}")
+            self.current_interval = self.next_interval()
+
+    def start(self):
+        """启动心跳任务（首个Socket连接建立时调用）"""
+        if self.started:
+            return
+        self.started = True
+        self.room_versions = resource_versions.versions('room:')
+        socketio.start_background_task(self._worker)
+
+    def stats(self):
+        return {
+            'interval': round(self.current_interval, 2),
+            'ticks': self.ticks,
+            'last_tick': self.last_tick.isoformat() if self.last_tick else None,
+            'online': len(self.online)
+        }
+
+heartbeat = HeartbeatBroadcaster(app.config.get('HEARTBEAT_INTERVAL', 10),
+                                 app.config.get('HEARTBEAT_MAX_INTERVAL', 60),
+                                 app.config.get('HEARTBEAT_CLIENT_TARGET', 500),
+                                 app.config.get('HEARTBEAT_LAG_TARGET', 0.05))
 
 # Socket.IO 事件处理
 @socketio.on('connect')
+@track_event('connect')
 def handle_connect():
-    """用户连接"""
-    if not current_user.is_authenticated:
+    """用户连接
+
+    能登录就说明数据库已由 HTTP 请求或启动器初始化，这里不再调用 ensure_database()；
+    用户从会话中的ID绑定，缓存未命中时在IO线程池中查询。
+    """
+    if lifecycle.draining:
+        return False  # 正在重启或关停
+    
+    user_id = session_user_id()
+    if user_id is None:
         return False  # 拒绝未认证用户
     
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db_session.commit()
+    # 绑定连接级用户快照，后续事件无需再查询用户
+    user = user_cache.bind_socket(request.sid, user_id)
+    if user is None:
+        return False  # 用户已被删除
+    activity_tracker.touch(user.id)
     
     session['receive_count'] = session.get('receive_count', 0) + 1
     emit('my_response', {'count': session['receive_count']})
+    
+    # 新连接先收到一次完整状态，之后由心跳推送变化
+    heartbeat.start()
+    emit('heartbeat', heartbeat.state())
+
+@socketio.on('disconnect')
+@track_event('disconnect')
+def handle_disconnect():
+    """用户断开连接"""
+    user_cache.unbind_socket(request.sid)
 
 @socketio.on('join')
+@track_event('join')
 def on_join(data):
     """加入聊天室"""
-    if not current_user.is_authenticated:
+    user = get_socket_user()
+    if user is None:
         return
     
     room_id = data.get('room')
@@ -1385,8 +5079,7 @@ def on_join(data):
     join_room(room_name)
     
     # 更新在线状态
-    current_user.last_seen = datetime.utcnow()
-    db_session.commit()
+    activity_tracker.touch(user.id)
     
     # 不再广播用户加入（取消进入聊天室的提示）
     # emit('status', {
@@ -1395,9 +5088,10 @@ def on_join(data):
     # }, room=room_name)
 
 @socketio.on('leave')
+@track_event('leave')
 def on_leave(data):
     """离开聊天室"""
-    if not current_user.is_authenticated:
+    if get_socket_user() is None:
         return
     
     room_id = data.get('room')
@@ -1414,16 +5108,18 @@ def on_leave(data):
     # }, room=room_name)
 
 @socketio.on('send_message')
+@track_event('send_message')
 def handle_message(data):
     """处理发送消息"""
-    if not current_user.is_authenticated:
+    user = get_socket_user()
+    if user is None:
         return
     
-    room_id = data.get('room_id')
+    room_id = parse_room_id(data.get('room_id'))
     content = data.get('message', '').strip()
     
     # 验证
-    if not room_id or not content:
+    if room_id is None or not content:
         emit('error', {'message': '参数错误'})
         return
     
@@ -1432,35 +5128,67 @@ def handle_message(data):
         emit('error', {'message': '消息过长'})
         return
     
+    if not run_db_task(chat_room_exists, room_id):
+        emit('error', {'message': '聊天室不存在'})
+        return
+    
     # XSS基础防护
     content = sanitize_content(content)
     
     # 保存到数据库
-    message = ChatMessage(
-        content=content,  # 存储原始Markdown
-        user_id=current_user.id,
-        room_id=room_id
-    )
-    db_session.add(message)
-    db_session.commit()
+    message_id, timestamp = run_db_task(save_chat_message, user.id, room_id, content)
+    resource_versions.bump(f'room:{room_id}')
     
     # 发送消息给房间内其他所有人（不包括发送者自己），避免重复显示
     room_name = f"room_{room_id}"
+    socketio_fanout.observe(max(room_size(room_name) - 1, 0))
     emit('message', {
-        'id': message.id,
-        'content': message.content,  # 原始Markdown
-        'timestamp': message.timestamp.isoformat(),
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'nickname': current_user.nickname or current_user.username,
-        'color': current_user.color,
-        'badge': current_user.badge
+        'id': message_id,
+        'content': content,  # 原始Markdown
+        'timestamp': timestamp.isoformat(),
+        'user_id': user.id,
+        'username': user.username,
+        'nickname': user.nickname or user.username,
+        'color': user.color,
+        'badge': user.badge
     }, room=room_name, include_self=False)
+    # 房间列表页据此增加未读数
+    emit('room_message', {'room_id': room_id, 'message_id': message_id, 'user_id': user.id}, room='room_list')
+
+@socketio.on('watch_rooms')
+@track_event('watch_rooms')
+def handle_watch_rooms(data):
+    """房间列表页订阅各房间的新消息和自己的已读变化"""
+    user = get_socket_user()
+    if user is None:
+        return
+    join_room('room_list')
+    join_room(f"user_{user.id}")
+
+@socketio.on('mark_read')
+@track_event('mark_read')
+def handle_mark_read(data):
+    """推进已读位置，并把新的未读数推送给该用户的其他页面"""
+    user = get_socket_user()
+    if user is None:
+        return
+    
+    try:
+        room_id = int(data.get('room_id'))
+        message_id = int(data.get('message_id'))
+    except (TypeError, ValueError):
+        return
+    
+    unread = run_db_task(mark_room_read, user.id, room_id, message_id)
+    if unread is None:
+        return
+    emit('room_read', {'room_id': room_id, 'unread': unread}, room=f"user_{user.id}")
 
 @socketio.on('get_online_users')
+@track_event('get_online_users')
 def handle_get_online_users(data):
     """获取在线用户列表"""
-    if not current_user.is_authenticated:
+    if get_socket_user() is None:
         return
     
     room_id = data.get('room_id')
@@ -1468,22 +5196,20 @@ def handle_get_online_users(data):
         return
     
     # 获取在线用户
-    online_users = get_online_users(room_id)
+    online_users = run_db_task(get_online_users, room_id)
     
     emit('online_users', {'users': online_users})
 
 
 @socketio.on('get_global_online_count')
+@track_event('get_global_online_count')
 def handle_get_global_online_count(data):
     """获取全局在线用户数"""
-    if not current_user.is_authenticated:
+    if get_socket_user() is None:
         return
     
-    from datetime import datetime, timedelta
-    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
     # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
+    online_count = run_db_task(online_count_cache.get)
     
     # 发送全局在线人数到客户端
     emit('global_online_count', {'count': online_count})
@@ -1497,13 +5223,8 @@ def inject_user():
 @app.context_processor
 def inject_online_count():
     """注入在线用户数到模板"""
-    from datetime import datetime, timedelta
-    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
-    
-    return dict(online_count=online_count)
+    # 模板读取时才查询最近活动的用户数
+    return dict(online_count=lazy_context_value(count_online_users))
 
 # 错误处理
 @app.errorhandler(403)
@@ -1553,9 +5274,212 @@ def init_db():
     db_session.commit()
     log_admin_action("数据库初始化完成")
 
+def setup_database():
+    """建表、迁移并写入初始数据"""
+    Base.metadata.create_all(bind=engine)
+    update_database_schema()
+    ensure_admin_user()
+    init_db()
+    # 释放初始化期间的连接，之后 fork 出的工作进程不会共享同一个 SQLite 句柄
+    db_session.remove()
+    engine.dispose()
+
+_database_ready = False
+_database_lock = threading.Lock()
+
+def ensure_database():
+    """首次使用时执行 setup_database，之后直接返回"""
+    global _database_ready
+    if _database_ready or not app.config.get('AUTO_INIT_DB', True):
+        return
+    with _database_lock:
+        if not _database_ready:
+            setup_database()
+            _database_ready = True
+
+@app.before_request
+def ensure_database_before_request():
+    ensure_database()
+
+# 应用工厂
+_app_configured = False
+
+def create_app(config=None):
+    """配置并返回应用
+
+    导入本模块不创建目录、不连接数据库；日志在这里初始化，建表、迁移和
+    初始数据由 `flask --app app init-db` 或首次请求时的 ensure_database() 完成。
+    config 中的 SQLALCHEMY_DATABASE_URI 与当前引擎不同时重建引擎。
+    配置了 TEMPLATE_CACHE_DIR 时模板字节码缓存在该目录，新进程首次渲染无需编译。
+    可重复调用，日志只配置一次。
+    """
+    global engine, _app_configured
+    if config:
+        app.config.update(config)
+    if launcher.multi_process():
+        audit_logger.max_bytes = 0  # 由启动器轮转
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if engine.url.render_as_string(hide_password=False) != uri:
+        engine.dispose()
+        engine = create_engine(uri)
+        db_session.remove()
+        db_session.configure(bind=engine)
+
+    # 未显式设置时跟随 DEBUG：调试时直接使用原文件，修改立即生效
+    use_build = app.config.get('STATIC_USE_BUILD')
+    if use_build is None:
+        use_build = not app.config.get('DEBUG')
+    if use_build:
+        static_assets.load()
+    else:
+        static_assets.manifest = {}
+
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+    if cache_dir and app.jinja_env.bytecode_cache is None:
+        cache_dir = Path(app.root_path) / cache_dir
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(cache_dir))
+
+    if not _app_configured:
+        setup_logging()
+        _app_configured = True
+    return app
+
+@app.cli.command('init-db')
+def init_db_command():
+    """建表、迁移并写入初始数据"""
+    create_app()
+    setup_database()
+    click.echo('数据库初始化完成')
+
+@app.cli.command('bench-startup')
+@click.option('--runs', default=5, show_default=True, help='每项测量的次数')
+def bench_startup_command(runs):
+    """在新进程中测量导入、create_app 与首个请求的耗时"""
+    create_app()
+    stages = {
+        'import': "import app",
+        'create_app': "import app; app.create_app()",
+        'first_request': "import app; app.create_app().test_client().get('/login')",
+    }
+    script = ("import json, sys, time; sys.path.insert(0, {root!r}); "
+              "t = time.perf_counter(); {code}; "
+              "print(json.dumps(time.perf_counter() - t))")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for stage, code in stages.items():
+            timings = []
+            for i in range(runs):
+                # 每次使用新的空数据库，首个请求包含建表和初始数据
+                env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp}/bench-{stage}-{i}.db")
+                result = subprocess.run(
+                    [sys.executable, '-c', script.format(root=app.root_path, code=code)],
+                    env=env, capture_output=True, text=True, check=True, cwd=tmp
+                )
+                timings.append(json.loads(result.stdout.strip().splitlines()[-1]) * 1000)
+            timings.sort()
+            click.echo(f"{stage:<14} 最小 {timings[0]:8.1f} ms  中位数 {timings[len(timings) // 2]:8.1f} ms")
+
+def compile_templates():
+    """编译全部模板写入字节码缓存，返回模板名列表"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """预编译模板到字节码缓存（部署时运行）"""
+    create_app()
+    if app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('未配置 TEMPLATE_CACHE_DIR')
+    names = compile_templates()
+    click.echo(f"已编译 {len(names)} 个模板到 {app.config['TEMPLATE_CACHE_DIR']}")
+
+@app.cli.command('bench-ttfb')
+@click.option('--runs', default=3, show_default=True, help='每种模式启动的新进程数')
+@click.option('--repeat', default=20, show_default=True, help='预热后每个页面的请求次数')
+def bench_ttfb_command(runs, repeat):
+    """在新进程中测量各页面首字节时间：从源码编译模板、使用预编译字节码，以及预热后"""
+    create_app()
+    pages = ['/', '/chat', '/chat/1', '/forum', '/forum/section/1', '/profile',
+             '/admin', '/admin/users', '/admin/chat', '/admin/forum', '/admin/file_manager']
+    script = (
+        "import json, sys, time\n"
+        "sys.path.insert(0, {root!r})\n"
+        "import app\n"
+        "a = app.create_app({config!r})\n"
+        "{setup}\n"
+        "c = a.test_client()\n"
+        "c.post('/login', data={{'username': 'admin', 'password': 'admin123'}})\n"
+        "result = {{}}\n"
+        "for path in {pages!r}:\n"
+        "    t = time.perf_counter(); c.get(path); cold = time.perf_counter() - t\n"
+        "    warm = []\n"
+        "    for _ in range({repeat}):\n"
+        "        t = time.perf_counter(); c.get(path); warm.append(time.perf_counter() - t)\n"
+        "    result[path] = [cold, sorted(warm)[len(warm) // 2]]\n"
+        "print(json.dumps(result))\n"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp}/bench.db")
+        base = {'DEBUG': False, 'WTF_CSRF_ENABLED': False, 'TEMPLATE_CACHE_DIR': None}
+        modes = {
+            'source': (base, 'app.setup_database()'),
+            'bytecode': (dict(base, TEMPLATE_CACHE_DIR=f"{tmp}/templates"), 'app.setup_database()'),
+        }
+        # 与部署时相同，先在单独的进程中预编译
+        subprocess.run([sys.executable, '-c', script.format(
+            root=app.root_path, config=modes['bytecode'][0], setup='app.compile_templates(); sys.exit()',
+            pages=pages, repeat=repeat)], env=env, check=True, cwd=tmp, capture_output=True)
+
+        results = {}
+        for mode, (config, setup) in modes.items():
+            runs_result = []
+            for _ in range(runs):
+                output = subprocess.run(
+                    [sys.executable, '-c', script.format(root=app.root_path, config=config, setup=setup,
+                                                          pages=pages, repeat=repeat)],
+                    env=env, capture_output=True, text=True, check=True, cwd=tmp
+                ).stdout
+                runs_result.append(json.loads(output.strip().splitlines()[-1]))
+            results[mode] = {path: sorted(run[path] for run in runs_result)[len(runs_result) // 2]
+                             for path in pages}
+
+    click.echo(f"{'页面':<22}{'首次(源码编译)':>14}{'首次(字节码)':>14}{'预热后':>10}  (ms，取中位数)")
+    for path in pages:
+        click.echo(f"{path:<24}{results['source'][path][0] * 1000:14.2f}"
+                   f"{results['bytecode'][path][0] * 1000:14.2f}"
+                   f"{results['bytecode'][path][1] * 1000:12.2f}")
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """按内容哈希命名 static/css、static/js，生成预压缩文件和 manifest"""
+    manifest = static_assets.build()
+    for name, hashed in manifest.items():
+        click.echo(f"{name} -> {hashed}")
+    click.echo(f"共 {len(manifest)} 个文件，输出到 {static_assets.output}")
+
+@app.cli.command('serve')
+@click.option('--host', default='0.0.0.0', show_default=True)
+@click.option('--port', default=5000, show_default=True)
+@click.option('--workers', default=None, type=int, help='工作进程数，默认取 WORKERS 配置')
+def serve_command(host, port, workers):
+    """多进程运行：同一端口上的多个 eventlet 工作进程，Socket.IO 会话按客户端地址（本机代理转发时取代理头）固定到同一进程"""
+    workers = workers or app.config.get('WORKERS') or os.cpu_count() or 1
+    sys.exit(launcher.run(host, port, workers))
+
 # 主程序
 if __name__ == '__main__':
-    init_db()
+    create_app()
+    setup_database()
     CORS(app, resources={r"/socket.io/*": {"origins": "*"}})
+    log_archiver.start()
+    db_maintenance.start()
+    activity_tracker.start()
+    stats_counters.start()
+    hub_monitor.start()
     logger.info("应用启动成功")
-    socketio.run(app, debug=app.config['DEBUG'])
+    sys.exit(lifecycle.run(debug=app.config['DEBUG']))
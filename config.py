@@ -11,4 +11,95 @@ class Config:
     DEBUG = True  # 用于热重载
     SOCKETIO_ASYNC_MODE = 'eventlet'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB 上传限制
-    ONLINE_TIMEOUT = 300  # 5分钟无活动视为离线
\ No newline at end of file
+    ONLINE_TIMEOUT = 300  # 5分钟无活动视为离线
+
+    # 数据库后台维护
+    DB_MAINTENANCE_INTERVAL = 60  # 维护线程检查间隔（秒）
+    DB_VACUUM_PAGES_PER_STEP = 200  # 每步 incremental_vacuum 回收的页数
+    DB_VACUUM_MAX_STEPS = 50  # 每轮最多执行的步数
+    DB_OPTIMIZE_INTERVAL = 3600  # PRAGMA optimize 间隔（秒）
+    DB_ANALYZE_INTERVAL = 24 * 3600  # ANALYZE 间隔（秒）
+    DB_WRITE_BUSY_THRESHOLD = 20  # 每秒写事务超过该值时暂停维护
+
+    # 阻塞IO线程池（eventlet 模式下用于 sqlite3 / 文件 IO）
+    IO_THREADPOOL_SIZE = 10
+
+    # SQL 性能分析
+    SQL_PROFILING = True  # 记录每个请求/事件的查询数与耗时
+    SQL_SERVER_TIMING = False  # 在响应中添加 Server-Timing 头
+    SQL_NPLUSONE_THRESHOLD = 5  # 同一语句形态重复次数达到该值视为疑似 N+1
+    SQL_SLOW_STATEMENTS = 5  # 每个请求保留的最慢语句数
+    SQL_PROFILE_HISTORY = 200  # 保留最近的统计条数
+
+    # 已认证用户缓存有效期（秒）
+    USER_CACHE_TTL = 60
+
+    # 用户活动时间批量写回间隔（秒）
+    ACTIVITY_FLUSH_INTERVAL = 5
+    # 按ID批量查询时每个 IN (...) 的最大ID数，需低于 SQLite 绑定变量上限
+    SQL_IN_CHUNK_SIZE = 500
+
+    # 系统日志轮转
+    LOG_MAX_BYTES = 10 * 1024 * 1024  # 单个日志文件上限
+    LOG_ARCHIVE_MAX_BYTES = 200 * 1024 * 1024  # 压缩归档总大小上限
+    LOG_ARCHIVE_MAX_DAYS = 30  # 压缩归档保留天数
+    LOG_ARCHIVE_BLOCK_SIZE = 256 * 1024  # 归档内每个 gzip 分块的原始大小，按时间跳转时只解压命中的分块
+    AUDIT_LOG_MAX_BYTES = 10 * 1024 * 1024  # admin.log 轮转大小
+
+    # 管理员操作日志
+    AUDIT_LOG_FORMAT = 'text'  # text 或 json（每行一个JSON对象）
+    AUDIT_LOG_FLUSH_INTERVAL = 1.0  # 后台写入线程等待间隔（秒）
+    AUDIT_LOG_MIRROR_SYSTEM = False  # 是否同时写入 system.log
+
+    # 管理面板统计
+    STATS_RECONCILE_INTERVAL = 600  # 计数器与真实表校准间隔（秒）
+    STATS_SERIES_MINUTES = 60  # 消息速率序列保留的分钟数
+
+    # /metrics 访问控制（管理员登录即可访问）
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 抓取时使用 Authorization: Bearer <token>
+    METRICS_ALLOW_LOCAL = False  # 允许本机直连抓取（带反向代理头的请求仍需令牌）
+
+    # eventlet hub 延迟监控
+    HUB_LAG_INTERVAL = 0.1  # 采样间隔（秒）
+    HUB_LAG_THRESHOLD = 0.25  # 超过该延迟视为阻塞并抓取调用栈（秒）
+    HUB_LAG_INCIDENTS = 50  # 保留的阻塞事故数
+
+    # 采样分析
+    PROFILER_MAX_SECONDS = 30  # 单次采样时长上限（秒）
+    PROFILER_INTERVAL = 0.01  # 采样间隔（秒）
+    ADMIN_USER_PAGE_SIZE = 50  # 管理后台用户列表每页条数
+    FILE_MANAGER_PAGE_SIZE = 200  # 文件管理每页条目数
+    FILE_EDIT_MAX_BYTES = 1024 * 1024  # 超过此大小的文件只读分段查看
+    FILE_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 分块上传每块大小，需小于 MAX_CONTENT_LENGTH
+    SHUTDOWN_DRAIN_TIMEOUT = 30  # 重启/关停时等待处理中请求的最长时间（秒）
+    RESTART_READY_TIMEOUT = 30  # 等待新进程接管监听 socket 的最长时间（秒）
+    RECONNECT_DELAY = 1  # 客户端收到重启通知后最短重连等待（秒）
+    RECONNECT_JITTER = 10  # 重连等待的随机范围（秒）
+    AUTO_INIT_DB = True  # 首次请求时自动建表、迁移并写入初始数据；关闭后需先运行 flask --app app init-db
+    WORKERS = int(os.environ.get('WORKERS', 0)) or None  # flask --app app serve 的工作进程数，默认等于CPU核数
+    WORKER_STATS_INTERVAL = 5  # 工作进程负载上报间隔（秒）
+    WORKER_RESTART_BACKOFF = 1  # 工作进程异常退出后的首次重启等待，连续失败时翻倍（秒）
+    STATIC_USE_BUILD = None  # 使用 flask --app app build-assets 生成的带哈希、预压缩文件（未构建或原文件已修改时使用原文件）；None 表示仅在非 DEBUG 时使用
+    STATIC_BUILD_DIR = 'dist'  # 构建输出目录（相对 static/）
+    STATIC_ASSET_MAX_AGE = 365 * 24 * 3600  # 带哈希文件的缓存时间（秒）
+    TEMPLATE_CACHE_DIR = '.template_cache'  # 模板字节码缓存目录（相对项目目录），部署时运行 flask --app app compile-templates；设为 None 关闭
+    COMPRESS_MIN_SIZE = 1024  # 超过该大小（字节）的动态响应才压缩
+    COMPRESS_GZIP_LEVEL = 5  # gzip 压缩级别，动态响应偏向速度
+    COMPRESS_BROTLI_QUALITY = 4  # brotli 压缩质量（0-11），4 左右压缩率接近 gzip 9 且更快
+    STREAM_CHUNK_SIZE = 16 * 1024  # 流式渲染时每次发送的最小字节数
+    STREAM_BATCH_SIZE = 200  # 流式页面每批查询的行数
+
+    # 全局在线人数缓存时间（秒），/api/online_count 在此期间直接用缓存值判断 304
+    ONLINE_COUNT_CACHE_TTL = 5
+
+    # 聊天室增量同步时每次最多返回的消息数（也是客户端本地缓存的条数上限）
+    CHAT_SYNC_LIMIT = 200
+
+    # 房间列表中每个聊天室最多统计的未读数，超过时显示 99+
+    CHAT_UNREAD_CAP = 100
+
+    # 服务器心跳：在线人数、在线名单变化和房间动态统一由心跳推送
+    HEARTBEAT_INTERVAL = 10  # 空闲时的周期（秒）
+    HEARTBEAT_MAX_INTERVAL = 60  # 高负载时的最长周期（秒）
+    HEARTBEAT_CLIENT_TARGET = 500  # 单进程连接数超过此值后按比例延长周期
+    HEARTBEAT_LAG_TARGET = 0.05  # hub 调度延迟（秒）超过此值后按比例延长周期
\ No newline at end of file
@@ -21,6 +21,330 @@ const pendingMessages = new Map();
 const processedSystemEvents = new Map(); // {eventType_userId_timestamp: true}
 const recentSystemMessages = new Map(); // 防止重复系统消息
 
+// Markdown 渲染 Worker：渲染和清理在后台线程进行，结果按原始内容缓存
+const RENDER_CACHE_SIZE = 2000;
+const renderCache = new Map();     // content -> html（按使用顺序淘汰）
+const renderWaiting = new Map();   // content -> [callback]
+const renderRequests = new Map();  // 请求ID -> content
+let renderWorker = null;
+let nextRenderId = 1;
+
+// 创建渲染 Worker，不支持时继续在主线程用 window.renderContent 渲染
+function setupRenderWorker(workerUrl) {
+    if (renderWorker || !workerUrl || typeof Worker === 'undefined' || typeof RENDER_LIBS === 'undefined') {
+        return;
+    }
+    try {
+        renderWorker = new Worker(workerUrl);
+    } catch (e) {
+        console.warn('渲染 Worker 创建失败，使用主线程渲染:', e);
+        return;
+    }
+    renderWorker.onmessage = function(event) {
+        const data = event.data;
+        if (data.type === 'ready' && !data.ok) {
+            console.warn('渲染 Worker 未能加载渲染库，使用主线程渲染');
+            disableRenderWorker();
+        } else if (data.type === 'rendered') {
+            const content = renderRequests.get(data.id);
+            renderRequests.delete(data.id);
+            if (content !== undefined) {
+                finishRender(content, data.html);
+            }
+        }
+    };
+    renderWorker.onerror = function(e) {
+        console.error('渲染 Worker 出错，使用主线程渲染:', e.message);
+        disableRenderWorker();
+    };
+    renderWorker.postMessage({type: 'init', libs: RENDER_LIBS});
+}
+
+// 停用 Worker，已发出的请求改为在主线程完成
+function disableRenderWorker() {
+    if (renderWorker) {
+        renderWorker.terminate();
+        renderWorker = null;
+    }
+    const contents = Array.from(renderRequests.values());
+    renderRequests.clear();
+    contents.forEach(content => finishRender(content, renderOnMainThread(content)));
+}
+
+function renderOnMainThread(content) {
+    try {
+        if (typeof window.renderContent === 'function') {
+            return window.renderContent(content);
+        }
+    } catch (e) {
+        console.error('消息渲染失败:', e);
+    }
+    return `<div class="render-fallback">${escapeHtml(content)}</div>`;
+}
+
+function cacheRenderedHtml(content, html) {
+    renderCache.delete(content);
+    renderCache.set(content, html);
+    if (renderCache.size > RENDER_CACHE_SIZE) {
+        renderCache.delete(renderCache.keys().next().value);
+    }
+}
+
+function finishRender(content, html) {
+    cacheRenderedHtml(content, html);
+    const callbacks = renderWaiting.get(content) || [];
+    renderWaiting.delete(content);
+    callbacks.forEach(callback => callback(html));
+}
+
+// 渲染 Markdown：命中缓存时同步返回 HTML，否则返回 null 并在渲染完成后调用 callback
+function renderMarkdown(content, callback) {
+    if (renderCache.has(content)) {
+        const html = renderCache.get(content);
+        cacheRenderedHtml(content, html);
+        return html;
+    }
+    if (!renderWorker) {
+        const html = renderOnMainThread(content);
+        cacheRenderedHtml(content, html);
+        return html;
+    }
+    if (renderWaiting.has(content)) {
+        renderWaiting.get(content).push(callback);
+        return null;
+    }
+    renderWaiting.set(content, [callback]);
+    const id = nextRenderId++;
+    renderRequests.set(id, content);
+    renderWorker.postMessage({type: 'render', id: id, content: content});
+    return null;
+}
+
+// 虚拟滚动消息列表：DOM 中只保留可见区域及上下缓冲区内的条目，其余用占位高度代替
+const ESTIMATED_ITEM_HEIGHT = 64;
+const VIRTUAL_BUFFER_PX = 800;
+const chatItems = [];                   // {key, kind, msg, isLocal, text, height}
+const chatItemsByMessageId = new Map();
+const renderedItems = new Map();        // key -> 行元素
+let itemOffsets = [0];                  // itemOffsets[i] 为第 i 项的顶部位置
+let offsetsDirtyFrom = 0;
+let nextItemKey = 1;
+let virtualTopSpacer = null;
+let virtualWindow = null;
+let virtualBottomSpacer = null;
+let virtualRenderScheduled = false;
+let stickToBottom = true;
+
+// 已读位置：看到底部最新消息后上报，服务器据此维护房间列表的未读数
+const MARK_READ_DELAY = 1000;
+let lastReadId = 0;
+let markedReadId = 0;
+let markReadTimer = null;
+let unreadDividerShown = false;
+
+function scheduleMarkRead() {
+    if (markReadTimer) return;
+    markReadTimer = setTimeout(() => {
+        markReadTimer = null;
+        if (!chatSocket || !chatSocket.connected) return;
+        if (lastMessageId <= markedReadId || document.visibilityState === 'hidden' || !stickToBottom) return;
+        markedReadId = lastMessageId;
+        chatSocket.emit('mark_read', {room_id: roomId, message_id: markedReadId});
+    }, MARK_READ_DELAY);
+}
+
+function setupVirtualList() {
+    const container = document.getElementById('chat-messages');
+    if (!container || virtualWindow) return;
+    
+    virtualTopSpacer = document.createElement('div');
+    virtualWindow = document.createElement('div');
+    virtualBottomSpacer = document.createElement('div');
+    container.appendChild(virtualTopSpacer);
+    container.appendChild(virtualWindow);
+    container.appendChild(virtualBottomSpacer);
+    
+    container.addEventListener('scroll', () => {
+        stickToBottom = container.scrollHeight - container.scrollTop - container.clientHeight < 5;
+        scheduleVirtualRender();
+        if (stickToBottom) {
+            scheduleMarkRead();
+        }
+    }, {passive: true});
+    window.addEventListener('resize', scheduleVirtualRender);
+    document.addEventListener('visibilitychange', scheduleMarkRead);
+}
+
+// 追加一个条目（kind: message / date / unread / status / error）
+function appendChatItem(kind, data) {
+    const item = Object.assign({key: nextItemKey++, kind: kind, height: ESTIMATED_ITEM_HEIGHT}, data);
+    chatItems.push(item);
+    itemOffsets.push(0);
+    offsetsDirtyFrom = Math.min(offsetsDirtyFrom, chatItems.length - 1);
+    if (kind === 'message' && item.msg.id) {
+        chatItemsByMessageId.set(item.msg.id, item);
+    }
+    scheduleVirtualRender();
+    return item;
+}
+
+function scrollChatToBottom() {
+    stickToBottom = true;
+    scheduleVirtualRender();
+}
+
+function scheduleVirtualRender() {
+    if (virtualRenderScheduled) return;
+    virtualRenderScheduled = true;
+    requestAnimationFrame(renderVisibleItems);
+}
+
+function updateItemOffsets() {
+    for (let i = offsetsDirtyFrom; i < chatItems.length; i++) {
+        itemOffsets[i + 1] = itemOffsets[i] + chatItems[i].height;
+    }
+    offsetsDirtyFrom = chatItems.length;
+}
+
+// 二分查找位置 y 所在的条目下标
+function findItemIndex(y) {
+    let low = 0;
+    let high = chatItems.length - 1;
+    while (low < high) {
+        const mid = (low + high + 1) >> 1;
+        if (itemOffsets[mid] <= y) {
+            low = mid;
+        } else {
+            high = mid - 1;
+        }
+    }
+    return low;
+}
+
+function renderVisibleItems() {
+    virtualRenderScheduled = false;
+    const container = document.getElementById('chat-messages');
+    if (!container || !virtualWindow) return;
+    
+    updateItemOffsets();
+    const total = itemOffsets[chatItems.length];
+    const viewTop = stickToBottom ? Math.max(0, total - container.clientHeight) : container.scrollTop;
+    const start = chatItems.length ? findItemIndex(viewTop - VIRTUAL_BUFFER_PX) : 0;
+    const end = chatItems.length ? findItemIndex(viewTop + container.clientHeight + VIRTUAL_BUFFER_PX) + 1 : 0;
+    
+    // 移除离开窗口的节点，按顺序补上进入窗口的节点
+    const visibleKeys = new Set();
+    for (let i = start; i < end; i++) {
+        visibleKeys.add(chatItems[i].key);
+    }
+    renderedItems.forEach((element, key) => {
+        if (!visibleKeys.has(key)) {
+            element.remove();
+            renderedItems.delete(key);
+        }
+    });
+    let previous = null;
+    for (let i = start; i < end; i++) {
+        const item = chatItems[i];
+        let element = renderedItems.get(item.key);
+        if (!element) {
+            element = createItemElement(item);
+            renderedItems.set(item.key, element);
+        }
+        const expected = previous ? previous.nextSibling : virtualWindow.firstChild;
+        if (element !== expected) {
+            virtualWindow.insertBefore(element, expected);
+        }
+        previous = element;
+    }
+    
+    // 测量实际高度；视口上方条目的高度变化要补偿滚动位置，避免内容跳动
+    let shift = 0;
+    for (let i = start; i < end; i++) {
+        const item = chatItems[i];
+        const height = renderedItems.get(item.key).offsetHeight;
+        if (height !== item.height) {
+            if (itemOffsets[i] + item.height <= viewTop) {
+                shift += height - item.height;
+            }
+            item.height = height;
+            offsetsDirtyFrom = Math.min(offsetsDirtyFrom, i);
+        }
+    }
+    updateItemOffsets();
+    virtualTopSpacer.style.height = itemOffsets[start] + 'px';
+    virtualBottomSpacer.style.height = (itemOffsets[chatItems.length] - itemOffsets[end]) + 'px';
+    
+    if (stickToBottom) {
+        container.scrollTop = container.scrollHeight;
+    } else if (shift) {
+        container.scrollTop += shift;
+    }
+}
+
+// 移除一条消息（管理员删除）
+function removeChatMessage(messageId) {
+    const item = chatItemsByMessageId.get(messageId);
+    if (!item) return;
+    const index = chatItems.indexOf(item);
+    chatItems.splice(index, 1);
+    itemOffsets.pop();
+    offsetsDirtyFrom = Math.min(offsetsDirtyFrom, index);
+    chatItemsByMessageId.delete(messageId);
+    processedMessageIds.delete(messageId);
+    refreshChatItem(item);
+}
+
+// 清空消息列表（本地缓存与服务器不连续时整体替换）
+function clearChatMessages() {
+    chatItems.length = 0;
+    itemOffsets = [0];
+    offsetsDirtyFrom = 0;
+    chatItemsByMessageId.clear();
+    renderedItems.forEach(element => element.remove());
+    renderedItems.clear();
+    processedMessageIds.clear();
+    processedContentHashes.clear();
+    lastMessageDate = null;
+    lastMessageId = 0;
+    unreadDividerShown = false;
+    scrollChatToBottom();
+}
+
+// 条目重新渲染（例如待确认消息收到服务器确认）
+function refreshChatItem(item) {
+    const element = renderedItems.get(item.key);
+    if (element) {
+        element.remove();
+        renderedItems.delete(item.key);
+    }
+    scheduleVirtualRender();
+}
+
+// 创建条目的行元素；行使用独立格式化上下文，测得的高度包含内部元素的外边距
+function createItemElement(item) {
+    let element;
+    if (item.kind === 'message') {
+        element = createMessageElement(item.msg, item.isLocal);
+        element.dataset.messageId = item.msg.id;
+        element.dataset.contentHash = item.contentHash;
+    } else if (item.kind === 'date') {
+        element = createDateSeparator(item.text);
+    } else if (item.kind === 'unread') {
+        element = createDateSeparator(item.text);
+        element.classList.add('unread-separator');
+    } else {
+        element = document.createElement('div');
+        element.className = item.kind === 'error' ? 'chat-error' : 'chat-status';
+        element.textContent = item.text;
+    }
+    const row = document.createElement('div');
+    row.className = item.shown ? 'chat-row chat-row-seen' : 'chat-row';
+    row.appendChild(element);
+    item.shown = true;
+    return row;
+}
+
 // 初始化渲染系统
 function initializeRenderingSystem() {
     // 如果renderContent函数已经存在，直接使用它
@@ -119,34 +443,6 @@ var currentUserColor = '#000000';
 var currentUserBadge = '';
 var currentUserId = 0;
 
-// 更健壮的渲染就绪检测
-function waitForRenderSystem(callback) {
-    const checkInterval = setInterval(() => {
-        try {
-            // 检查渲染系统是否真正可用
-            if (typeof window.renderContent === 'function') {
-                // 尝试渲染测试内容
-                window.renderContent('**test**');
-                clearInterval(checkInterval);
-                callback();
-                return;
-            }
-        } catch (e) {
-            console.debug('渲染系统尚未完全就绪:', e);
-        }
-    }, 200);
-    
-    // 超时处理
-    setTimeout(() => {
-        clearInterval(checkInterval);
-        if (!isRenderingReady) {
-            console.warn('渲染系统加载超时，强制初始化降级方案');
-            initializeRenderingSystem(); // 使用降级方案
-            callback();
-        }
-    }, 3000);
-}
-
 // 设置模态框
 function setupModal() {
     const modal = document.getElementById('online-list-modal');
@@ -173,95 +469,273 @@ function setupModal() {
     };
 }
 
-// 加载聊天历史
+// 本地历史缓存：IndexedDB 中按 用户:房间 保存最近的消息和墓碑游标，重新打开房间时只同步增量
+const HISTORY_DB_NAME = 'social-platform-chat';
+const HISTORY_STORE = 'rooms';
+const HISTORY_CACHE_LIMIT = 200;
+let historyDb = null;
+let cachedMessages = [];   // 已确认的消息，按ID升序
+let tombstoneCursor = 0;
+let lastSyncData = null;
+let historySaveTimer = null;
+
+function openHistoryDb() {
+    if (historyDb) return historyDb;
+    historyDb = new Promise(resolve => {
+        if (typeof indexedDB === 'undefined') {
+            resolve(null);
+            return;
+        }
+        try {
+            const request = indexedDB.open(HISTORY_DB_NAME, 1);
+            request.onupgradeneeded = () => {
+                request.result.createObjectStore(HISTORY_STORE, {keyPath: 'key'});
+            };
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => {
+                console.warn('打开本地历史缓存失败:', request.error);
+                resolve(null);
+            };
+        } catch (e) {
+            console.warn('本地历史缓存不可用:', e);
+            resolve(null);
+        }
+    });
+    return historyDb;
+}
+
+function historyKey() {
+    return `${currentUserId}:${roomId}`;
+}
+
+function readCachedHistory() {
+    return openHistoryDb().then(db => new Promise(resolve => {
+        if (!db) return resolve(null);
+        try {
+            const request = db.transaction(HISTORY_STORE).objectStore(HISTORY_STORE).get(historyKey());
+            request.onsuccess = () => resolve(request.result || null);
+            request.onerror = () => resolve(null);
+        } catch (e) {
+            resolve(null);
+        }
+    }));
+}
+
+// 合并一秒内的多次变更再写入
+function saveCachedHistory() {
+    if (historySaveTimer) return;
+    historySaveTimer = setTimeout(() => {
+        historySaveTimer = null;
+        openHistoryDb().then(db => {
+            if (!db) return;
+            try {
+                db.transaction(HISTORY_STORE, 'readwrite').objectStore(HISTORY_STORE).put({
+                    key: historyKey(),
+                    cursor: tombstoneCursor,
+                    messages: cachedMessages,
+                    saved_at: Date.now()
+                });
+            } catch (e) {
+                console.warn('保存本地历史缓存失败:', e);
+            }
+        });
+    }, 1000);
+}
+
+function deleteCachedHistory() {
+    openHistoryDb().then(db => {
+        if (!db) return;
+        try {
+            db.transaction(HISTORY_STORE, 'readwrite').objectStore(HISTORY_STORE).delete(historyKey());
+        } catch (e) {
+            console.warn('删除本地历史缓存失败:', e);
+        }
+    });
+}
+
+// 记录一条已确认的消息（由 addMessageToUI 和消息确认调用）
+function rememberMessage(msg) {
+    if (typeof msg.id !== 'number') return;
+    if (msg.id > lastMessageId) {
+        lastMessageId = msg.id;
+        scheduleMarkRead();
+    }
+    const last = cachedMessages[cachedMessages.length - 1];
+    if (last && msg.id <= last.id) return;
+    cachedMessages.push({
+        id: msg.id,
+        content: msg.content,
+        timestamp: msg.timestamp,
+        user_id: msg.user_id,
+        username: msg.username,
+        nickname: msg.nickname,
+        color: msg.color,
+        badge: msg.badge
+    });
+    if (cachedMessages.length > HISTORY_CACHE_LIMIT) {
+        cachedMessages.splice(0, cachedMessages.length - HISTORY_CACHE_LIMIT);
+    }
+    saveCachedHistory();
+}
+
+// 应用一次增量同步的结果，after 为请求时本地最后一条消息的ID
+function applyHistorySync(data, after) {
+    // 304 时返回的是上次的同一个结果，不重复应用
+    if (data === lastSyncData) return;
+    lastSyncData = data;
+    
+    let messages = data.messages;
+    if (data.reset) {
+        // 保留请求期间经 WebSocket 收到、比返回结果更新的消息
+        const lastReturned = messages.length ? messages[messages.length - 1].id : 0;
+        const newer = cachedMessages.filter(msg => msg.id > Math.max(after, lastReturned));
+        cachedMessages = [];
+        clearChatMessages();
+        messages = messages.concat(newer);
+    }
+    
+    // 移除管理员删除的消息
+    if (data.tombstones && data.tombstones.length) {
+        const removed = new Set(data.tombstones);
+        cachedMessages = cachedMessages.filter(msg => !removed.has(msg.id));
+        data.tombstones.forEach(removeChatMessage);
+    }
+    
+    // 用最新资料刷新缓存消息的昵称、颜色和徽章
+    const users = data.users || {};
+    cachedMessages.forEach(cached => {
+        const user = users[cached.user_id];
+        if (!user) return;
+        const profile = {
+            username: user.username,
+            nickname: user.nickname || user.username,
+            color: user.color,
+            badge: user.badge
+        };
+        if (Object.keys(profile).every(field => cached[field] === profile[field])) return;
+        Object.assign(cached, profile);
+        const item = chatItemsByMessageId.get(cached.id);
+        if (item) {
+            item.msg = Object.assign({}, item.msg, profile);
+            refreshChatItem(item);
+        }
+    });
+    
+    messages.forEach(msg => {
+        addMessageToUI(msg);
+    });
+    tombstoneCursor = data.cursor;
+    saveCachedHistory();
+}
+
+// 同步服务器上比本地缓存新的消息
+function syncChatHistory() {
+    const last = cachedMessages[cachedMessages.length - 1];
+    const after = last ? last.id : 0;
+    return fetchJsonIfModified(`/api/chat/${roomId}/sync?after=${after}&tombstones=${tombstoneCursor}`)
+        .then(data => applyHistorySync(data, after))
+        .catch(error => {
+            if (error.status === 404) {
+                deleteCachedHistory();
+            }
+            throw error;
+        });
+}
+
+// 加载聊天历史：先显示本地缓存，再取增量
 function loadChatHistory() {
     if (chatHistoryLoaded) return;
+    chatHistoryLoaded = true;
     
-    fetch(`/api/chat/${roomId}/history`)
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP错误! 状态: ${response.status}`);
-            }
-            return response.json();
-        })
-        .then(data => {
-            const messagesContainer = document.getElementById('chat-messages');
-            if (!messagesContainer) return;
-            
-            // 重置日期跟踪变量，以便在加载历史时能正确显示日期分隔符
-            lastMessageDate = null;
-            
-            // 保存当前滚动位置
-            const isScrolledToBottom = Math.abs(
-                messagesContainer.scrollHeight - messagesContainer.scrollTop - messagesContainer.clientHeight
-            ) < 5;
-            
-            data.messages.forEach(msg => {
-                addMessageToUI(msg);
-            });
-            
-            // 更新最后一条消息ID
-            if (data.messages.length > 0) {
-                lastMessageId = data.messages[data.messages.length - 1].id;
-                // 设置最后消息日期为最后一条消息的日期
-                lastMessageDate = getMessageDate(data.messages[data.messages.length - 1].timestamp);
-            }
-            
-            // 如果之前滚动到底部，则滚动到底部
-            if (isScrolledToBottom) {
-                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    readCachedHistory()
+        .then(cached => {
+            if (cached && cached.messages) {
+                tombstoneCursor = cached.cursor || 0;
+                cached.messages.forEach(msg => {
+                    addMessageToUI(msg);
+                });
             }
-            chatHistoryLoaded = true;
+            scrollChatToBottom();
+            return syncChatHistory();
         })
         .catch(error => {
             console.error('加载历史消息失败:', error);
-            const messagesContainer = document.getElementById('chat-messages');
-            if (messagesContainer) {
-                messagesContainer.innerHTML += 
-                    `<div class="chat-error">加载历史消息失败: ${error.message}</div>`;
-            }
+            appendChatItem('error', {text: `加载历史消息失败: ${error.message}`});
         });
 }
 
-// 设置轮询（老旧浏览器降级方案）
+// Socket.IO 不可用时的降级方案：定时同步，有新消息时缩短间隔、没有时逐步拉长；
+// 同步请求带 ETag，没有变化时服务器直接返回 304。连接恢复后由服务器心跳接管
+const POLL_MIN_INTERVAL = 5000;
+const POLL_MAX_INTERVAL = 60000;
+let pollingStarted = false;
+let pollTimer = null;
+let pollInterval = POLL_MIN_INTERVAL;
+
 function setupPolling() {
-    console.log('使用轮询作为WebSocket的降级方案');
-    
-    // 每5秒检查一次新消息
-    setInterval(() => {
-        if (lastMessageId > 0) {
-            fetch(`/api/chat/${roomId}/history?offset=0&limit=50`)
-                .then(response => response.json())
-                .then(data => {
-                    const messagesContainer = document.getElementById('chat-messages');
-                    if (!messagesContainer) return;
-                    
-                    let hasNewMessages = false;
-                    
-                    data.messages.forEach(msg => {
-                        if (msg.id > lastMessageId) {
-                            addMessageToUI(msg);
-                            hasNewMessages = true;
-                            
-                            // 更新最后一条消息ID
-                            if (msg.id > lastMessageId) {
-                                lastMessageId = msg.id;
-                            }
-                        }
-                    });
-                    
-                    if (hasNewMessages) {
-                        messagesContainer.scrollTop = messagesContainer.scrollHeight;
-                    }
-                })
-                .catch(error => {
-                    console.error('轮询获取消息失败:', error);
-                });
+    if (pollingStarted || (chatSocket && chatSocket.connected)) return;
+    pollingStarted = true;
+    pollInterval = POLL_MIN_INTERVAL;
+    console.log('Socket.IO 不可用，改为定时同步消息');
+    appendChatItem('status', {text: '实时连接不可用，消息将定时同步，可能有延迟'});
+    pollChatHistory();
+}
+
+function pollChatHistory() {
+    pollTimer = null;
+    const before = lastMessageId;
+    syncChatHistory()
+        .then(() => {
+            pollInterval = lastMessageId > before ? POLL_MIN_INTERVAL : Math.min(pollInterval * 2, POLL_MAX_INTERVAL);
+        })
+        .catch(error => {
+            console.error('获取消息失败:', error);
+            pollInterval = Math.min(pollInterval * 2, POLL_MAX_INTERVAL);
+        })
+        .then(() => {
+            if (!pollingStarted) return;
+            updateOnlineStatus();
+            pollTimer = setTimeout(pollChatHistory, pollInterval);
+        });
+}
+
+function stopPolling() {
+    pollingStarted = false;
+    if (pollTimer) {
+        clearTimeout(pollTimer);
+        pollTimer = null;
+    }
+}
+
+// 服务器心跳：连接时收到完整在线名单，之后只收到变化；房间有未经推送的变动（如管理员删除）时同步一次
+let roomEventsSinceHeartbeat = 0;
+
+function applyHeartbeat(data) {
+    const presence = data.presence;
+    if (presence) {
+        if (presence.users) {
+            onlineUsers = presence.users;
+        } else {
+            const left = new Set(presence.left || []);
+            const joined = new Map((presence.joined || []).map(user => [user.id, user]));
+            onlineUsers = onlineUsers
+                .filter(user => !left.has(user.id) && !joined.has(user.id))
+                .concat(Array.from(joined.values()));
         }
-    }, 5000);
+        updateOnlineCount();
+        const modal = document.getElementById('online-list-modal');
+        if (modal && modal.style.display === 'block') {
+            updateOnlineUsersList();
+        }
+    }
     
-    // 每30秒更新在线状态
-    setInterval(updateOnlineStatus, 30000);
+    const activity = (data.activity || {})[roomId] || 0;
+    if (chatHistoryLoaded && activity > roomEventsSinceHeartbeat) {
+        syncChatHistory().catch(error => {
+            console.error('同步消息失败:', error);
+        });
+    }
+    roomEventsSinceHeartbeat = 0;
 }
 
 // 设置WebSocket
@@ -285,14 +759,21 @@ function setupWebSocket() {
         
         chatSocket.on('connect', () => {
             console.log('WebSocket连接已建立');
+            stopPolling();
             
             // 关键修改：仅在首次连接时发送join事件
             if (!chatSocket.hasJoinedRoom) {
                 chatSocket.emit('join', {room: roomId});
                 chatSocket.hasJoinedRoom = true; // 标记已加入房间
+                
+                // 重连后补上断开期间错过的消息
+                if (chatHistoryLoaded) {
+                    syncChatHistory().catch(error => {
+                        console.error('同步消息失败:', error);
+                    });
+                }
             }
-            
-            updateOnlineStatus();
+            // 在线状态由连接时的心跳带来，无需再请求
         });
         
         chatSocket.on('disconnect', (reason) => {
@@ -302,6 +783,12 @@ function setupWebSocket() {
                 onlineCountElement.textContent = '连接中...';
             }
             
+            // 服务器重启：按通知的退避时间重连，重连后重新加入房间
+            if (typeof scheduleServerReconnect === 'function' &&
+                scheduleServerReconnect(chatSocket, reason, () => { chatSocket.hasJoinedRoom = false; })) {
+                return;
+            }
+            
             // 尝试重新连接
             if (reason !== 'io server disconnect') {
                 setTimeout(() => {
@@ -319,11 +806,12 @@ function setupWebSocket() {
                 onlineCountElement.textContent = '连接错误';
             }
             
-            // 尝试轮询作为后备
+            // 尝试轮询作为后备（已在轮询时不重复启动）
             setTimeout(setupPolling, 3000);
         });
         
         chatSocket.on('message', (data) => {
+            roomEventsSinceHeartbeat++;
             // 检查是否是对本地消息的确认
             if (data.client_id && pendingMessages.has(data.client_id)) {
                 // 更新现有消息，而不是添加新消息
@@ -335,10 +823,16 @@ function setupWebSocket() {
             }
         });
         
+        chatSocket.on('server_shutdown', (data) => {
+            chatSocket.serverShutdown = data;
+        });
+        
         chatSocket.on('online_users', (data) => {
             onlineUsers = data.users || [];
             updateOnlineCount();
         });
+        
+        chatSocket.on('heartbeat', applyHeartbeat);
     } catch (e) {
         console.error('WebSocket初始化失败:', e);
         setupPolling();
@@ -347,12 +841,11 @@ function setupWebSocket() {
 
 // 更新在线状态
 function updateOnlineStatus() {
-    if (chatSocket) {
+    if (chatSocket && chatSocket.connected) {
         chatSocket.emit('get_online_users', {room_id: roomId});
     } else {
         // 轮询模式下，简单更新在线人数
-        fetch('/api/online_count')
-            .then(response => response.json())
+        fetchJsonIfModified('/api/online_count')
             .then(data => {
                 const onlineCountElement = document.getElementById('online-count');
                 if (onlineCountElement) {
@@ -440,6 +933,7 @@ function sendMessage() {
         };
         
         addMessageToUI(localMessage, true);
+        roomEventsSinceHeartbeat++;
         
         chatSocket.emit('send_message', {
             room_id: roomId,
@@ -484,10 +978,8 @@ function sendMessage() {
         .catch(error => {
             console.error('发送消息失败:', error);
             // 显示错误
-            const errorElement = document.createElement('div');
-            errorElement.className = 'chat-error';
-            errorElement.textContent = '消息发送失败，请检查网络连接';
-            document.getElementById('chat-messages').appendChild(errorElement);
+            appendChatItem('error', {text: '消息发送失败，请检查网络连接'});
+            scrollChatToBottom();
         });
     }
 }
@@ -522,11 +1014,16 @@ function addMessageToUI(msg, isLocal = false) {
         const currentDate = getMessageDate(msg.timestamp);
         if (lastMessageDate && lastMessageDate !== currentDate) {
             // 添加日期分隔符
-            addDateSeparator(messagesContainer, currentDate);
+            addDateSeparator(currentDate);
         }
         lastMessageDate = currentDate;
     }
     
+    // 已确认的消息写入本地缓存（与本地预览重复、不再显示的也要记录）
+    if (!msg.type) {
+        rememberMessage(msg);
+    }
+    
     // 1. 检查重复消息ID
     if (msg.id && processedMessageIds.has(msg.id)) {
         return;
@@ -561,17 +1058,26 @@ function addMessageToUI(msg, isLocal = false) {
     }
     processedContentHashes.add(contentHash);
     
-    // 创建并添加消息元素
-    const messageElement = createMessageElement(msg, isLocal);
-    messageElement.dataset.contentHash = contentHash;  // 存储内容哈希以便后续匹配
+    // 上次离开后别人发来的第一条消息前显示未读分隔线
+    if (!unreadDividerShown && lastReadId && typeof msg.id === 'number' &&
+        msg.id > lastReadId && msg.user_id !== currentUserId) {
+        unreadDividerShown = true;
+        appendChatItem('unread', {text: '以下为新消息'});
+    }
     
-    // 添加到容器
-    messagesContainer.appendChild(messageElement);
-    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    // 添加到列表（元素在进入可见区域时才创建）；自己发送的消息总是滚动到底部
+    appendChatItem('message', {msg: msg, isLocal: isLocal, contentHash: contentHash});
+    if (isLocal) {
+        scrollChatToBottom();
+    }
 }
 
 // 添加日期分隔符
-function addDateSeparator(container, dateStr) {
+function addDateSeparator(dateStr) {
+    appendChatItem('date', {text: dateStr});
+}
+
+function createDateSeparator(dateStr) {
     const separatorElement = document.createElement('div');
     separatorElement.className = 'date-separator';
     separatorElement.innerHTML = `
@@ -579,7 +1085,7 @@ function addDateSeparator(container, dateStr) {
         <span class="date-separator-text">${dateStr}</span>
         <div class="date-separator-line"></div>
     `;
-    container.appendChild(separatorElement);
+    return separatorElement;
 }
 
 // 添加状态消息
@@ -608,41 +1114,26 @@ function addStatusMessage(msg) {
         }
     }, 10000);
     
-    const statusElement = document.createElement('div');
-    statusElement.className = 'chat-status';
-    statusElement.textContent = msg;
-    
-    messagesContainer.appendChild(statusElement);
-    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    appendChatItem('status', {text: msg});
 }
 
 // 更新现有消息
 function updateExistingMessage(clientId, serverMessage) {
-    // 查找对应的消息元素
-    const existingMessage = document.querySelector(`[data-message-id="${clientId}"]`);
-    if (!existingMessage) return;
-    
-    // 更新ID（从临时ID到服务器ID）
-    existingMessage.dataset.messageId = serverMessage.id;
-    
-    // 更新时间戳
-    const timeElement = existingMessage.querySelector('.message-time');
-    if (timeElement) {
-        timeElement.textContent = formatTimeDisplay(serverMessage.timestamp);
-    }
+    // 查找对应的消息条目
+    const item = chatItemsByMessageId.get(clientId);
+    if (!item) return;
     
-    // 清除pending状态
-    existingMessage.classList.remove('pending-message');
-    
-    // 重新渲染内容（如有需要）
-    const contentElement = existingMessage.querySelector('.message-content');
-    if (contentElement && typeof window.renderContent === 'function') {
-        try {
-            contentElement.innerHTML = window.renderContent(serverMessage.content);
-        } catch (e) {
-            console.error('更新消息内容失败:', e);
-        }
-    }
+    // 更新ID（从临时ID到服务器ID）、时间戳和内容，清除pending状态
+    item.msg = Object.assign({}, item.msg, {
+        id: serverMessage.id,
+        timestamp: serverMessage.timestamp,
+        content: serverMessage.content,
+        isPending: false
+    });
+    chatItemsByMessageId.delete(clientId);
+    chatItemsByMessageId.set(serverMessage.id, item);
+    refreshChatItem(item);
+    rememberMessage(item.msg);
     
     // 更新processed集合
     processedMessageIds.delete(clientId);
@@ -717,7 +1208,7 @@ function createMessageElement(msg, isLocal = false) {
     contentElement.className = 'message-content';
     contentElement.dataset.originalContent = msg.content; // 保存原始内容用于重试
 
-    // 尝试立即渲染
+    // 尝试立即渲染（缓存未命中时先显示原文，Worker 渲染完成后替换）
     tryRenderMessage(contentElement, msg.content);
     
     // 组装
@@ -742,33 +1233,39 @@ function processMessageQueue() {
 
 // 安全渲染消息
 function tryRenderMessage(element, content) {
-    if (typeof window.renderContent === 'function') {
-        try {
-            element.innerHTML = window.renderContent(content);
-            return true;
-        } catch (e) {
-            console.error('消息渲染失败:', e);
+    const html = renderMarkdown(content, rendered => {
+        // 条目可能已滚出窗口，结果仍留在缓存中
+        if (element.isConnected) {
+            element.innerHTML = rendered;
+            scheduleVirtualRender();
         }
+    });
+    if (html !== null) {
+        element.innerHTML = html;
+        return true;
     }
     
-    // 降级渲染
+    // 等待 Worker 渲染期间先显示原文
     element.innerHTML = `<div class="render-fallback">${escapeHtml(content)}</div>`;
     return false;
 }
 
 // 重新尝试渲染所有消息
 function retryRenderingAllMessages() {
-    document.querySelectorAll('.message-content').forEach(element => {
-        const content = element.dataset.originalContent;
-        if (content) {
-            tryRenderMessage(element, content);
-        }
-    });
+    renderCache.clear();
+    renderedItems.forEach(element => element.remove());
+    renderedItems.clear();
+    scheduleVirtualRender();
 }
 
 
 // 全局初始化函数
+let chatInitialized = false;
+
 window.initChat = function() {
+    if (chatInitialized) return;
+    chatInitialized = true;
+    
     // 重置日期跟踪变量
     lastMessageDate = null;
     
@@ -788,6 +1285,7 @@ window.initChat = function() {
         currentNickname = roomData.nickname || currentUsername;
         currentUserColor = roomData.color || '#000000';
         currentUserBadge = roomData.badge || '';
+        lastReadId = markedReadId = roomData.last_read_id || 0;
         
         // 1. 先设置UI元素
         const onlineCountElement = document.getElementById('online-count');
@@ -797,6 +1295,8 @@ window.initChat = function() {
         
         setupModal();
         setupMessageInput();
+        setupVirtualList();
+        setupRenderWorker(roomData.render_worker);
         
         // 2. 然后连接WebSocket
         setupWebSocket();
@@ -806,14 +1306,17 @@ window.initChat = function() {
             loadChatHistory();
         }, 500); // 短暂延迟，确保WebSocket有时间初始化
         
-        // 4. 设置渲染就绪处理
-        document.addEventListener('renderReady', function() {
-            isRenderingReady = true;
-            processMessageQueue();
-        });
-        
-        if (typeof window.renderContent === 'function') {
+        // 4. 设置渲染就绪处理：没有 Worker 时用刚加载的渲染库重新渲染
+        if (window.renderLibsReady) {
             isRenderingReady = true;
+        } else {
+            document.addEventListener('renderReady', function() {
+                isRenderingReady = true;
+                processMessageQueue();
+                if (!renderWorker) {
+                    retryRenderingAllMessages();
+                }
+            });
         }
         
         console.log('聊天系统初始化完成');
@@ -822,40 +1325,6 @@ window.initChat = function() {
     }
 };
 
-// 确保所有依赖加载
-function ensureDependenciesLoaded(callback) {
-    const dependencies = [
-        { name: 'socket.io', check: () => typeof io !== 'undefined' },
-        { name: 'marked', check: () => typeof marked !== 'undefined' }
-    ];
-    
-    let loadedCount = 0;
-    const checkAllLoaded = setInterval(() => {
-        dependencies.forEach(dep => {
-            if (dep.check()) {
-                dependencies = dependencies.filter(d => d !== dep);
-                loadedCount++;
-                console.log(`${dep.name} 已加载`);
-            }
-        });
-        
-        if (dependencies.length === 0 || loadedCount >= dependencies.length) {
-            clearInterval(checkAllLoaded);
-            callback();
-        }
-    }, 200);
-    
-    // 超时处理
-    setTimeout(() => {
-        clearInterval(checkAllLoaded);
-        if (dependencies.length > 0) {
-            console.warn('部分依赖加载超时，继续初始化:', 
-                dependencies.map(d => d.name));
-        }
-        callback();
-    }, 5000);
-}
-
 // 全局错误处理
 window.addEventListener('error', function(e) {
     if (e.message.includes('marked is not defined')) {
@@ -883,18 +1352,13 @@ function initializeGlobalOnlineCount() {
 // 页面加载完成后自动初始化
 document.addEventListener('DOMContentLoaded', function() {
     if (document.getElementById('chat-messages')) {
-        // 1. 首先确保渲染系统就绪
-        waitForRenderSystem(() => {
-            // 2. 确保所有依赖库加载
-            ensureDependenciesLoaded(() => {
-                // 3. 最后初始化聊天系统
-                if (typeof window.initChat === 'function') {
-                    window.initChat();
-                } else {
-                    console.error('initChat 函数未定义');
-                }
-            });
-        });
+        // socket.io 由 room.html 加载，加载完成（或失败）后初始化聊天系统；
+        // 渲染库不必等待，消息由 Worker 渲染，主线程降级渲染在 renderReady 后重做
+        if (typeof waitForSocketIo === 'function') {
+            waitForSocketIo(window.initChat);
+        } else {
+            window.initChat();
+        }
     } else {
         // 如果不是聊天页面，仍然初始化全局在线人数更新
         initializeGlobalOnlineCount();
@@ -0,0 +1,45 @@
+// Markdown 渲染的安全设置：主线程（base.html）和渲染 Worker 共用，两条渲染路径的结果一致
+// 原始 HTML 一律转义，链接和图片只保留安全协议的地址
+var configureMarkedSanitizer = (function() {
+    function escapeHtml(unsafe) {
+        if (!unsafe) return '';
+        return String(unsafe)
+            .replace(/&/g, "&amp;")
+            .replace(/</g, "&lt;")
+            .replace(/>/g, "&gt;")
+            .replace(/"/g, "&quot;")
+            .replace(/'/g, "&#039;");
+    }
+
+    // 检查链接地址：只允许相对地址、http(s)、mailto 和常见图片格式的 data URL
+    function isSafeUrl(url) {
+        // 浏览器会先解码实体、去掉控制字符再解析协议，这里按同样的方式还原后判断
+        var decoded = String(url || '')
+            .replace(/&#x([0-9a-f]+);?/gi, function(match, hex) { return String.fromCharCode(parseInt(hex, 16)); })
+            .replace(/&#(\d+);?/g, function(match, dec) { return String.fromCharCode(parseInt(dec, 10)); })
+            .replace(/&colon;?/gi, ':')
+            .replace(/&[a-z]+;?/gi, '')
+            .replace(/[\u0000- \u007f]/g, '')
+            .toLowerCase();
+        var scheme = decoded.match(/^([a-z][a-z0-9+.\-]*):/);
+        if (!scheme) return true;
+        if (['http', 'https', 'mailto'].indexOf(scheme[1]) !== -1) return true;
+        return /^data:image\/(png|gif|jpe?g|webp);/.test(decoded);
+    }
+
+    return function(marked) {
+        marked.use({
+            renderer: {
+                html: function(html) {
+                    return escapeHtml(html);
+                },
+                link: function(href, title, text) {
+                    return isSafeUrl(href) ? false : text;
+                },
+                image: function(href, title, text) {
+                    return isSafeUrl(href) ? false : escapeHtml(text);
+                }
+            }
+        });
+    };
+})();
@@ -0,0 +1,81 @@
+// Markdown 渲染 Worker：在后台线程渲染 Markdown/LaTeX 并清理 HTML，避免长列表渲染阻塞滚动和输入
+// 消息格式：
+//   {type: 'init', libs: {marked: url, sanitize: url, katex: url}}
+//   {type: 'render', id, content}  ->  {type: 'rendered', id, html}
+let librariesLoaded = false;
+
+// HTML转义函数
+function escapeHtml(unsafe) {
+    if (!unsafe) return '';
+    return unsafe
+        .replace(/&/g, "&amp;")
+        .replace(/</g, "&lt;")
+        .replace(/>/g, "&gt;")
+        .replace(/"/g, "&quot;")
+        .replace(/'/g, "&#039;");
+}
+
+// 加载渲染库，并让 marked 转义原始HTML、丢弃不安全的链接（与主线程共用 render_sanitize.js）
+function loadLibraries(libs) {
+    try {
+        importScripts(libs.marked, libs.sanitize);
+    } catch (e) {
+        console.error('Worker 加载 marked 失败:', e);
+        return;
+    }
+    try {
+        importScripts(libs.katex);
+    } catch (e) {
+        console.warn('Worker 加载 KaTeX 失败，公式按原文显示:', e);
+    }
+
+    configureMarkedSanitizer(marked);
+    librariesLoaded = true;
+}
+
+// 渲染单个公式，失败时按原文显示
+function renderLatex(source, displayMode, open, close) {
+    if (typeof katex === 'undefined') {
+        return escapeHtml(open) + source + escapeHtml(close);
+    }
+    try {
+        const html = katex.renderToString(source, {
+            throwOnError: false,
+            displayMode: displayMode
+        });
+        return displayMode ? '<div class="katex-block">' + html + '</div>' : html;
+    } catch (e) {
+        const tag = displayMode ? 'div' : 'span';
+        const cls = displayMode ? 'katex-block katex-error' : 'katex-error';
+        return `<${tag} class="${cls}">${escapeHtml(open)}${source}${escapeHtml(close)}</${tag}>`;
+    }
+}
+
+// 与 base.html 中 renderContent 的处理顺序一致
+function renderContent(content) {
+    if (!librariesLoaded) {
+        return '<pre class="plaintext-render">' + escapeHtml(content) + '</pre>';
+    }
+    try {
+        let html = marked.parse(content);
+        // 公式源码取自 marked 的输出，已经过转义
+        html = html.replace(/\$([^\$]+)\$/g, (match, p1) => renderLatex(p1, false, '$', '$'));
+        html = html.replace(/\$\$([^\$]+)\$\$/g, (match, p1) => renderLatex(p1, true, '$$', '$$'));
+        html = html.replace(/\\\((.*?)\\\)/g, (match, p1) => renderLatex(p1, false, '\\(', '\\)'));
+        html = html.replace(/\\\[(.*?)\\\]/g, (match, p1) => renderLatex(p1, true, '\\[', '\\]'));
+        return html;
+    } catch (e) {
+        console.error('内容渲染失败:', e);
+        return '<div class="render-error">' + escapeHtml(content) + '</div>';
+    }
+}
+
+self.onmessage = function(event) {
+    const data = event.data;
+    if (data.type === 'init') {
+        loadLibraries(data.libs);
+        self.postMessage({type: 'ready', ok: librariesLoaded});
+    } else if (data.type === 'render') {
+        self.postMessage({type: 'rendered', id: data.id, html: renderContent(data.content)});
+    }
+};